@@ -14,21 +14,37 @@ If you don't have python3 installed:
   make python3-host-precompiled
   tools/path/python3 tools/ssh_firmware_update.py ...
 """
-import os, sys, argparse, time, subprocess, threading, pty, select, errno, re, getpass
-from glob import glob
+import os, sys, argparse, time, subprocess, threading, pty, select, errno, re, getpass, socket
+import atexit, tempfile, hashlib, shutil, json, tarfile, zlib, lzma, io, asyncio, functools, contextlib, queue, signal
+import itertools
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import shlex
 import re
 import tty
+import termios
+import fcntl
 
 # --- CONSTANTS ---
 DEFAULT_USER = 'root'
 DEFAULT_TARGET_DIR = '/var/tmp'
 DEFAULT_EXTERNAL_BASE = '/var/media/ftp/external'
 FREETZ_PATH = '/mod/sbin:/mod/bin:/mod/usr/sbin:/mod/usr/bin:/mod/etc/init.d:/sbin:/bin:/usr/sbin:/usr/bin'
-PING_TIMEOUT = 1
-BOOT_WAIT_MAX_TRIES = 450  # one try every two seconds; 15 minutes
+SSH_PORT = 22
+BOOT_WAIT_TIMEOUT = 900  # seconds; 15 minutes
+SHUTDOWN_TIMEOUT = 60  # seconds the FRITZ!Box may take to go down after the reboot command
+BOOT_EXPECTED = 60  # typical seconds from shutdown to SSH up; probes are densest around it
+PROBE_TIMEOUT = 1.0  # seconds to connect to a port (and to read the SSH banner)
+PROBE_INTERVAL_MIN = 0.25
+PROBE_INTERVAL_MAX = 2.0
+WEB_WAIT_TIMEOUT = 60  # seconds to wait for the Freetz web interface once SSH is up
 SSH_TEST_CMD = 'pwd'
-SSH_LOG_FILE = '/tmp/ssh_firmware_update.log'
+SSH_LOG_DIR = '/tmp/ssh_firmware_update'  # debug log of the SSH commands, one JSON lines file per host and run
+SSH_LOG_MAX_BYTES = 16 * 1024 * 1024  # size at which a log file is rotated
+SSH_LOG_BACKUPS = 3  # rotated log files kept
+SSH_CONTROL_PERSIST = 600  # seconds an idle master connection is kept open
+SSH_KEEPALIVE = ['-o', 'ServerAliveInterval=5', '-o', 'ServerAliveCountMax=3']
+KEY_AUTH_RETRY = 10  # seconds before key authentication is probed again on a box that did not answer
 REBOOT_CMD = (
     "nohup sh -c 'prepare_fwupgrade end; "
     "/etc/inittab.shutdown; "
@@ -51,12 +67,12 @@ EMOJI = {
 }
 
 # --- UTILITY FUNCTIONS ---
-def cprint(msg, color=None, emoji=None, end='\n', file=sys.stdout):
+def cprint(msg, color=None, emoji=None, end='\n', file=None):
     """Print colored message with optional emoji prefix"""
     prefix = COLORS.get(color, '')
     suffix = COLORS['reset'] if color else ''
     emj = EMOJI.get(emoji, '') + ' ' if emoji else ''
-    print(f"{prefix}{emj}{msg}{suffix}", end=end, file=file, flush=True)
+    PROGRESS.write(f"{prefix}{emj}{msg}{suffix}{end}", file or sys.stdout)
 
 def cerror(msg):
     """Print error message"""
@@ -75,21 +91,16 @@ def cdebug(msg, debug=False):
     if debug:
         cprint(f"[DEBUG] {msg}", 'dim')
 
-def progress_bar(current, total, prefix='', width=40):
-    """Display a progress bar"""
-    if total == 0:
-        total = 1
-    percent = int(100 * current / total)
-    filled = int(width * current / total)
-    bar = '█' * filled + '-' * (width - filled)
-    print(f"\r{prefix}[{bar}] {percent}% ({current}/{total})", end='', flush=True)
-    if current >= total:
-        print()
+def progress_bar(current, total, width=20):
+    """Return a text progress bar"""
+    filled = int(width * min(current, total) / total) if total > 0 else width
+    return '█' * filled + '-' * (width - filled)
 
 def confirm(prompt, default=True):
     """Ask user for confirmation"""
     options = '[Y/n]' if default else '[y/N]'
-    response = input(f"{EMOJI['prompt']} {prompt} {options}: ").strip().lower()
+    with PROGRESS.hold():
+        response = input(f"{EMOJI['prompt']} {prompt} {options}: ").strip().lower()
     if not response:
         return default
     return response in ('y', 'yes')
@@ -109,75 +120,714 @@ def format_size(size_bytes):
         size_bytes /= 1024.0
     return f"{size_bytes:.1f} TB"
 
-def log_ssh_command(command, output="", debug=False):
-    """Log SSH/SCP commands to file for debugging"""
-    if not debug:
-        return
-    try:
-        with open(SSH_LOG_FILE, 'a', encoding='utf-8') as f:
-            timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            f.write(f"\n{'='*60}\n")
-            f.write(f"[{timestamp}] COMMAND: {command}\n")
-            if output:
-                f.write(f"OUTPUT:\n{output}\n")
-            f.write(f"{'='*60}\n")
-        cdebug(f"Logged SSH command to {SSH_LOG_FILE}", True)
-    except Exception as e:
-        cdebug(f"Failed to log SSH command: {e}", True)
+
+# --- PROGRESS DISPLAY ---
+PROGRESS_INTERVAL = 0.1  # seconds between two redraws of the live display
+PROGRESS_PLAIN_INTERVAL = 10  # seconds between two progress lines when the output is not a terminal
+PROGRESS_ROWS = 4  # transfers shown on a line of their own; the others share one more line
+
+class ProgressTask:
+    """One transfer of the progress display: update() records its position, nothing is printed"""
+    def __init__(self, display, label, total, done=0):
+        self.display = display
+        self.label = label
+        self.total = total
+        self.done = self.first = done
+        self.note = ''
+        self.start = time.monotonic()
+        self.shown = None  # position of the last plain line
+
+    def update(self, done, note=None):
+        """Set the bytes done so far and optionally a note shown after them"""
+        self.display._update(self, done, note)
+
+    def line(self, now):
+        """Progress line of the task"""
+        elapsed = now - self.start
+        speed = (self.done - self.first) / elapsed if elapsed > 0 else 0
+        eta = f"ETA: {int((self.total - self.done) / speed)}s" if speed > 0 else "ETA: -"
+        percent = min(100, int(100 * self.done / self.total)) if self.total > 0 else 100
+        return (f"   {self.label}: [{progress_bar(self.done, self.total)}] {percent}% | "
+                f"{format_size(self.done)}/{format_size(self.total)} | {format_size(speed)}/s | {eta}"
+                f"{' | ' + self.note if self.note else ''}")
+
+class ProgressDisplay:
+    """
+    Single renderer of the progress of all running transfers (uploads,
+    extractions, the hosts of a fleet). Any thread opens a task() and
+    updates it, which only records its position; one background thread
+    draws them every PROGRESS_INTERVAL seconds at most, below the other
+    output on a terminal ('live'), or as plain lines every
+    PROGRESS_PLAIN_INTERVAL seconds for logs ('plain'). Only the first
+    PROGRESS_ROWS transfers get a line each, the others are summed up in
+    one, so a redraw costs the same however many transfers run. cprint()
+    goes through write() so that messages are printed above the display.
+    """
+    def __init__(self):
+        self.mode = 'auto'  # 'live', 'plain', 'off' or 'auto' (live on a terminal, plain otherwise)
+        self.stream = None  # the console (default: sys.stdout)
+        self._tasks = {}  # running tasks, in start order
+        self._total = self._done = 0  # sums over the running tasks
+        self._lock = threading.RLock()
+        self._wake = threading.Condition(self._lock)
+        self._local = threading.local()
+        self._thread = None
+        self._changed = False
+        self._drawn = 0  # lines of the live display on the console
+        self._shown = None  # position of the last plain line of the other tasks
+        self._partial = False  # the console cursor is after a message without newline
+        self._held = 0
+
+    def console(self):
+        """The console stream (sys.stdout of the main thread)"""
+        stream = self.stream or sys.stdout
+        while isinstance(stream, ThreadOutput):
+            stream = stream.stream
+        return stream
+
+    def _mode(self):
+        if self.mode != 'auto':
+            return self.mode
+        stream = self.console()
+        return 'live' if stream.isatty() and os.environ.get('TERM') != 'dumb' else 'plain'
+
+    def set_owner(self, name):
+        """Prefix the labels of the tasks opened by the calling thread with name (e.g. the host)"""
+        self._local.owner = name
+
+    def owner(self):
+        return getattr(self._local, 'owner', None)
+
+    @contextlib.contextmanager
+    def task(self, label, total, done=0):
+        """Show a transfer of total bytes, done of them already there, while the block runs"""
+        owner = self.owner()
+        task = ProgressTask(self, f"{owner}: {label}" if owner else label, total, done)
+        if self._mode() == 'off':
+            yield task
+            return
+        with self._lock:
+            self._tasks[task] = None
+            self._total += task.total
+            self._done += task.done
+            self._changed = True
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='progress', daemon=True)
+                self._thread.start()
+        try:
+            yield task
+        finally:
+            with self._lock:
+                del self._tasks[task]
+                self._total -= task.total
+                self._done -= task.done
+                self._changed = True
+                self._wake.notify()
+
+    def _update(self, task, done, note):
+        with self._lock:
+            if task in self._tasks:
+                self._done += done - task.done
+            task.done = done
+            if note is not None:
+                task.note = note
+            self._changed = True
+
+    def write(self, text, stream):
+        """Print text (str, or bytes written to the file descriptor) to stream; on the console, above the live display"""
+        target = stream._current() if isinstance(stream, ThreadOutput) else stream
+        with self._lock:
+            if target is self.console() or target.isatty():
+                if self._drawn:
+                    self.console().write(self._erase())
+                    self.console().flush()
+                    self._changed = True
+                self._partial = bool(text) and text[-1:] not in ('\n', b'\n')
+            if isinstance(text, bytes):
+                stream.flush()
+                os.write(stream.fileno(), text)
+            else:
+                stream.write(text)
+                stream.flush()
+
+    @contextlib.contextmanager
+    def hold(self):
+        """Keep the live display off the console while the block runs (e.g. a prompt)"""
+        with self._lock:
+            self._held += 1
+            if self._drawn:
+                self.console().write(self._erase())
+                self.console().flush()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._held -= 1
+                self._changed = True
+
+    def _erase(self):
+        """Escape sequence removing the live display, leaving the cursor where it started"""
+        lines, self._drawn = self._drawn, 0
+        return '\r\033[2K' + '\033[A\033[2K' * (lines - 1) if lines else ''
+
+    def _rows(self, now):
+        rows, total, done = [], self._total, self._done
+        for task in itertools.islice(self._tasks, PROGRESS_ROWS):
+            rows.append((task, task.line(now)))
+            total -= task.total
+            done -= task.done
+        others = len(self._tasks) - len(rows)
+        if others:
+            percent = min(100, int(100 * done / total)) if total > 0 else 100
+            rows.append((None, f"   +{others} more: [{progress_bar(done, total)}] {percent}% | "
+                               f"{format_size(done)}/{format_size(total)}"))
+        return rows
+
+    def _draw_live(self, stream):
+        width = shutil.get_terminal_size().columns - 1
+        rows = [line[:width] for _, line in self._rows(time.monotonic())]
+        stream.write(self._erase() + '\n'.join(rows))
+        stream.flush()
+        self._drawn = len(rows)
+
+    def _draw_plain(self, stream):
+        lines = []
+        for task, line in self._rows(time.monotonic()):
+            position = task.done if task else self._done
+            if (task.shown if task else self._shown) != position:
+                lines.append(line + '\n')
+                if task:
+                    task.shown = position
+                else:
+                    self._shown = position
+        stream.write(''.join(lines))
+        stream.flush()
+
+    def _run(self):
+        live = self._mode() == 'live'
+        with self._lock:
+            while self._tasks:
+                self._wake.wait(PROGRESS_INTERVAL if live else PROGRESS_PLAIN_INTERVAL)
+                if not self._tasks or not self._changed or self._held or self._partial:
+                    continue
+                self._changed = False
+                if live:
+                    self._draw_live(self.console())
+                else:
+                    self._draw_plain(self.console())
+            if self._drawn:
+                self.console().write(self._erase())
+                self.console().flush()
+            self._thread = None
+
+PROGRESS = ProgressDisplay()
+
+class CommandLog:
+    """
+    Debug log of the SSH/SCP commands. Records are queued by the calling
+    threads and written by a single background thread as JSON lines, one
+    file per host ({prefix}{host}.jsonl in the log directory), rotated at
+    SSH_LOG_MAX_BYTES. close() writes out everything still queued.
+    """
+    def __init__(self):
+        self.directory = None
+        self.prefix = ''
+        self._queue = queue.Queue()
+        self._thread = None
+        self._files = {}
+
+    def open(self, directory, prefix=''):
+        """Start logging to directory"""
+        os.makedirs(directory, exist_ok=True)
+        self.directory, self.prefix = directory, prefix
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._writer, name='command-log', daemon=True)
+            self._thread.start()
+
+    def path(self, host):
+        """Log file of host"""
+        return os.path.join(self.directory, f"{self.prefix}{host or 'local'}.jsonl")
+
+    def write(self, **record):
+        """Queue a record (a timestamp is added); never blocks on the disk"""
+        if self.directory:
+            record = dict(time=datetime.now().isoformat(timespec='milliseconds'),
+                          thread=threading.current_thread().name, **record)
+            self._queue.put((self.path(record.get('host')), record))
+
+    def _writer(self):
+        while True:
+            item = self._queue.get()
+            batch = [item]
+            while item is not None:  # drain what is queued before touching the files
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                batch.append(item)
+            for entry in batch:
+                if entry is not None:
+                    self._append(*entry)
+            for path, f in list(self._files.items()):
+                try:
+                    f.flush()
+                except (OSError, ValueError) as e:  # e.g. a full disk: the writer keeps going
+                    cdebug(f"Failed to write SSH command log {path}: {e}", True)
+            if batch[-1] is None:
+                return
+
+    def _append(self, path, record):
+        try:
+            f = self._files.get(path)
+            if f is None:
+                f = self._files[path] = open(path, 'a', encoding='utf-8')
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+            if f.tell() >= SSH_LOG_MAX_BYTES:
+                f.close()
+                del self._files[path]
+                for n in range(SSH_LOG_BACKUPS - 1, 0, -1):
+                    if os.path.exists(f"{path}.{n}"):
+                        os.replace(f"{path}.{n}", f"{path}.{n + 1}")
+                os.replace(path, f"{path}.1")
+        except (OSError, ValueError) as e:
+            cdebug(f"Failed to log SSH command: {e}", True)
+
+    def close(self):
+        """Write out the queued records and close the files"""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        for path, f in self._files.items():
+            try:
+                f.close()
+            except OSError as e:
+                cdebug(f"Failed to write SSH command log {path}: {e}", True)
+        self._files.clear()
+
+COMMAND_LOG = CommandLog()
+atexit.register(COMMAND_LOG.close)
+
+def log_ssh_command(command, output="", debug=False, host=None, status=None, seconds=None):
+    """Log SSH/SCP commands for debugging (see CommandLog)"""
+    if debug:
+        COMMAND_LOG.write(host=host, command=command, status=status,
+                          seconds=None if seconds is None else round(seconds, 3), output=output)
+
+
+# --- TRACING ---
+class Tracer:
+    """
+    Timing spans of the update phases, SSH commands and transfers, saved
+    as a Chrome trace (open it in ui.perfetto.dev or chrome://tracing).
+    Spans nest per thread; step() splits the innermost traced() function
+    into consecutive phases. Disabled (no cost but a flag test) unless
+    --trace is given.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._origin = time.perf_counter()
+        self._named = set()
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def _tid(self):
+        """Trace thread of the caller: its thread, or its task when running on an event loop"""
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:
+            task = None
+        if task is not None:
+            return id(task) & 0x7fffffff, f"{threading.current_thread().name} {task.get_name()}"
+        return threading.get_ident(), threading.current_thread().name
+
+    def record(self, name, cat, start, args=None):
+        """Add a complete span that began at start (time.perf_counter()) and ends now"""
+        end = time.perf_counter()
+        tid, thread_name = self._tid()
+        event = {'name': name, 'cat': cat, 'ph': 'X', 'pid': os.getpid(), 'tid': tid,
+                 'ts': round((start - self._origin) * 1e6), 'dur': round((end - start) * 1e6),
+                 'args': args or {}}
+        with self._lock:
+            if tid not in self._named:
+                self._named.add(tid)
+                self.events.append({'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid,
+                                    'args': {'name': thread_name}})
+            self.events.append(event)
+
+    @contextlib.contextmanager
+    def span(self, name, cat='phase', **args):
+        """Context manager timing its block; yields the args dict, to add results (bytes, status) to"""
+        if not self.enabled:
+            yield args
+            return
+        stack = self._stack()
+        entry = [name, cat, time.perf_counter(), args, False]
+        stack.append(entry)
+        try:
+            yield args
+        finally:
+            self._close_step(stack)
+            stack.remove(entry)
+            self.record(name, cat, entry[2], args)
+
+    def _close_step(self, stack):
+        if stack and stack[-1][4]:
+            name, cat, start, args, _ = stack.pop()
+            self.record(name, cat, start, args)
+
+    def step(self, name, **args):
+        """End the current phase of the innermost span (if any) and start the next one"""
+        if not self.enabled:
+            return
+        stack = self._stack()
+        self._close_step(stack)
+        stack.append([name, 'step', time.perf_counter(), args, True])
+
+    def note(self, **args):
+        """Add results to the innermost open span of this thread"""
+        if self.enabled and self._stack():
+            self._stack()[-1][3].update(args)
+
+    def save(self, path):
+        """Write the trace file"""
+        with self._lock:
+            events = list(self.events)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+TRACE = Tracer()
+
+def traced(name):
+    """Decorator recording each call of the function as a span, with its result"""
+    def wrap(func):
+        @functools.wraps(func)
+        def call(*args, **kwargs):
+            with TRACE.span(name) as span:
+                result = func(*args, **kwargs)
+                span['result'] = result if isinstance(result, (bool, int, str, type(None))) else type(result).__name__
+                return result
+        return call
+    return wrap
+
+def trace_command(command):
+    """Shorten a remote command for a span name"""
+    command = ' '.join(command.split())
+    return command if len(command) <= 60 else command[:57] + '...'
 
 
 # --- NETWORK UTILITY FUNCTIONS ---
-def ping_router(host, timeout=PING_TIMEOUT):
-    """Check if FRITZ!Box responds to ping"""
-    return os.system(f"ping -c 1 -W {timeout} {host} > /dev/null 2>&1") == 0
+def tcp_probe(host, port, timeout=PROBE_TIMEOUT, banner=False):
+    """
+    Try a TCP connection to host:port with a non-blocking socket. Returns
+    None if the port does not accept it, otherwise '' or, with banner, the
+    first line sent by the server within timeout (e.g. 'SSH-2.0-dropbear').
+    """
+    try:
+        family, kind, proto, _, address = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)[0]
+        sock = socket.socket(family, kind, proto)
+    except OSError:
+        return None
+    deadline = time.monotonic() + timeout
+    try:
+        sock.setblocking(False)
+        if sock.connect_ex(address) not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            return None
+        _, writable, _ = select.select([], [sock], [], timeout)
+        if not writable or sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+            return None
+        data = b''
+        while banner and b'\n' not in data and len(data) < 256:
+            left = deadline - time.monotonic()
+            if left <= 0 or not select.select([sock], [], [], left)[0]:
+                break
+            chunk = sock.recv(256)
+            if not chunk:
+                break
+            data += chunk
+        return data.split(b'\n')[0].strip().decode(errors='replace')
+    except OSError:
+        return None
+    finally:
+        sock.close()
 
-def wait_router_boot(host, password, user=DEFAULT_USER, max_tries=BOOT_WAIT_MAX_TRIES, debug=False):
-    """Wait for FRITZ!Box to boot and become accessible via SSH"""
+def probe_interval(elapsed, expected=BOOT_EXPECTED):
+    """Seconds to the next probe: sparse far from the expected boot time, sub-second close to it"""
+    return min(PROBE_INTERVAL_MAX, max(PROBE_INTERVAL_MIN, abs(expected - elapsed) / 10))
+
+def wait_port(host, port, deadline, banner_prefix=None, expected=BOOT_EXPECTED):
+    """
+    Poll host:port until it accepts connections (and, with banner_prefix,
+    greets with it) or deadline (time.monotonic()) passes. Returns the
+    banner ('' without banner_prefix), None on timeout.
+    """
+    start = time.monotonic()
+    while True:
+        probe_start = time.monotonic()
+        banner = tcp_probe(host, port, banner=banner_prefix is not None)
+        if banner is not None and (banner_prefix is None or banner.startswith(banner_prefix)):
+            return banner
+        now = time.monotonic()
+        if now >= deadline:
+            return None
+        cprint('.', end='')
+        pause = probe_interval(now - start, expected) - (now - probe_start)
+        if pause > 0:
+            time.sleep(min(pause, deadline - now))
+
+@traced('boot wait')
+def wait_router_boot(host, password, user=DEFAULT_USER, timeout=BOOT_WAIT_TIMEOUT, debug=False, web_port=None):
+    """
+    Wait for FRITZ!Box to reboot and become accessible via SSH: watch the
+    SSH port go down, then probe it until the SSH server greets, and only
+    then log in. With web_port, also wait for the Freetz web interface.
+    """
     cinfo(f"Waiting for FRITZ!Box {host} to boot...")
-    time.sleep(25)  # time for the device to shutdown
-    start_time = time.time()
-    
-    # Phase 1: Wait for ping response
-    cprint("Phase 1: Waiting for network connectivity...", 'blue', 'ping')
-    for i in range(max_tries):
-        if ping_router(host):
+    start_time = time.monotonic()
+    deadline = start_time + timeout
+
+    # Phase 1: Wait for the shutdown (the SSH port stops answering)
+    cprint("Phase 1: Waiting for the FRITZ!Box to shut down...", 'blue', 'reboot')
+    TRACE.step('shutdown')
+    while tcp_probe(host, SSH_PORT) is not None:
+        if time.monotonic() - start_time > SHUTDOWN_TIMEOUT:
             cprint("")
-            cprint(f"{EMOJI['ok']} FRITZ!Box is pingable!", 'green')
+            cwarning(f"FRITZ!Box still answers on port {SSH_PORT} after {SHUTDOWN_TIMEOUT}s, "
+                     "assuming it already rebooted")
             break
-        print('.', end='', flush=True)
-        time.sleep(2)
+        cprint('.', end='')
+        time.sleep(PROBE_INTERVAL_MIN)
     else:
         cprint("")
-        cerror(f"Timeout waiting for FRITZ!Box to respond to ping ({max_tries * 2}s)")
+        cprint(f"{EMOJI['ok']} FRITZ!Box is down (after {time.monotonic() - start_time:.1f}s)", 'green')
+    down_time = time.monotonic()
+
+    # Phase 2: Wait for the SSH server banner
+    cprint("Phase 2: Waiting for SSH service...", 'blue', 'ping')
+    TRACE.step('boot')
+    banner = wait_port(host, SSH_PORT, deadline, banner_prefix='SSH-')
+    cprint("")
+    if banner is None:
+        cerror(f"Timeout waiting for SSH service to start ({timeout}s)")
         return False
-    
-    # Phase 2: Wait for SSH availability
-    cprint("Phase 2: Waiting for SSH service...", 'blue', 'wait')
-    time.sleep(5)  # Give SSH daemon time to start
-    for i in range(max_tries):
-        try:
-            result = ssh_run(host, user, password, SSH_TEST_CMD, debug=debug, capture_output=True)
-            if result and not 'connection refused' in result.lower():
-                elapsed = int(time.time() - start_time)
-                cprint("")
-                cprint(f"{EMOJI['ok']} FRITZ!Box is fully operational! (took {elapsed}s)", 'green')
-                return True
-        except:
-            pass
-        print('.', end='', flush=True)
-        time.sleep(2)
+    cprint(f"{EMOJI['ok']} SSH service is up: {banner} (boot took {time.monotonic() - down_time:.1f}s)", 'green')
 
-    cerror("Timeout waiting for SSH service to start")
-    return False
+    # The server greets: log in (retried while the box finishes booting)
+    TRACE.step('ssh login', banner=banner)
+    while True:
+        result = ssh_run(host, user, password, SSH_TEST_CMD, debug=debug, capture_output=True)
+        if last_exit_status() == 0 and result:
+            break
+        if time.monotonic() >= deadline:
+            cerror("Timeout waiting for SSH login")
+            return False
+        cdebug(f"SSH login not possible yet: {result.strip()}", debug)
+        time.sleep(1)
+
+    # Phase 3: Freetz web interface (optional)
+    if web_port:
+        cprint(f"Phase 3: Waiting for the web interface on port {web_port}...", 'blue', 'wait')
+        TRACE.step('web interface', port=web_port)
+        up = wait_port(host, web_port, min(deadline, time.monotonic() + WEB_WAIT_TIMEOUT), expected=0)
+        cprint("")
+        if up is None:
+            cwarning(f"Web interface on port {web_port} is not answering, continuing anyway")
+
+    cprint(f"{EMOJI['ok']} FRITZ!Box is fully operational! (took {int(time.monotonic() - start_time)}s)", 'green')
+    return True
 
-def count_tar_files(tarfile):
+def count_tar_files(archive):
     """Count total files in tar archive"""
     try:
-        output = subprocess.getoutput(f"tar -tf '{tarfile}' 2>/dev/null")
-        return len([l for l in output.splitlines() if l.strip() and not l.endswith('/')])  # only count files
-    except:
+        return ArchiveIndex.load(archive).files
+    except Exception:
         return 0
 
+# --- ARCHIVE INDEX ---
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+                         'freetz-ng', 'ssh_firmware_update')
+
+# TI checksum trailer of kernel.image/filesystem.image (make/host-tools/tichksum-host):
+# LE32 magic + LE32 POSIX cksum of the payload. zlib only has the reflected CRC-32,
+# so it is fed bit-reversed bytes and the register is reversed back at the end.
+TI_CHECKSUM_MAGIC = 0xC453DE23
+BIT_REVERSED = bytes(int(f"{i:08b}"[::-1], 2) for i in range(256))
+INSTALL_CHECKSUM_ERRORS = {'kernel': 'INSTALL_KERNEL_CHECKSUM', 'filesystem': 'INSTALL_FILESYSTEM_CHECKSUM',
+                           'urlader': 'INSTALL_URLADER_CHECKSUM'}
+
+def ti_checksum(f, size):
+    """
+    Stream size bytes of f and check the TI checksum trailer:
+    returns 'ok', 'bad' or 'none' (no trailer)
+    """
+    crc, remaining = 0xFFFFFFFF, max(0, size - 8)
+    while remaining:
+        chunk = f.read(min(remaining, 1024 * 1024))
+        if not chunk:
+            raise EOFError("unexpected end of data")
+        crc = zlib.crc32(chunk.translate(BIT_REVERSED), crc)
+        remaining -= len(chunk)
+    trailer = f.read(min(size, 8))
+    if len(trailer) != min(size, 8):
+        raise EOFError("unexpected end of data")
+    if len(trailer) < 8 or int.from_bytes(trailer[:4], 'little') != TI_CHECKSUM_MAGIC:
+        return 'none'
+    length = size - 8
+    crc = zlib.crc32(length.to_bytes((length.bit_length() + 7) // 8, 'little').translate(BIT_REVERSED), crc)
+    cksum = ~int(f"{~crc & 0xFFFFFFFF:032b}"[::-1], 2) & 0xFFFFFFFF
+    return 'ok' if cksum == int.from_bytes(trailer[4:], 'little') else 'bad'
+
+class ArchiveIndex:
+    """
+    Index of a local .image/.external tar archive built in one streaming pass:
+    member count, total unpacked size, ./var/content, ./var/.packages and
+    the offset of every member. Indexes are cached in CACHE_DIR, keyed by
+    path, size and mtime, so an unchanged archive is never read again.
+    """
+    VERSION = 4
+    METADATA = {'var/content': 'content', 'var/.packages': 'packages'}
+    # Firmware payload of each layout: kernel.image + filesystem.image, FIT image (FWLAYOUT_5), UIMG (FWLAYOUT_4)
+    PAYLOADS = ('var/tmp/kernel.image', 'var/tmp/fit-image', 'var/firmware-update.uimg')
+    FIELDS = ('files', 'unpacked_size', 'content', 'packages', 'members', 'digests', 'preflight')
+
+    def __init__(self, path):
+        self.path = path
+        self.files = 0  # members that are not directories
+        self.unpacked_size = 0
+        self.content = None
+        self.packages = None
+        self.members = []  # [name, header offset, data offset, size, type]
+        self.digests = None  # member name -> md5 of regular files / 'l:target' of symlinks, see file_digests()
+        self.preflight = None  # firmware image check, see verify()
+
+    @staticmethod
+    def cache_key(path):
+        st = os.stat(path)
+        return f"{os.path.realpath(path)}|{st.st_size}|{st.st_mtime_ns}"
+
+    @staticmethod
+    def cache_file(path):
+        digest = hashlib.sha1(os.path.realpath(path).encode()).hexdigest()
+        return os.path.join(CACHE_DIR, f"archive-{digest}.json")
+
+    @classmethod
+    def load(cls, path, debug=False):
+        """Return the index of path, from the cache if the archive did not change"""
+        key = cls.cache_key(path)
+        cache_file = cls.cache_file(path)
+        try:
+            with open(cache_file, encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('version') == cls.VERSION and data.get('key') == key:
+                index = cls(path)
+                for attr in cls.FIELDS:
+                    setattr(index, attr, data[attr])
+                cdebug(f"Archive index of {path} read from {cache_file}", debug)
+                return index
+        except (OSError, ValueError, KeyError):
+            pass
+        index = cls(path)
+        index.scan()
+        cdebug(f"Archive {path} indexed: {index.files} files, {format_size(index.unpacked_size)}", debug)
+        index.save(key, debug)
+        return index
+
+    def save(self, key=None, debug=False):
+        """Write the index to the cache"""
+        cache_file = self.cache_file(self.path)
+        try:
+            data = {'version': self.VERSION, 'key': key or self.cache_key(self.path)}
+            data.update((attr, getattr(self, attr)) for attr in self.FIELDS)
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            tmp = f"{cache_file}.{os.getpid()}-{threading.get_ident()}.tmp"
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(data, f)
+            os.replace(tmp, cache_file)
+        except OSError as e:
+            cdebug(f"Could not write archive index cache: {e}", debug)
+
+    def scan(self):
+        """Read the archive once: for a plain tar only the headers are read, data is skipped"""
+        with tarfile.open(self.path, 'r:*') as tar:
+            for member in tar:
+                self.members.append([member.name, member.offset, member.offset_data, member.size,
+                                     member.type.decode(errors='replace')])
+                if member.isdir():
+                    continue
+                self.files += 1
+                self.unpacked_size += member.size
+                attr = self.METADATA.get(member.name[2:] if member.name.startswith('./') else member.name)
+                if attr and member.isfile():
+                    setattr(self, attr, tar.extractfile(member).read().decode(errors='replace'))
+
+    def file_digests(self, debug=False):
+        """
+        Return {member name: md5} of the regular files and {member name: 'l:target'}
+        of the symlinks, hashing the archive data once (then cached)
+        """
+        if self.digests is None:
+            digests = {}
+            with tarfile.open(self.path, 'r:*') as tar:
+                for member in tar:
+                    if member.issym():
+                        digests[member.name] = f"l:{member.linkname}"
+                    elif member.islnk():
+                        digests[member.name] = digests.get(member.linkname)
+                    elif member.isfile():
+                        md5 = hashlib.md5()
+                        f = tar.extractfile(member)
+                        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                            md5.update(chunk)
+                        digests[member.name] = md5.hexdigest()
+            self.digests = digests
+            self.save(debug=debug)
+        return self.digests
+
+    def verify(self, debug=False):
+        """
+        Pre-flight check of a firmware image, reading the archive once (then cached):
+        ./var/install must be there and every *.image member must match its TI
+        checksum trailer, if it has one (an empty filesystem.image, as in hidden
+        root firmware, has none). The firmware itself is ./var/tmp/kernel.image,
+        ./var/tmp/fit-image or ./var/firmware-update.uimg depending on the box
+        layout; an image with none of them only gets a warning.
+        Returns {'errors': [messages], 'warnings': [messages],
+        'images': {member name: [size, 'ok'|'bad'|'none']}}
+        """
+        if self.preflight is None:
+            errors, warnings, images, install = [], [], {}, False
+            try:
+                with tarfile.open(self.path, 'r:*') as tar:
+                    for member in tar:
+                        name = member.name[2:] if member.name.startswith('./') else member.name
+                        if name == 'var/install':
+                            install = member.isfile() and member.size > 0
+                        elif member.isfile() and (name.endswith('.image') or name in self.PAYLOADS):
+                            images[name] = [member.size, ti_checksum(tar.extractfile(member), member.size)]
+            except (tarfile.TarError, EOFError) as e:
+                errors.append(f"Archive is truncated or corrupt: {e}")
+            if not install:
+                errors.append("./var/install is missing or empty")
+            if not any(name in self.PAYLOADS or os.path.basename(name) == 'kernel.image' for name in images):
+                warnings.append(f"No firmware payload found ({', '.join('./' + name for name in self.PAYLOADS)})")
+            for name, (size, checksum) in sorted(images.items()):
+                kind = os.path.basename(name).split('.')[0]
+                if checksum == 'bad':
+                    errors.append(f"./{name}: checksum mismatch (the box would report "
+                                  f"{INSTALL_CHECKSUM_ERRORS.get(kind, 'INSTALL_OTHER_ERROR')})")
+                elif size == 0 and kind != 'filesystem':
+                    warnings.append(f"./{name} is empty")
+            cdebug(f"Pre-flight check of {self.path}: {len(images)} images, {len(errors)} errors", debug)
+            self.preflight = {'errors': errors, 'warnings': warnings, 'images': images}
+            self.save(debug=debug)
+        return self.preflight
+
 def get_password(args):
     """
     Get password from multiple sources (priority order):
@@ -198,7 +848,7 @@ def get_password(args):
     
     # Interactive password prompt
     try:
-        password = getpass.getpass(f"{EMOJI['prompt']} Enter SSH password for {args.user}@{args.host}: ")
+        password = getpass.getpass(f"{EMOJI['prompt']} Enter SSH password for {args.user}@{args.host or 'the inventory hosts'}: ")
         if not password:
             cerror("Password cannot be empty!")
             sys.exit(1)
@@ -208,13 +858,128 @@ def get_password(args):
         sys.exit(130)
 
 # --- FILE SELECTION FUNCTIONS ---
-def find_images():
-    """Find all .image and .external files in images/ directory"""
-    images = sorted(glob('images/*.image'), key=os.path.getmtime, reverse=True)
-    externals = sorted(glob('images/*.external'), key=os.path.getmtime, reverse=True)
-    return images, externals
+def parse_fw_content(text):
+    """Parse ./var/content of a firmware image (Key=Value lines)"""
+    content = {}
+    for line in (text or '').splitlines():
+        line = line.strip()
+        if '=' in line:
+            key, value = line.split('=', 1)
+            content[key.strip()] = value.strip()
+    return content
+
+class ImageCatalogue:
+    """
+    Persistent catalogue of the .image/.external files of a directory with
+    size, mtime, product, version and package list of each one.
+
+    The directory is listed on every refresh (one stat per file), but only
+    new archives and archives whose size or mtime_ns changed, e.g. rebuilt
+    under the same name, are indexed again (see ArchiveIndex), so selecting
+    a file does not untar every artifact.
+    """
+    VERSION = 2
+    SUFFIXES = ('.image', '.external')
+
+    def __init__(self, directory='images'):
+        self.directory = directory
+        self.entries = {}  # file name -> {size, mtime, mtime_ns, product, version, packages}
+        digest = hashlib.sha1(os.path.realpath(directory).encode()).hexdigest()
+        self.cache_file = os.path.join(CACHE_DIR, f"catalogue-{digest}.json")
+
+    def refresh(self, debug=False):
+        """Bring the catalogue up to date with the directory; return self"""
+        try:
+            with open(self.cache_file, encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('version') == self.VERSION:
+                self.entries = data['entries']
+        except (OSError, ValueError, KeyError):
+            pass
+        entries = {}
+        try:
+            it = os.scandir(self.directory)
+        except OSError:
+            self.entries = {}
+            return self
+        with it:
+            for entry in it:
+                if not entry.name.endswith(self.SUFFIXES):
+                    continue
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue  # e.g. dangling symlink
+                old = self.entries.get(entry.name)
+                if old and old['size'] == st.st_size and old['mtime_ns'] == st.st_mtime_ns:
+                    entries[entry.name] = old
+                    continue
+                info = {'size': st.st_size, 'mtime': st.st_mtime, 'mtime_ns': st.st_mtime_ns,
+                        'product': None, 'version': None, 'packages': []}
+                if entry.name.endswith('.image'):
+                    try:
+                        index = ArchiveIndex.load(entry.path, debug)
+                        content = parse_fw_content(index.content)
+                        info['product'] = content.get('Product')
+                        info['version'] = content.get('Version')
+                        info['packages'] = (index.packages or '').split()
+                    except Exception as e:
+                        cdebug(f"Cannot index {entry.path}: {e}", debug)
+                entries[entry.name] = info
+        if entries == self.entries:
+            cdebug(f"Catalogue of {self.directory}/ is up to date ({len(entries)} files)", debug)
+            return self
+        cdebug(f"Catalogue of {self.directory}/ refreshed: {len(entries)} files, "
+               f"{sum(1 for name in entries if entries[name] is not self.entries.get(name))} new or changed", debug)
+        self.entries = entries
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            tmp = f"{self.cache_file}.{os.getpid()}-{threading.get_ident()}.tmp"
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump({'version': self.VERSION, 'entries': entries}, f)
+            os.replace(tmp, self.cache_file)
+        except OSError as e:
+            cdebug(f"Could not write images catalogue: {e}", debug)
+        return self
+
+    def info(self, path):
+        """Return the catalogue entry of path, or None"""
+        if os.path.dirname(os.path.normpath(path)) != os.path.normpath(self.directory):
+            return None
+        return self.entries.get(os.path.basename(path))
+
+    def product(self, name):
+        """Product of an image; externals take it from the image with the same base name"""
+        base, ext = os.path.splitext(name)
+        entry = self.entries.get(name) if ext == '.image' else self.entries.get(base + '.image')
+        return entry.get('product') if entry else None
 
-def select_file_interactive(files, file_type):
+    def files(self, suffix, product_id=None):
+        """Paths with the given suffix, newest first, optionally only those built for product_id"""
+        names = [n for n in self.entries if n.endswith(suffix)]
+        if product_id and product_id != 'Unknown':
+            names = [n for n in names if not self.product(n) or product_id in self.product(n)]
+        names.sort(key=lambda n: self.entries[n]['mtime'], reverse=True)
+        return [os.path.join(self.directory, n) for n in names]
+
+def find_images(product_id=None, catalogue=None, debug=False):
+    """
+    Find all .image and .external files in images/ directory, newest first.
+    With product_id, files built for another box type are left out (unless
+    this would leave nothing to choose from).
+    """
+    if catalogue is None:
+        catalogue = ImageCatalogue('images').refresh(debug)
+    result = []
+    for suffix in ('.image', '.external'):
+        files = catalogue.files(suffix, product_id)
+        if product_id and not files and catalogue.files(suffix):
+            cwarning(f"No {suffix} file built for {product_id} found in images/, showing all")
+            files = catalogue.files(suffix)
+        result.append(files)
+    return tuple(result)
+
+def select_file_interactive(files, file_type, catalogue=None):
     """Interactive file selection from list"""
     if not files:
         cwarning(f"No {file_type} files found in images/ directory")
@@ -232,9 +997,11 @@ def select_file_interactive(files, file_type):
     
     cinfo(f"Available {file_type} files:")
     for i, f in enumerate(files[:5], 1):  # Show max 5 recent files
-        size = format_size(get_file_size(f))
-        mtime = datetime.fromtimestamp(os.path.getmtime(f)).strftime('%Y-%m-%d %H:%M')
-        cprint(f"  {i}. {os.path.basename(f)} ({size}, {mtime})", 'cyan')
+        info = catalogue.info(f) if catalogue else None
+        size = format_size(info['size'] if info else get_file_size(f))
+        mtime = datetime.fromtimestamp(info['mtime'] if info else os.path.getmtime(f)).strftime('%Y-%m-%d %H:%M')
+        version = f", {info['version']}" if info and info.get('version') else ''
+        cprint(f"  {i}. {os.path.basename(f)} ({size}, {mtime}{version})", 'cyan')
     
     cprint("")
     cprint(f"Latest {file_type}: {os.path.basename(files[0])}", 'green', 'check')
@@ -255,10 +1022,248 @@ def select_file_interactive(files, file_type):
 
 
 # --- SSH/SCP WRAPPER ---
-def sshpass_exec(cmd, password, verbose=False, retries=2, capture_output=False, silent=False, stdin_stream=None):
+PTY_READ_SIZE = 65536
+PTY_WRITE_SIZE = 4096
+PIPE_READ_SIZE = 1024 * 1024
+STDIN_PIPE_SIZE = 1024 * 1024
+STREAM_DRAIN_TIMEOUT = 120  # seconds of silence tolerated after end of input
+UPLOAD_RETRIES = 3  # resumes of an interrupted upload
+CHILD_EXIT_TIMEOUT = 5  # seconds a command that closed its terminal gets to exit before it is hung up
+_transport = threading.local()  # per-thread transport state (exit status of the last command, unattended flag)
+
+def unattended():
+    """True in threads that must not use the terminal (see run_fleet())"""
+    return getattr(_transport, 'unattended', False)
+
+def last_exit_status():
+    """Exit status of the last command run by sshpass_exec() in this thread (None if unknown)"""
+    return getattr(_transport, 'exit_status', None)
+
+def pty_send_eof(master):
+    """
+    Signal end of input through a PTY whose slave is in raw mode.
+
+    A raw terminal has no EOF character, so canonical mode is switched back
+    on (pending input is pushed to the reader as a complete line) and VEOF
+    is written: the child's next read() returns 0 and ssh half-closes the
+    channel, exactly as for a pipe.
+    """
+    try:
+        attrs = termios.tcgetattr(master)
+        attrs[3] |= termios.ICANON
+        termios.tcsetattr(master, termios.TCSANOW, attrs)
+        veof = attrs[6][termios.VEOF]
+        os.write(master, veof if isinstance(veof, bytes) else bytes([veof]))
+    except (termios.error, OSError):
+        pass
+# name -> (literal anchors, confirming regex or None), all lowercase. The
+# regex only runs when an anchor is present, which keeps scanning cheap.
+SSH_PROMPT_PATTERNS = {
+    'password': ((b'password', b'root@'), re.compile(rb"password[^\n]{0,64}:|root@")),
+    'hostkey': ((b'are you sure you want to continue connecting', b'(yes/no)?'), None),
+    'authfail': ((b'permission denied', b'authentication failed', b'authentication error',
+                  b'login incorrect', b'access denied'), None),
+}
+SCP_PROGRESS_ANCHORS = (b'eta', b'kb/s', b'mb/s')
+
+def match_pattern(name, lowered, start=0):
+    """Check whether SSH_PROMPT_PATTERNS[name] matches lowered data ending after offset start"""
+    anchors, rx = SSH_PROMPT_PATTERNS[name]
+    if rx is None:
+        return any(lowered.find(a, max(0, start - len(a) + 1)) != -1 for a in anchors)
+    if not any(a in lowered for a in anchors):
+        return False
+    return any(m.end() > start for m in rx.finditer(lowered))
+
+class StreamMatcher:
+    """
+    Incrementally search a byte stream for SSH_PROMPT_PATTERNS (case insensitive).
+
+    Only a short tail of the previous chunks is kept, so matches split
+    across chunk boundaries are found while each byte is scanned a bounded
+    number of times. A match is reported once, in the chunk where it ends.
+    """
+    def __init__(self, names=tuple(SSH_PROMPT_PATTERNS), window=256):
+        self.names = names
+        self.window = window
+        self._tail = b''
+
+    def feed(self, data):
+        """Return the set of pattern names matching up to the end of data"""
+        buf = self._tail + data.lower()
+        offset = len(self._tail)
+        found = {name for name in self.names if match_pattern(name, buf, offset)}
+        self._tail = buf[-self.window:]
+        return found
+
+    def reset(self):
+        """Forget the buffered tail (e.g. after answering a prompt)"""
+        self._tail = b''
+
+class OutputCapture:
+    """
+    Accumulate command output in linear time and memory.
+
+    Until stop_filtering() is called, output is processed line by line and
+    lines containing password prompts are dropped together with the blank
+    lines that follow them; an incomplete trailing line is held back until
+    its end is known. Leading whitespace of the whole output is skipped.
+    """
+    def __init__(self, strip_scp_progress=False, filter_prompts=True):
+        self.strip_scp_progress = strip_scp_progress
+        self.filter_prompts = filter_prompts
+        self._chunks = []
+        self._pending = bytearray()
+        self._skip_blank = False
+        self._started = False
+
+    def _keep_line(self, line):
+        """Return False for lines that must not appear in the output"""
+        lowered = line.lower()
+        if self.filter_prompts:
+            if match_pattern('password', lowered):
+                self._skip_blank = True
+                return False
+            if self._skip_blank and not line.strip():
+                return False
+            self._skip_blank = False
+        if self.strip_scp_progress and b'%' in line and any(a in lowered for a in SCP_PROGRESS_ANCHORS):
+            return False
+        return True
+
+    def _append(self, data):
+        if not self._started:
+            data = data.lstrip(b'\n\r \t')
+            if not data:
+                return b''
+            self._started = True
+        self._chunks.append(data)
+        return data
+
+    def feed(self, data):
+        """Add a received chunk; return the part that can be shown right away"""
+        if not (self.filter_prompts or self.strip_scp_progress):
+            return self._append(data)
+        self._pending += data
+        cut = self._pending.rfind(b'\n') + 1
+        if not cut:
+            return b''
+        block = bytes(self._pending[:cut])
+        del self._pending[:cut]
+        # Fast path: nothing to drop in the whole block
+        lowered = block.lower()
+        if not self._skip_blank and not (self.filter_prompts and match_pattern('password', lowered)) \
+                and not (self.strip_scp_progress and b'%' in block):
+            return self._append(block)
+        return self._append(b''.join(l for l in block.splitlines(keepends=True) if self._keep_line(l)))
+
+    def stop_filtering(self):
+        """Stop prompt filtering (authenticated); return the released pending output"""
+        flushed = self.close()
+        self.filter_prompts = False
+        return flushed
+
+    def close(self):
+        """Flush the held back incomplete line; return the part that can be shown"""
+        pending, self._pending = bytes(self._pending), bytearray()
+        if pending and self._keep_line(pending):
+            return self._append(pending)
+        return b''
+
+    def getvalue(self):
+        """Return the whole captured output"""
+        return b''.join(self._chunks)
+
+async def wait_fds(readers, writers=(), timeout=None):
+    """
+    Awaitable select(): wait until one of the fds is ready or timeout
+    seconds passed; return the (readable, writable) sets. Fds that cannot
+    be polled (regular files, /dev/null) count as ready, as with select().
+    """
+    loop = asyncio.get_running_loop()
+    readable, writable = set(), set()
+    ready = loop.create_future()
+
+    def mark(found, fd):
+        found.add(fd)
+        if not ready.done():
+            ready.set_result(None)
+
+    watched = []
+    for fds, add, found in ((readers, loop.add_reader, readable), (writers, loop.add_writer, writable)):
+        for fd in fds:
+            try:
+                add(fd, mark, found, fd)
+                watched.append((fds is readers, fd))
+            except (OSError, ValueError):
+                mark(found, fd)
+    timer = loop.call_later(timeout, mark, set(), None) if timeout is not None else None
+    try:
+        await ready
+    finally:
+        if timer:
+            timer.cancel()
+        for is_reader, fd in watched:
+            (loop.remove_reader if is_reader else loop.remove_writer)(fd)
+    return readable, writable
+
+async def wait_child(pid):
+    """Reap a child process without blocking the event loop; return its wait status (None if unknown)"""
+    delay = 0.001
+    while True:
+        try:
+            done, status = os.waitpid(pid, os.WNOHANG)
+        except ChildProcessError:
+            return None
+        if done:
+            return status
+        await asyncio.sleep(delay)
+        delay = min(0.05, delay * 2)
+
+def set_pipe_size(fd, size=STDIN_PIPE_SIZE):
+    """Enlarge the kernel buffer of a pipe (Linux), so data moves in large blocks"""
+    try:
+        fcntl.fcntl(fd, getattr(fcntl, 'F_SETPIPE_SZ', 1031), size)
+    except OSError:
+        pass
+
+def feed_pipe(stream, fd, pending):
+    """
+    Push the next part of stream into the non-blocking pipe fd, with
+    os.sendfile() when the stream allows it (see ProgressReader.sendfile()).
+    pending is data read from stream but not written yet.
+    Returns (pending, eof); eof also when the reader closed the pipe.
+    """
+    if not pending and getattr(stream, 'zero_copy', False):
+        try:
+            return b'', not stream.sendfile(fd, STDIN_PIPE_SIZE)
+        except BlockingIOError:
+            return b'', False
+        except BrokenPipeError:
+            return b'', True
+        except OSError:
+            stream.zero_copy = False  # no sendfile() for this file: read() it from now on
+    if not pending:
+        try:
+            pending = stream.read(STDIN_PIPE_SIZE)
+        except Exception:
+            pending = b''
+        if not pending:
+            return b'', True
+    try:
+        pending = pending[os.write(fd, pending):]
+    except BlockingIOError:
+        pass
+    except BrokenPipeError:
+        return b'', True  # the remote command stopped reading
+    return pending, False
+
+async def pty_exec_async(cmd, password, verbose=False, retries=2, capture_output=False, silent=False,
+                         stdin_stream=None, authenticated=False, drain_timeout=None, forward_stdin=False):
     """
     Execute SSH/SCP command with automatic password authentication.
-    Uses PTY to interact with SSH password prompts.
+    Uses PTY to interact with SSH password prompts; driven by the running
+    asyncio event loop, so any number of commands can run concurrently.
     
     Args:
         cmd: List of command arguments (e.g., ['ssh', 'root@host', 'ls'])
@@ -267,15 +1272,34 @@ def sshpass_exec(cmd, password, verbose=False, retries=2, capture_output=False,
         retries: Number of password retry attempts
         capture_output: Return output as string instead of printing
         silent: Suppress all output (for SCP uploads)
-    
+        stdin_stream: File-like object (read() only) streamed to the command's stdin
+        authenticated: No password prompt is expected (e.g. multiplexed session)
+        drain_timeout: Seconds without output after the end of stdin_stream before
+            giving up waiting for the remote command to exit (default: STREAM_DRAIN_TIMEOUT)
+        forward_stdin: Forward the terminal input to the command after authentication
+            (otherwise the command gets an EOF)
+
+    Completion is detected from the remote side: once stdin reaches EOF, the
+    EOF is passed on through the PTY and the loop ends when ssh exits.
+
     Returns:
-        Output string if capture_output=True, empty string otherwise
+        (output string if capture_output=True else empty string, exit status or None)
     """
+    if drain_timeout is None:
+        drain_timeout = STREAM_DRAIN_TIMEOUT
+    # A stdin_stream is fed through a pipe: ssh reads passwords from its
+    # controlling terminal (the PTY), so the data never passes the line
+    # discipline and closing the pipe is a real end of input.
+    stdin_pipe = os.pipe() if stdin_stream else None
     pid, master = pty.fork()
     if pid == 0:
-        # Child process: force PTY slave (stdin) to raw mode for binary data transfer
+        if stdin_pipe:
+            os.dup2(stdin_pipe[0], 0)
+            os.close(stdin_pipe[0])
+            os.close(stdin_pipe[1])
+        # Child process: force PTY slave to raw mode for binary data transfer
         try:
-            tty.setraw(sys.stdin.fileno())
+            tty.setraw(1, termios.TCSANOW)  # no flush: input may already be queued
         except Exception:
             cerror("Cannot set tty in raw mode")
             pass  # continue anyway
@@ -286,223 +1310,1519 @@ def sshpass_exec(cmd, password, verbose=False, retries=2, capture_output=False,
             print(f"Exec failed: {e}", file=sys.stderr)
             os._exit(127)
 
+    # Parent process: set raw mode from this side as well, so nothing written
+    # before the child got to it is echoed or interpreted by the line discipline
+    try:
+        tty.setraw(master, termios.TCSANOW)
+    except termios.error:
+        pass
+    os.set_blocking(master, False)
+
     # Parent process: handle password prompts and output
-    rolling = bytearray()
     sent_count = 0
     hostkey_answered = False
     max_retries = max(0, retries)
-    output = b''
+    events = StreamMatcher()
+    capture = OutputCapture(strip_scp_progress=os.path.basename(cmd[0]) == 'scp', filter_prompts=not authenticated)
 
-    authenticated = False
-    first_write = True
+    def emit(filtered):
+        if not capture_output and not silent and filtered:
+            PROGRESS.write(filtered, sys.stdout)
+
+    stdin_fd = sys.stdin.fileno()
+    stdin_open = forward_stdin and not stdin_pipe
+    eof_sent = stdin_open or bool(stdin_pipe)
+    pipe_fd = None
+    pending, eof = b'', False
+    if stdin_pipe:
+        os.close(stdin_pipe[0])
+        pipe_fd = stdin_pipe[1]
+        os.set_blocking(pipe_fd, False)
+        set_pipe_size(pipe_fd)
+    drain_deadline = None  # set once the end of stdin_stream has been signalled
+    status = None
+    hung_up = False  # the child closed its side of the PTY
     try:
         while True:
-            r, _, _ = select.select([master] + ([stdin_stream.fileno()] if stdin_stream else [sys.stdin.fileno()]), [], [], 0.1)
+            # The terminal input is only forwarded after authentication (never
+            # type data into a password prompt); the stdin_stream pipe right away.
+            watch = [master] + ([stdin_fd] if authenticated and stdin_open else [])
+            r, w = await wait_fds(watch, [pipe_fd] if pipe_fd is not None else [], 0.5)
+            if drain_deadline is not None and time.monotonic() > drain_deadline:
+                if verbose:
+                    sys.stderr.write(f"[debug] No completion within {drain_timeout}s after end of input, closing\n")
+                    sys.stderr.flush()
+                break
             # Handle command output
             if master in r:  # Here is the data received from the remote command
                 try:
-                    data = os.read(master, 4096)
+                    data = os.read(master, PTY_READ_SIZE)
+                except BlockingIOError:
+                    data = None
                 except OSError as e:
                     if e.errno == errno.EIO:
+                        hung_up = True
                         break
                     raise
-                if not data:
+                if data == b'':
+                    hung_up = True
                     break
-                filtered = data
-                # For SCP, also filter progress lines (lines starting with filename and containing %)
-                if b'scp' in cmd[0].encode():
-                    lines = data.split(b'\n')
-                    filtered_lines = []
-                    for line in lines:
-                        if b'%' in line and (b'ETA' in line or b'KB/s' in line or b'MB/s' in line):
-                            continue
-                        filtered_lines.append(line)
-                    filtered = b'\n'.join(filtered_lines)
+            else:
+                data = None
+            if data:
+                if drain_deadline is not None:
+                    drain_deadline = time.monotonic() + drain_timeout
+                if verbose:
+                    preview = data[:32].hex(' ') + (' ...' if len(data) > 32 else '')
+                    sys.stderr.write(f"[recv {len(data)} bytes] {preview}\n")
+                    sys.stderr.flush()
+                # Prompts only show up before authentication: skip the scan afterwards
+                found = events.feed(data) if not authenticated else ()
                 # Intercept password only if not yet authenticated
                 if not authenticated:
-                    for p in [b'password:', b"'s password:", b'root password:', b'root@']:
-                        idx = filtered.lower().find(p)
-                        while idx != -1:
-                            end = filtered.find(b'\n', idx)
-                            start = filtered.rfind(b'\n', 0, idx)
-                            next_nl = end
-                            while next_nl != -1 and next_nl+1 < len(filtered) and filtered[next_nl+1:next_nl+2] == b'\n':
-                                next_nl += 1
-                            if start != -1 and end != -1:
-                                filtered = filtered[:start] + filtered[(next_nl+1) if next_nl != -1 else (end+1):]
-                            elif end != -1:
-                                filtered = filtered[:idx] + filtered[(next_nl+1) if next_nl != -1 else (end+1):]
-                            elif start != -1:
-                                filtered = filtered[:start]
-                            else:
-                                filtered = filtered[:idx]
-                            idx = filtered.lower().find(p)
                     # Detect and respond to password prompts
-                    if sent_count <= max_retries:
-                        prompts = [b'password:', b"'s password:", b'root password:', b'root@']
-                        for p in prompts:
-                            if p in data.lower():
-                                os.write(master, password.encode() + b"\n")
-                                sent_count += 1
-                                if verbose:
-                                    sys.stderr.write(f"[debug] Sent password (attempt {sent_count}) for prompt {p.decode(errors='ignore')}\n")
-                                    sys.stderr.flush()
-                                rolling = bytearray()
-                                break
-                        else:
-                            idx = data.lower().find(b'password')
-                            if idx != -1:
-                                window = data.lower()[idx: idx + 64]
-                                if b':' in window:
-                                    os.write(master, password.encode() + b"\n")
-                                    sent_count += 1
-                                    if verbose:
-                                        sys.stderr.write(f"[debug] Sent password (attempt {sent_count})\n")
-                                        sys.stderr.flush()
-                                    rolling = bytearray()
-                                    continue
+                    if 'password' in found and sent_count <= max_retries:
+                        os.write(master, password.encode() + b"\n")
+                        sent_count += 1
+                        if verbose:
+                            sys.stderr.write(f"[debug] Sent password (attempt {sent_count})\n")
+                            sys.stderr.flush()
+                        events.reset()
                     # Detect authentication failures
-                    fails = [b'permission denied', b'authentication failed', b'authentication error', b'login incorrect', b'access denied']
-                    if any(p in data.lower() for p in fails):
+                    if 'authfail' in found:
                         if verbose:
                             sys.stderr.write("[debug] Detected authentication failure, aborting\n")
                             sys.stderr.flush()
-                        time.sleep(0.05)
                         break
                     # No password prompt and no error: autheticated
-                    if sent_count > 0 and not any(p in data.lower() for p in prompts + fails):
+                    if sent_count > 0 and not found:
                         authenticated = True
-                        time.sleep(1)
-                # Remove leading whitespace/newlines
-                while filtered and filtered[:1] in (b'\n', b'\r', b' ', b'\t'):
-                    filtered = filtered[1:]
-                output += filtered
-                if not capture_output and not silent and filtered:
-                    os.write(sys.stdout.fileno(), filtered)
-                if verbose:
-                    sys.stderr.write("[recv hex] " + ' '.join(f'{x:02x}' for x in data) + "\n")
-                    sys.stderr.flush()
-                rolling += data
-                if len(rolling) > 4096:
-                    rolling = rolling[-4096:]
-                low = rolling.lower()
-                if (not hostkey_answered) and b"are you sure you want to continue connecting" in low:
-                    os.write(master, b"yes\n")
-                    hostkey_answered = True
-                    rolling = bytearray()
-                    continue
-                if (not hostkey_answered) and b"(yes/no)?" in low:
+                        emit(capture.feed(data))
+                        emit(capture.stop_filtering())
+                        data = None
+                if data is not None:
+                    emit(capture.feed(data))
+                if (not hostkey_answered) and 'hostkey' in found:
                     os.write(master, b"yes\n")
                     hostkey_answered = True
-                    rolling = bytearray()
+                    events.reset()
                     continue
-            # Handle stdin input (pipe data after authentication)
-            if authenticated:
-                if stdin_stream and stdin_stream.fileno() in r:  # read from INPUT (stdin_stream)
-                    try:
-                        data = stdin_stream.read(4096)
-                    except Exception:
-                        data = b''
-                    if not data:
-                        # EOF reached: close master to send EOF to slave
-                        try:
-                            while True:
-                                r, _, _ = select.select([master], [], [], 0)
-                                if not r:
-                                    # nessun dato da leggere, esco dal loop
-                                    break
-                                time.sleep(1)
-                            time.sleep(5)
-                            os.close(master)
-                        except Exception as e:
-                            cerror("Write error: {e}")
-                        break
-                    else:
-                        if first_write:
-                            first_write = False
-                        os.write(master, data)
-                elif not stdin_stream and sys.stdin.fileno() in r:  # read from INPUT (stdin)
-                    try:
-                        data = os.read(sys.stdin.fileno(), 4096)
-                    except OSError:
-                        data = b''
-                    if not data:
-                        # EOF reached: close master to send EOF to slave
-                        try:
-                            while True:
-                                r, _, _ = select.select([master], [], [], 0)
-                                if not r:
-                                    # nessun dato da leggere, esco dal loop
-                                    break
-                                time.sleep(1)
-                            time.sleep(5)
-                            os.close(master)
-                        except Exception as e:
-                            cerror("Write error: {e}")
-                        break
-                    else:
-                        os.write(master, data)
-    
-    except KeyboardInterrupt:
-        pass
+            # Feed stdin_stream into the pipe
+            if w:
+                pending, eof = feed_pipe(stdin_stream, pipe_fd, pending)
+                if eof:
+                    # End of input: half-close and let the remote side finish
+                    os.close(pipe_fd)
+                    pipe_fd = None
+                    drain_deadline = time.monotonic() + drain_timeout
+            if authenticated and not eof_sent:
+                pty_send_eof(master)
+                eof_sent = True
+            # Forward terminal input
+            if stdin_fd in r:
+                try:
+                    data = os.read(stdin_fd, PTY_WRITE_SIZE)
+                except OSError:
+                    data = b''
+                if data:
+                    os.write(master, data)
+                else:
+                    stdin_open = False
+                    pty_send_eof(master)
+
     finally:
+        if pipe_fd is not None:
+            os.close(pipe_fd)
+        # A child that closed the PTY may still be exiting: closing the master
+        # now would hang it up (SIGHUP), so give it time to finish first
+        reaped = False
+        if hung_up:
+            try:
+                status = await asyncio.wait_for(wait_child(pid), CHILD_EXIT_TIMEOUT)
+                reaped = True
+            except asyncio.TimeoutError:
+                pass
+        os.close(master)
+        if not reaped:
+            status = await wait_child(pid)
+    emit(capture.close())
+    status = os.waitstatus_to_exitcode(status) if status is not None else None
+
+    return (capture.getvalue().decode(errors='ignore') if capture_output else ''), status
+
+async def pipe_exec_async(cmd, verbose=False, capture_output=False, silent=False, stdin_stream=None,
+                          drain_timeout=None, forward_stdin=False):
+    """
+    Execute an SSH/SCP command that cannot prompt for a password (shared
+    master connection or key authentication) with plain pipes and no
+    terminal in between: output is read in large blocks without prompt
+    scanning and stdin_stream is copied with os.sendfile() when possible.
+    Same arguments and result as pty_exec_async().
+    """
+    if drain_timeout is None:
+        drain_timeout = STREAM_DRAIN_TIMEOUT
+    out_r, out_w = os.pipe()
+    in_r, in_w = os.pipe() if stdin_stream else (None, None)
+    null = None if stdin_stream or forward_stdin else os.open(os.devnull, os.O_RDONLY)
+    actions = [(os.POSIX_SPAWN_DUP2, out_w, 1), (os.POSIX_SPAWN_DUP2, out_w, 2)]
+    if in_r is not None or null is not None:
+        actions.append((os.POSIX_SPAWN_DUP2, in_r if in_r is not None else null, 0))
+    try:
+        # New session, as with pty.fork(): no controlling terminal to prompt on, no SIGINT from the keyboard
+        pid = os.posix_spawnp(cmd[0], cmd, os.environ, file_actions=actions, setsid=True)
+    except OSError as e:
+        for fd in (out_r, in_w):
+            if fd is not None:
+                os.close(fd)
+        if verbose:
+            sys.stderr.write(f"[debug] Exec failed: {e}\n")
+        return '', 127
+    finally:
+        for fd in (out_w, in_r, null):
+            if fd is not None:
+                os.close(fd)
+    os.set_blocking(out_r, False)
+    set_pipe_size(out_r, PIPE_READ_SIZE)
+    if in_w is not None:
+        os.set_blocking(in_w, False)
+        set_pipe_size(in_w)
+
+    capture = OutputCapture(strip_scp_progress=os.path.basename(cmd[0]) == 'scp', filter_prompts=False)
+
+    def emit(filtered):
+        if not capture_output and not silent and filtered:
+            PROGRESS.write(filtered, sys.stdout)
+
+    pending = b''
+    drain_deadline = None  # set once the end of stdin_stream has been signalled
+    status = None
+    try:
+        while True:
+            r, w = await wait_fds([out_r], [in_w] if in_w is not None else [], 0.5)
+            if drain_deadline is not None and time.monotonic() > drain_deadline:
+                if verbose:
+                    sys.stderr.write(f"[debug] No completion within {drain_timeout}s after end of input, closing\n")
+                    sys.stderr.flush()
+                os.kill(pid, signal.SIGTERM)
+                break
+            if out_r in r:
+                try:
+                    data = os.read(out_r, PIPE_READ_SIZE)
+                except BlockingIOError:
+                    data = None
+                if data == b'':
+                    break  # ssh exited (the remote command finished)
+                if data:
+                    if drain_deadline is not None:
+                        drain_deadline = time.monotonic() + drain_timeout
+                    if verbose:
+                        preview = data[:32].hex(' ') + (' ...' if len(data) > 32 else '')
+                        sys.stderr.write(f"[recv {len(data)} bytes] {preview}\n")
+                        sys.stderr.flush()
+                    emit(capture.feed(data))
+            if w:
+                pending, eof = feed_pipe(stdin_stream, in_w, pending)
+                if eof:
+                    # End of input: close the pipe and let the remote side finish
+                    os.close(in_w)
+                    in_w = None
+                    drain_deadline = time.monotonic() + drain_timeout
+        status = await wait_child(pid)
+    finally:
+        if in_w is not None:
+            os.close(in_w)
+        os.close(out_r)
+        if status is None:
+            # Interrupted: do not leave the command running
+            try:
+                os.kill(pid, signal.SIGTERM)
+                status = os.waitpid(pid, 0)[1]
+            except (ProcessLookupError, ChildProcessError):
+                pass
+    emit(capture.close())
+    status = os.waitstatus_to_exitcode(status) if status is not None else None
+
+    return (capture.getvalue().decode(errors='ignore') if capture_output else ''), status
+
+async def sshpass_exec_async(cmd, password, verbose=False, retries=2, capture_output=False, silent=False,
+                             stdin_stream=None, authenticated=False, drain_timeout=None, forward_stdin=False):
+    """
+    Run an SSH/SCP command with the transport that fits it: plain pipes
+    (pipe_exec_async()) when no password prompt can come, a PTY answering
+    the prompts (pty_exec_async()) otherwise. Same arguments and result as
+    pty_exec_async().
+    """
+    if authenticated:
+        return await pipe_exec_async(cmd, verbose=verbose, capture_output=capture_output, silent=silent,
+                                     stdin_stream=stdin_stream, drain_timeout=drain_timeout,
+                                     forward_stdin=forward_stdin)
+    return await pty_exec_async(cmd, password, verbose=verbose, retries=retries, capture_output=capture_output,
+                                silent=silent, stdin_stream=stdin_stream, drain_timeout=drain_timeout,
+                                forward_stdin=forward_stdin)
+
+def sshpass_exec(cmd, password, verbose=False, retries=2, capture_output=False, silent=False, stdin_stream=None,
+                 authenticated=False, drain_timeout=None):
+    """
+    Synchronous wrapper of sshpass_exec_async() (same arguments), running
+    it in its own event loop. The terminal input is forwarded to the
+    command unless the thread is unattended. The exit status is available
+    from last_exit_status().
+
+    Returns:
+        Output string if capture_output=True, empty string otherwise
+    """
+    try:
+        output, status = asyncio.run(sshpass_exec_async(
+            cmd, password, verbose=verbose, retries=retries, capture_output=capture_output, silent=silent,
+            stdin_stream=stdin_stream, authenticated=authenticated, drain_timeout=drain_timeout,
+            forward_stdin=not unattended()))
+    except KeyboardInterrupt:
+        output, status = '', None
+    _transport.exit_status = status
+    return output
+
+# --- SSH SESSION MULTIPLEXING ---
+class SSHSessionManager:
+    """
+    Keep one authenticated OpenSSH master connection per host and share it.
+
+    The master is opened once with password authentication (through
+    sshpass_exec) and then reused by every ssh/scp invocation via
+    ControlPath, so each further command only opens a new channel on the
+    existing connection instead of doing a full dropbear login.
+    """
+    def __init__(self):
+        self.enabled = True
+        self._lock = threading.Lock()
+        self._host_locks = {}  # (user, host) -> lock serializing the master of that host
+        self._sessions = {}  # (user, host) -> master pid
+        self._dir = None
+
+    def _host_lock(self, host, user):
+        with self._lock:
+            return self._host_locks.setdefault((user, host), threading.Lock())
+
+    def control_path(self, host, user):
+        """Return the control socket path for user@host (kept short for sun_path)"""
+        with self._lock:
+            if self._dir is None:
+                self._dir = tempfile.mkdtemp(prefix='freetz-ssh-')
+        digest = hashlib.sha1(f"{user}@{host}".encode()).hexdigest()[:16]
+        return os.path.join(self._dir, digest)
+
+    def _master_pid(self, host, user):
+        """Ask the master for its pid; return None if no master is running"""
         try:
-            _, status = os.waitpid(pid, 0)
-        except ChildProcessError:
+            result = subprocess.run(
+                ['ssh', '-o', f'ControlPath={self.control_path(host, user)}', '-O', 'check', f'{user}@{host}'],
+                stdin=subprocess.DEVNULL, capture_output=True, text=True, timeout=10)
+        except Exception:
+            return None
+        match = re.search(r'pid=(\d+)', result.stdout + result.stderr)
+        return int(match.group(1)) if result.returncode == 0 and match else None
+
+    def is_alive(self, host, user):
+        """Check (without spawning processes) whether the master for user@host is still running"""
+        pid = self._sessions.get((user, host))
+        if not pid or not os.path.exists(self.control_path(host, user)):
+            return False
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
             pass
-    
-    return output.decode(errors='ignore') if capture_output else ''
+        return True
+
+    def open(self, host, user, password, debug=False):
+        """Open the master connection for user@host; return True on success"""
+        path = self.control_path(host, user)
+        cmd = ['ssh', '-o', 'StrictHostKeyChecking=no', '-o', 'ControlMaster=yes',
+               '-o', f'ControlPath={path}', '-o', f'ControlPersist={SSH_CONTROL_PERSIST}'
+               ] + SSH_KEEPALIVE + [f'{user}@{host}', 'true']
+        cdebug(f"SSH master: {' '.join(cmd)}", debug)
+        with TRACE.span('connect + auth', 'ssh', host=host) as span:
+            sshpass_exec(cmd, password, verbose=debug, capture_output=True)
+            span['status'] = last_exit_status()
+        pid = self._master_pid(host, user)
+        if pid is None:
+            cdebug(f"Could not open SSH master connection to {host}", debug)
+            return False
+        self._sessions[(user, host)] = pid
+        cdebug(f"SSH master connection to {host} established (pid={pid})", debug)
+        return True
+
+    def options(self, host, user, password, debug=False):
+        """
+        Return the ssh options that route a command through the master of
+        user@host, opening the master first if needed. An empty list means
+        that the command must authenticate on its own.
+        """
+        if not self.enabled:
+            return []
+        with self._host_lock(host, user):
+            if not self.is_alive(host, user) and not self.open(host, user, password, debug):
+                return []
+            return ['-o', f'ControlPath={self.control_path(host, user)}', '-o', 'ControlMaster=no']
+
+    def close(self, host, user, debug=False):
+        """Tear down the master connection of user@host (e.g. before a reboot)"""
+        with self._host_lock(host, user):
+            if self._sessions.pop((user, host), None) is None:
+                return
+            path = self.control_path(host, user)
+            cdebug(f"Closing SSH master connection to {host}", debug)
+            try:
+                subprocess.run(['ssh', '-o', f'ControlPath={path}', '-O', 'exit', f'{user}@{host}'],
+                               stdin=subprocess.DEVNULL, capture_output=True, timeout=10)
+            except Exception:
+                pass
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+    def close_all(self):
+        """Tear down all master connections and remove the socket directory"""
+        for user, host in list(self._sessions):
+            self.close(host, user)
+        if self._dir:
+            shutil.rmtree(self._dir, ignore_errors=True)
+            self._dir = None
+
+SESSIONS = SSHSessionManager()
+atexit.register(SESSIONS.close_all)
+
+# --- REMOTE HELPER AGENT ---
+AGENT_NAME = 'sfu-agent'
+AGENT_START_TIMEOUT = 15  # seconds to wait for the agent to greet
+AGENT_RETRY = 30  # seconds before starting an agent on a host where it failed is tried again
+
+# Listing of the current directory read by remote_manifest(): 'd path' per
+# directory, 'l path<TAB>target' per symlink and the md5sum line of each file
+MANIFEST_LISTING = (r"""find . -type d | sed 's/^/d /'; """
+                    r"""find . -type l | while read -r l; do printf 'l %s\t%s\n' "$l" "$(readlink "$l")"; done; """
+                    r"""find . -type f -print0 | xargs -0 -r md5sum""")
+
+# busybox sh loop reading requests from stdin: a line with the operation and
+# the number of argument lines, then the arguments, one per line. Each
+# response is the output of the request followed by a trailer line with the
+# nonce of the session (so output cannot fake it) and the exit status.
+AGENT_SCRIPT = r"""nonce=$1
+nl='
+'
+frame() { printf '\n%s %s\n' "$nonce" "$1"; }
+frame 0
+while read -r op n; do
+	set --
+	while [ "$n" -gt 0 ] && IFS= read -r line; do
+		set -- "$@" "$line"
+		n=$((n - 1))
+	done
+	case $op in
+	test) [ "$@" ] ;;
+	stat) if [ -d "$1" ]; then echo d; elif [ -f "$1" ]; then set -- $(ls -lnd "$1") && echo "f $5"
+	      elif [ -e "$1" ] || [ -L "$1" ]; then echo o; else false; fi ;;
+	read) cat "$1" ;;
+	du) du -sk "$1" ;;
+	df) df -h "$@" ;;
+	sum) "$1" <"$2" ;;
+	manifest) (cd "$1" && { """ + MANIFEST_LISTING + r"""; }) ;;
+	run) cmd=; for line; do cmd=$cmd$line$nl; done; (eval "$cmd") ;;
+	quit) exit 0 ;;
+	*) echo "unknown request: $op"; false ;;
+	esac </dev/null 2>&1
+	frame $?
+done
+"""
+
+class RemoteAgent:
+    """
+    Helper shell on the box serving many requests over one SSH channel, so
+    a probe costs a round trip instead of a login. The channel is opened
+    through the shared master connection, or with key authentication: it
+    never waits for a password prompt.
+    """
+    def __init__(self, host, user, password, debug=False):
+        self.host = host
+        self.user = user
+        self.password = password
+        self.debug = debug
+        self.nonce = os.urandom(8).hex()
+        self.proc = None
+        self._buffer = bytearray()
+
+    def start(self):
+        """Push the agent script to the box and wait for its greeting; return True on success"""
+        mux = SESSIONS.options(self.host, self.user, self.password, self.debug)
+        cmd = (['ssh', '-o', 'StrictHostKeyChecking=no', '-o', 'BatchMode=yes'] + mux + SSH_KEEPALIVE
+               + [f'{self.user}@{self.host}',
+                  f"export PATH='{FREETZ_PATH}'; exec sh -c {shlex.quote(AGENT_SCRIPT)} {AGENT_NAME} {self.nonce}"])
+        cdebug(f"Starting remote agent on {self.host}", self.debug)
+        try:
+            self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                         stderr=subprocess.DEVNULL, start_new_session=True)
+        except OSError as e:
+            cdebug(f"Could not start remote agent: {e}", self.debug)
+            return False
+        return self._response(AGENT_START_TIMEOUT)[1] == 0
+
+    def alive(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def request(self, op, *args):
+        """Send one request; return (output, exit status), the status is None if the channel was lost"""
+        lines = [op, str(len(args))]
+        try:
+            self.proc.stdin.write((' '.join(lines) + '\n' + ''.join(f"{arg}\n" for arg in args)).encode())
+            self.proc.stdin.flush()
+        except (OSError, ValueError):
+            self.close()
+            return '', None
+        return self._response()
+
+    def _response(self, timeout=None):
+        """Read up to the trailer of the next response"""
+        trailer = f"\n{self.nonce} ".encode()
+        fd = self.proc.stdout.fileno()
+        deadline = time.monotonic() + timeout if timeout else None
+        searched = 0
+        while True:
+            found = self._buffer.find(trailer, searched)
+            if found >= 0:
+                end = self._buffer.find(b'\n', found + len(trailer))
+                if end >= 0:
+                    output, status = self._buffer[:found], self._buffer[found + len(trailer):end]
+                    del self._buffer[:end + 1]
+                    return output.decode(errors='ignore'), int(status)
+            else:
+                searched = max(0, len(self._buffer) - len(trailer))
+            if deadline is not None:
+                ready, _, _ = select.select([fd], [], [], max(0, deadline - time.monotonic()))
+                if not ready:
+                    cdebug(f"Remote agent on {self.host} did not answer in time", self.debug)
+                    self.close()
+                    return '', None
+            data = os.read(fd, PTY_READ_SIZE)
+            if not data:
+                self.close()
+                return '', None
+            self._buffer += data  # bytearray: appending is amortized O(1)
+
+    def run(self, command):
+        """Run a shell command (stdin /dev/null, stderr merged); return (output, exit status)"""
+        return self.request('run', *command.split('\n'))
+
+    def test(self, *args):
+        """Evaluate a test(1) expression"""
+        return self.request('test', *args)[1] == 0
+
+    def stat(self, path):
+        """Return ('f', size) of a file, ('d', None) of a directory, ('o', None) of anything else, None if missing"""
+        output, status = self.request('stat', path)
+        fields = output.split()
+        if status != 0 or not fields:
+            return None
+        return fields[0], int(fields[1]) if len(fields) > 1 and fields[1].isdigit() else None
+
+    def read(self, path):
+        """Return the content of a remote file, None if it cannot be read"""
+        output, status = self.request('read', path)
+        return output if status == 0 else None
+
+    def du(self, path):
+        """Return the disk usage of path in KB, None if unknown"""
+        output, status = self.request('du', path)
+        fields = output.split()
+        return int(fields[0]) if status == 0 and fields and fields[0].isdigit() else None
+
+    def df(self, *paths):
+        """Return the 'df -h' output of the filesystems holding paths (all of them without paths)"""
+        return self.request('df', *paths)[0]
+
+    def checksum(self, command, path):
+        """Return the digest of a remote file computed by command (e.g. md5sum), None on failure"""
+        output, status = self.request('sum', command, path)
+        fields = output.split()
+        return fields[0] if status == 0 and fields else None
+
+    def manifest(self, path):
+        """Return the MANIFEST_LISTING of a remote directory, None if it cannot be read"""
+        output, status = self.request('manifest', path)
+        return output if status == 0 else None
+
+    def close(self):
+        """Stop the agent and its channel"""
+        proc, self.proc = self.proc, None
+        if proc is None:
+            return
+        try:
+            if proc.poll() is None:
+                proc.stdin.write(b"quit 0\n")
+            proc.stdin.close()
+            proc.wait(timeout=2)
+        except (OSError, ValueError, subprocess.TimeoutExpired):
+            proc.kill()
+            proc.wait()
+        proc.stdout.close()
+
+class AgentPool:
+    """
+    Idle remote agents per host. An agent serves one caller at a time: a
+    thread finding none idle starts one more channel on the same connection.
+    """
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._idle = {}  # (user, host) -> [RemoteAgent]
+        self._failed = {}  # (user, host) -> time before which no agent is started
+
+    def acquire(self, host, user, password, debug=False):
+        """Return an agent for user@host, None if agents are disabled or cannot be started"""
+        if not self.enabled:
+            return None
+        with self._lock:
+            if time.monotonic() < self._failed.get((user, host), 0):
+                return None
+            idle = self._idle.setdefault((user, host), [])
+            while idle:
+                agent = idle.pop()
+                if agent.alive():
+                    return agent
+        agent = RemoteAgent(host, user, password, debug)
+        if agent.start():
+            return agent
+        agent.close()
+        cdebug(f"Remote agent not available on {host}, using one SSH command per call", debug)
+        with self._lock:
+            self._failed[(user, host)] = time.monotonic() + AGENT_RETRY
+        return None
+
+    def release(self, agent):
+        """Give an agent back to the pool once its caller is done"""
+        if agent.alive():
+            with self._lock:
+                self._idle.setdefault((agent.user, agent.host), []).append(agent)
+
+    def close(self, host, user):
+        """Stop the idle agents of user@host (e.g. before a reboot)"""
+        with self._lock:
+            agents = self._idle.pop((user, host), [])
+            self._failed.pop((user, host), None)
+        for agent in agents:
+            agent.close()
+
+    def close_all(self):
+        for user, host in list(self._idle):
+            self.close(host, user)
+
+AGENTS = AgentPool()
+atexit.register(AGENTS.close_all)
+
+def agent_call(host, user, password, request, *args, debug=False):
+    """
+    Call the typed request (a RemoteAgent method name) with args on an agent
+    of user@host. Returns (True, result), or (False, None) if there is no
+    agent and the caller has to run an SSH command instead.
+    """
+    agent = AGENTS.acquire(host, user, password, debug)
+    if not agent:
+        return False, None
+    start = time.perf_counter()
+    try:
+        result = getattr(agent, request)(*args)
+    finally:
+        AGENTS.release(agent)
+    if debug:
+        log_ssh_command(f"[agent] {request} {shlex.join(args)}", str(result), debug, host=host,
+                        seconds=time.perf_counter() - start)
+    return True, result
+
+def remote_test(host, user, password, *args, debug=False):
+    """Evaluate a test(1) expression on the box, through the agent when there is one"""
+    served, result = agent_call(host, user, password, 'test', *args, debug=debug)
+    if served:
+        return result
+    return ssh_run(host, user, password, f"test {shlex.join(args)} && echo exists || echo notfound",
+                   debug=debug, capture_output=True).strip() == 'exists'
+
+_key_auth = {}  # (user, host) -> the box accepts our key (only known answers are kept)
+_key_auth_retry = {}  # (user, host) -> time before which a box that did not answer is not probed again
+
+def key_auth(host, user, debug=False):
+    """Check once per host whether ssh logs in without a password (key or agent authentication)"""
+    if (user, host) not in _key_auth:
+        if time.monotonic() < _key_auth_retry.get((user, host), 0):
+            return False
+        try:
+            result = subprocess.run(['ssh', '-o', 'StrictHostKeyChecking=no', '-o', 'BatchMode=yes',
+                                     '-o', 'ConnectTimeout=10', f'{user}@{host}', 'true'],
+                                    stdin=subprocess.DEVNULL, capture_output=True, text=True, timeout=30)
+        except (OSError, subprocess.TimeoutExpired):
+            result = None
+        if result and result.returncode == 0:
+            _key_auth[(user, host)] = True
+        elif result and 'permission denied' in result.stderr.lower():
+            _key_auth[(user, host)] = False
+        else:
+            # Box not reachable (e.g. rebooting): commands use the password until it is asked again
+            _key_auth_retry[(user, host)] = time.monotonic() + KEY_AUTH_RETRY
+            return False
+        cdebug(f"Key authentication on {host}: {'yes' if _key_auth[(user, host)] else 'no'}", debug)
+    return _key_auth[(user, host)]
+
+def auth_options(host, user, password, debug=False, shared=True):
+    """
+    Return (ssh options, authenticated): through the master connection if
+    there is one (and shared), else with key authentication if the box
+    accepts it. An authenticated command never prompts, so it runs on the
+    pipe transport.
+    """
+    mux = SESSIONS.options(host, user, password, debug) if shared else []
+    if mux:
+        return mux, True
+    if key_auth(host, user, debug):
+        return ['-o', 'BatchMode=yes'], True
+    return [], False
+
+def ssh_command(host, user, password, command, debug=False, shared=True):
+    """
+    Return (ssh arguments, authenticated) to run command on the remote host,
+    on the shared master connection or (not shared) on a connection of its own
+    """
+    # Prepend PATH export to ensure Freetz-NG commands are found
+    # Use 'export PATH=...; command' to set PATH for the entire command execution
+    full_command = f"export PATH='{FREETZ_PATH}'; {command}"
+    options, authenticated = auth_options(host, user, password, debug, shared)
+    cmd = ['ssh', '-o', 'StrictHostKeyChecking=no'] + options + [f'{user}@{host}', full_command]
+    cdebug(f"SSH: {' '.join(cmd)}", debug)
+    return cmd, authenticated
+
+def scp_command(host, user, password, local, remote, debug=False):
+    """Return (scp arguments, authenticated) to copy local to the remote host"""
+    # Use quiet mode and redirect all output to /dev/null to prevent progress display
+    options, authenticated = auth_options(host, user, password, debug)
+    cmd = ['scp', '-o', 'StrictHostKeyChecking=no', '-o', 'LogLevel=ERROR'] + options + ['-q', local, f'{user}@{host}:{remote}']
+    cdebug(f"SCP: {' '.join(cmd)}", debug)
+    return cmd, authenticated
+
+async def unattended_call(func, *args):
+    """Run a blocking helper (e.g. opening an SSH master) in a worker thread that never reads the terminal"""
+    def call():
+        _transport.unattended = True
+        return func(*args)
+    return await asyncio.to_thread(call)
+
+def ssh_run(host, user, password, command, debug=False, capture_output=True, stdin_stream=None):
+    """Execute command on remote host via SSH, optionally passing a file-like stdin_stream"""
+    start = time.perf_counter()
+    with TRACE.span(trace_command(command), 'ssh', host=host) as span:
+        # Captured commands without input are served by the remote agent, if enabled
+        agent = AGENTS.acquire(host, user, password, debug) if capture_output and stdin_stream is None else None
+        if agent:
+            try:
+                output, _transport.exit_status = agent.run(command)
+            finally:
+                AGENTS.release(agent)
+            cmd = ['[agent]', command]
+            span['agent'] = True
+        else:
+            cmd, authenticated = ssh_command(host, user, password, command, debug)
+            output = sshpass_exec(cmd, password, verbose=debug, capture_output=capture_output,
+                                  stdin_stream=stdin_stream, authenticated=authenticated)
+        span.update(status=last_exit_status(), bytes_out=getattr(stdin_stream, 'count', 0),
+                    bytes_in=len(output or ''))
+    # Log command and output only in debug mode
+    if debug:
+        log_ssh_command(' '.join(cmd), output if capture_output else "[output not captured]", debug,
+                        host=host, status=last_exit_status(), seconds=time.perf_counter() - start)
+    return output
+
+async def ssh_run_async(host, user, password, command, debug=False, stdin_stream=None, shared=True):
+    """
+    Awaitable ssh_run() (output always captured); return (output, exit status).
+    Not shared, the command gets an SSH connection of its own (own cipher
+    stream and TCP window) instead of a channel of the master connection.
+    """
+    start = time.perf_counter()
+    cmd, authenticated = await unattended_call(ssh_command, host, user, password, command, debug, shared)
+    output, status = await sshpass_exec_async(cmd, password, verbose=debug, capture_output=True,
+                                              stdin_stream=stdin_stream, authenticated=authenticated)
+    if TRACE.enabled:
+        TRACE.record(trace_command(command), 'ssh', start, {'host': host, 'status': status, 'bytes_in': len(output),
+                                                             'bytes_out': getattr(stdin_stream, 'count', 0)})
+    if debug:
+        log_ssh_command(' '.join(cmd), output, debug, host=host, status=status, seconds=time.perf_counter() - start)
+    return output, status
+
+async def scp_send_async(host, user, password, local, remote, debug=False):
+    """Awaitable copy of a file to the remote host via SCP (overwriting it); return True on success"""
+    start = time.perf_counter()
+    cmd, authenticated = await unattended_call(scp_command, host, user, password, local, remote, debug)
+    # Execute SCP with silent=True to suppress all output
+    output, status = await sshpass_exec_async(cmd, password, capture_output=True, silent=True,
+                                              authenticated=authenticated)
+    # Log SCP command only in debug mode
+    if debug:
+        log_ssh_command(' '.join(cmd), output or f"Uploaded {local} to {remote}", debug, host=host, status=status,
+                        seconds=time.perf_counter() - start)
+    if TRACE.enabled:
+        TRACE.record(f"scp {os.path.basename(local)}", 'ssh', start,
+                     {'host': host, 'status': status, 'bytes_out': get_file_size(local)})
+    # Check if there were any error messages in output
+    if status != 0 or (output and ('error' in output.lower() or 'failed' in output.lower()
+                                   or 'permission denied' in output.lower())):
+        cdebug(f"SCP failed (exit status {status}): {output}", debug)
+        return False
+    return True
+
+def scp_send(host, user, password, local, remote, debug=False, dry_run=False):
+    """Copy file to remote host via SCP"""
+    try:
+        # Resume a partial copy left by an interrupted upload, or start over
+        offset = check_remote_file(host, user, password, local, remote, debug=debug, dry_run=dry_run)
+        if offset is None:
+            return None
+        if offset:
+            return offset == get_file_size(local) or resumable_upload(host, user, password, local, remote,
+                                                                      offset=offset, debug=debug)
+        return asyncio.run(scp_send_async(host, user, password, local, remote, debug))
+    except Exception as e:
+        cdebug(f"SCP exception: {e}", debug)
+        return False
+
+
+class ProgressReader:
+    """
+    File wrapper counting the bytes read from it, i.e. pushed into the
+    transport, and reporting them to callback(bytes_read) at most once per
+    interval seconds (and once more at end of file). With a length, the
+    file ends that many bytes after its current position.
+    """
+    hash = None  # see HashingReader
+    zero_copy = True  # the transport may use sendfile() instead of read()
+
+    def __init__(self, f, callback=None, interval=PROGRESS_INTERVAL, length=None):
+        self.f = f
+        self.callback = callback
+        self.interval = interval
+        self.length = length
+        self.count = 0
+        self._last_report = 0
+
+    def fileno(self):
+        return self.f.fileno()
+
+    def _limit(self, size):
+        if self.length is None:
+            return size
+        left = self.length - self.count
+        return left if size < 0 else min(size, left)
+
+    def read(self, size=-1):
+        data = self.f.read(self._limit(size))
+        self._advance(data)
+        self._sent(len(data))
+        return data
+
+    def sendfile(self, fd, size):
+        """
+        Copy up to size bytes to fd in the kernel (os.sendfile()) instead of
+        read() + write(); return the bytes sent, 0 at end of file. The data
+        is not seen, so readers inspecting it set zero_copy = False.
+        BlockingIOError if fd is full.
+        """
+        offset = self.f.tell()
+        size = self._limit(size)
+        sent = os.sendfile(fd, self.f.fileno(), offset, size) if size else 0
+        self.f.seek(offset + sent)
+        self._sent(sent)
+        return sent
+
+    def _sent(self, size):
+        self.count += size
+        if self.callback:
+            now = time.monotonic()
+            if not size or now - self._last_report >= self.interval:
+                self._last_report = now
+                self._notify()
+
+    def _advance(self, data):
+        """Hook for subclasses inspecting the data at offset count"""
+
+    def _notify(self):
+        self.callback(self.count)
+
+class HashingReader(ProgressReader):
+    """
+    ProgressReader that also hashes the data passing through: the digest
+    of what was sent, in the same single read() pass that sends it
+    """
+    zero_copy = False  # hashing needs the data in userspace anyway; sendfile() would mean a second read
+    def __init__(self, f, algorithm='md5', callback=None, interval=PROGRESS_INTERVAL, length=None):
+        super().__init__(f, callback, interval, length)
+        self.hash = hashlib.new(algorithm)
+
+    def _advance(self, data):
+        self.hash.update(data)
+
+TAR_BLOCK = 512
+TAR_META_TYPES = (b'5', b'L', b'K', b'x', b'g')  # directories, long names and pax headers
+
+def tar_header_size(header):
+    """Return the member size stored in a tar header (octal or base-256)"""
+    field = header[124:136]
+    if field[0] & 0x80:
+        return int.from_bytes(field[1:], 'big')
+    try:
+        return int(field.strip(b'\0 ') or b'0', 8)
+    except ValueError:
+        return 0
+
+class TarProgressReader(ProgressReader):
+    """
+    ProgressReader for a tar stream that also counts the archive members
+    (directories excluded) by following the 512-byte headers as they pass.
+    The callback gets (bytes_read, members).
+    """
+    zero_copy = False  # the headers must be seen
+
+    def __init__(self, f, callback=None, interval=PROGRESS_INTERVAL):
+        super().__init__(f, callback, interval)
+        self.members = 0
+        self._next_header = 0  # stream offset of the next header block
+        self._header = b''  # header block split across reads
+
+    def _advance(self, data):
+        start = self.count
+        end = start + len(data)
+        while self._next_header < end:
+            pos = max(0, self._next_header - start)  # 0: header started in the previous read
+            self._header += data[pos:pos + TAR_BLOCK - len(self._header)]
+            if len(self._header) < TAR_BLOCK:
+                return
+            header, self._header = self._header, b''
+            if not header.strip(b'\0'):  # end of archive
+                self._next_header = float('inf')
+                return
+            size = tar_header_size(header)
+            self._next_header += TAR_BLOCK + -(-size // TAR_BLOCK) * TAR_BLOCK
+            if header[156:157] not in TAR_META_TYPES and not header[:100].rstrip(b'\0').endswith(b'/'):
+                self.members += 1
+
+    def _notify(self):
+        self.callback(self.count, self.members)
+
+# box command -> hashlib algorithm, in order of preference (md5 is the cheapest on the box)
+UPLOAD_DIGESTS = (('md5sum', 'md5'), ('sha256sum', 'sha256'), ('sha1sum', 'sha1'))
+
+def upload_digest(host, user, password, debug=False):
+    """Return (box command, hashlib algorithm) of the digest used to verify uploads, (None, None) if none"""
+    available = remote_commands(host, user, password, [command for command, _ in UPLOAD_DIGESTS], debug)
+    return next(((c, a) for c, a in UPLOAD_DIGESTS if c in available), (None, None))
+
+def upload_command(remote, offset, digest_command):
+    """
+    Box command writing (offset: appending) its stdin to remote. With a
+    digest command, the data is hashed while it is written: a failing tee
+    adds a marker to the hashed data, so the digest cannot match.
+    """
+    if not digest_command:
+        return f"cat {'>>' if offset else '>'} '{remote}'"
+    return f"{{ tee {'-a ' if offset else ''}'{remote}' || echo tee-failed; }} | {digest_command}"
+
+def check_upload_digest(output, status, reader, remote, debug=False):
+    """Compare the digest printed by the box with the one of the data sent; return True if they match"""
+    if status != 0:
+        cdebug(f"Upload to {remote} failed with exit status {status}", debug)
+        return False
+    if reader.hash is None:
+        return True
+    match = re.search(r'\b[0-9a-f]{32,128}\b', output)
+    received = match.group(0) if match else None
+    if received != reader.hash.hexdigest():
+        cerror(f"Upload to {remote} corrupted: sent {reader.hash.name} {reader.hash.hexdigest()}, "
+               f"the FRITZ!Box received {received or 'nothing'}")
+        return False
+    cdebug(f"Upload to {remote} verified ({reader.hash.name} {received})", debug)
+    return True
+
+def ssh_upload(host, user, password, local, remote, debug=False, progress=None, offset=0):
+    """
+    Copy a file to the remote host by streaming it into 'cat' over SSH.
+    Unlike scp, the bytes sent are known locally: progress(bytes_sent) is
+    called about once per second. With an offset, only the part of the file
+    from there on is sent and appended to the remote file.
+
+    The data is hashed on both sides while it passes (see upload_digest()),
+    so the transfer is verified without reading the file again.
+    Returns True if the remote side succeeded and received what was sent.
+    """
+    cdebug(f"Streaming {local} to {remote}" + (f" from offset {offset}" if offset else ''), debug)
+    digest_command, algorithm = upload_digest(host, user, password, debug)
+    with open(local, 'rb') as f:
+        f.seek(offset)
+        reader = HashingReader(f, algorithm, progress) if algorithm else ProgressReader(f, progress)
+        output = ssh_run(host, user, password, upload_command(remote, offset, digest_command), debug=debug,
+                         capture_output=True, stdin_stream=reader)
+    return check_upload_digest(output, last_exit_status(), reader, remote, debug)
+
+def file_digest(path, length=None, algorithm='md5'):
+    """Return the digest of the first length bytes of a file (the whole file if None)"""
+    digest = hashlib.new(algorithm)
+    left = length
+    with open(path, 'rb') as f:
+        while left is None or left > 0:
+            chunk = f.read(1024 * 1024 if left is None else min(left, 1024 * 1024))
+            if not chunk:
+                break
+            digest.update(chunk)
+            if left is not None:
+                left -= len(chunk)
+    return digest.hexdigest()
+
+def remote_resume_offset(host, user, password, local, remote, debug=False):
+    """
+    Return how much of local the remote file already holds: 0 if it does
+    not exist, its size if it is a prefix of local (same digest), None if
+    it differs. An offset equal to the local size means a verified full copy.
+    """
+    digest_command, algorithm = upload_digest(host, user, password, debug)
+    served, info = agent_call(host, user, password, 'stat', remote, debug=debug)
+    if served:
+        output = []
+        if info and info[0] == 'f':
+            output = [str(info[1])]
+            if digest_command:
+                output.append(agent_call(host, user, password, 'checksum', digest_command, remote, debug=debug)[1])
+    else:
+        output = ssh_run(host, user, password, f"[ -f '{remote}' ] || exit 0; wc -c < '{remote}'"
+                         + (f"; {digest_command} < '{remote}'" if digest_command else ''),
+                         debug=debug, capture_output=True).split()
+    if not output:
+        return 0
+    try:
+        size = int(output[0])
+        digest = output[1] if digest_command else None
+    except (ValueError, IndexError):
+        return None
+    if size > get_file_size(local) or (digest_command and file_digest(local, size, algorithm) != digest):
+        return None
+    return size
+
+def check_remote_file(host, user, password, local, remote, debug=False, dry_run=False):
+    """
+    Look at the remote copy of local before an upload. Returns the offset
+    to upload from (0: from scratch, the file size: nothing left to send),
+    or None if the user does not want to overwrite a different file.
+    """
+    offset = remote_resume_offset(host, user, password, local, remote, debug)
+    size = get_file_size(local)
+    if offset is None:
+        if dry_run:
+            cwarning(f"[DRY-RUN] Remote file '{remote}' already exists. Would delete before upload.")
+            return 0
+        if sys.stdin.isatty() and not unattended():  # Interactive mode
+            cwarning(f"Remote file already exists: {remote}")
+            if not confirm(f"Overwrite remote file\n '{remote}'?\n This will delete the existing file and it is needed to continue.", default=False):
+                cerror("Upload cancelled by user.")
+                return None
+        # Delete remote file before upload
+        ssh_run(host, user, password, f"rm -f '{remote}'", debug=debug)
+        return 0
+    if offset == size:
+        cinfo(f"Remote file '{remote}' is already complete (checksum verified), nothing to upload")
+    elif offset:
+        cinfo(f"Resuming upload of '{remote}' at {format_size(offset)} of {format_size(size)}")
+    return offset
+
+def resumable_upload(host, user, password, local, remote, offset=0, debug=False, progress=None,
+                     retries=UPLOAD_RETRIES):
+    """
+    Upload local from offset on with ssh_upload() and verify the complete
+    remote file: the part sent is checked in-stream, the part already on
+    the box by check_remote_file(). Only a broken transfer costs a
+    re-read: it is resumed from what actually arrived, up to retries
+    times, so a retry only costs the lost bytes. progress(bytes) gets the
+    position in the whole file.
+    Only files uploaded as files resume: the archives of an update are
+    streamed straight into tar (see extract_archive_with_progress()), and
+    an interrupted extraction is started over.
+    Returns True if the remote file is complete and verified.
+    """
+    size = get_file_size(local)
+    streamed_digest = upload_digest(host, user, password, debug)[0] is not None
+    for attempt in range(retries + 1):
+        if offset < size:
+            start = offset
+            if ssh_upload(host, user, password, local, remote, debug=debug, offset=offset,
+                          progress=(lambda sent: progress(start + sent)) if progress else None) and streamed_digest:
+                return True
+        offset = remote_resume_offset(host, user, password, local, remote, debug)
+        if offset == size:
+            return True
+        if attempt == retries:
+            break
+        if offset is None:
+            cwarning(f"Remote file '{remote}' is corrupted, uploading it again")
+            ssh_run(host, user, password, f"rm -f '{remote}'", debug=debug)
+            offset = 0
+        else:
+            cwarning(f"Upload interrupted at {format_size(offset)}, resuming "
+                     f"(retry {attempt + 1}/{retries})")
+    cerror(f"Upload of '{remote}' could not be completed and verified")
+    return False
+
+async def ssh_upload_async(host, user, password, local, remote, debug=False, progress=None, offset=0):
+    """Awaitable ssh_upload(); return True if the remote side succeeded and received what was sent"""
+    cdebug(f"Streaming {local} to {remote}" + (f" from offset {offset}" if offset else ''), debug)
+    digest_command, algorithm = await unattended_call(upload_digest, host, user, password, debug)
+    with open(local, 'rb') as f:
+        f.seek(offset)
+        reader = HashingReader(f, algorithm, progress) if algorithm else ProgressReader(f, progress)
+        output, status = await ssh_run_async(host, user, password, upload_command(remote, offset, digest_command),
+                                             debug=debug, stdin_stream=reader)
+    return check_upload_digest(output, status, reader, remote, debug)
+
+UPLOAD_BLOCK = 64 * 1024  # dd block size of parallel uploads; ranges start on a block boundary
+PARALLEL_UPLOAD_MIN = 32 * 1024 * 1024  # smaller files are sent in one stream
+PARALLEL_STREAMS_MAX = 4
+PARALLEL_PROBE_SIZE = 4 * 1024 * 1024  # first range, sent alone to measure the rate of one stream
+PARALLEL_CHUNK_SECONDS = 4  # ranges are sized to take about this long on one stream
+PARALLEL_CHUNK_MIN = 4 * 1024 * 1024
+PARALLEL_CHUNK_MAX = 64 * 1024 * 1024
+PARALLEL_GAIN = 0.2  # one more stream is kept only if it raises the total rate by this much
+
+def range_upload_command(remote, start, length, digest_command):
+    """
+    Box command writing its stdin into remote at byte start (a multiple of
+    UPLOAD_BLOCK) with dd and, with a digest command, hashing the range back
+    """
+    block = start // UPLOAD_BLOCK
+    write = f"dd of='{remote}' bs={UPLOAD_BLOCK} seek={block} conv=notrunc 2>/dev/null"
+    if not digest_command:
+        return write
+    return (f"{write} && dd if='{remote}' bs={UPLOAD_BLOCK} skip={block} count={-(-length // UPLOAD_BLOCK)} "
+            f"2>/dev/null | {digest_command}")
+
+async def upload_range_async(host, user, password, local, remote, start, length, digest, debug=False, progress=None):
+    """
+    Send length bytes of local from start into remote on an SSH connection of
+    its own, retried up to UPLOAD_RETRIES times. digest is the
+    (box command, hashlib algorithm) pair of upload_digest().
+    Returns True once the range arrived and is verified.
+    """
+    digest_command, algorithm = digest
+    for attempt in range(UPLOAD_RETRIES + 1):
+        with open(local, 'rb') as f:
+            f.seek(start)
+            reader = (HashingReader(f, algorithm, progress, length=length) if algorithm
+                      else ProgressReader(f, progress, length=length))
+            output, status = await ssh_run_async(host, user, password,
+                                                 range_upload_command(remote, start, length, digest_command),
+                                                 debug=debug, stdin_stream=reader, shared=False)
+        if reader.count == length and check_upload_digest(output, status, reader, remote, debug):
+            return True
+        if progress:
+            progress(0)
+        cdebug(f"Range {start}+{length} of {remote} failed (attempt {attempt + 1})", debug)
+    return False
+
+async def parallel_upload_async(host, user, password, local, remote, offset=0, debug=False, progress=None,
+                                max_streams=PARALLEL_STREAMS_MAX):
+    """
+    Upload local from offset on as byte ranges sent over concurrent SSH
+    connections and written in place on the box with 'dd seek='. The first
+    range goes alone and measures the rate of one stream: it sizes the next
+    ranges, and streams are added one at a time as long as each one raises
+    the total rate by PARALLEL_GAIN. Every range is verified (see
+    range_upload_command()), then the size of the whole file.
+    progress(bytes) gets the position in the whole file.
+    Returns True if the remote file is complete and verified.
+    """
+    size = get_file_size(local)
+    digest = await unattended_call(upload_digest, host, user, password, debug)
+    base = position = offset - offset % UPLOAD_BLOCK
+    done = {}  # range start -> bytes sent
+
+    def take(length):
+        nonlocal position
+        start, position = position, min(size, position + length)
+        return start, position - start
+
+    async def send(start, length):
+        def sent(count):
+            done[start] = count
+            if progress:
+                progress(base + sum(done.values()))
+        return await upload_range_async(host, user, password, local, remote, start, length, digest, debug,
+                                        sent)
+
+    started = time.monotonic()
+    start, length = take(PARALLEL_PROBE_SIZE)
+    if not await send(start, length):
+        return False
+    best = length / max(time.monotonic() - started, 1e-3)
+    # Ranges for about PARALLEL_CHUNK_SECONDS each, small enough to leave most of the file to the tuned streams
+    chunk = min(best * PARALLEL_CHUNK_SECONDS, PARALLEL_CHUNK_MAX, (size - position) / max_streams ** 2)
+    chunk = int(max(chunk, PARALLEL_CHUNK_MIN))
+    streams, growing = 1, max_streams > 1
+    cdebug(f"One stream: {format_size(best)}/s, ranges of {format_size(chunk)}", debug)
+    while position < size:
+        trial = streams + 1 if growing else streams
+        # Once tuned (or near the end), the rest is split evenly between the streams
+        length = chunk if growing and size - position > 2 * trial * chunk else -(-(size - position) // trial)
+        length += -length % UPLOAD_BLOCK
+        ranges = [r for r in (take(length) for _ in range(trial)) if r[1]]
+        started = time.monotonic()
+        if not all(await asyncio.gather(*(send(start, length) for start, length in ranges))):
+            return False
+        rate = sum(length for _, length in ranges) / max(time.monotonic() - started, 1e-3)
+        if growing and len(ranges) == trial:
+            cdebug(f"{trial} streams: {format_size(rate)}/s", debug)
+            if rate > best * (1 + PARALLEL_GAIN):
+                streams, best = trial, rate
+                growing = streams < max_streams
+            else:
+                growing = False
+    TRACE.note(streams=streams)
+    output = await ssh_run_async(host, user, password, f"wc -c < '{remote}'", debug=debug)
+    if output[0].strip() != str(size):
+        cerror(f"Upload of '{remote}' incomplete: {output[0].strip() or 'no file'} of {size} bytes on the box")
+        return False
+    return True
+
+_remote_commands = {}  # (user, host) -> {command: available}
+
+def remote_commands(host, user, password, names, debug=False):
+    """Return which of the given commands exist on the box (cached per host, one SSH call for the unknown ones)"""
+    known = _remote_commands.setdefault((user, host), {})
+    missing = [n for n in names if n not in known]
+    if missing:
+        output = ssh_run(host, user, password,
+                         f"for c in {' '.join(missing)}; do command -v $c >/dev/null 2>&1 && echo $c; done",
+                         debug=debug, capture_output=True)
+        found = set(output.split())
+        for name in missing:
+            known[name] = name in found
+        cdebug(f"Commands available on {host}: {', '.join(sorted(n for n in known if known[n])) or 'none'}", debug)
+    return {n for n in names if known[n]}
+
+
+# --- WIRE COMPRESSION ---
+# codec -> box commands able to decompress it to stdout, in order of preference
+WIRE_DECOMPRESSORS = {
+    'gzip': (('gunzip', 'gunzip -c'), ('gzip', 'gzip -dc'), ('zcat', 'zcat')),
+    'xz': (('unxz', 'unxz -c'), ('xz', 'xz -dc'), ('xzcat', 'xzcat')),
+    'lzma': (('unlzma', 'unlzma -c'), ('lzma', 'lzma -dc'), ('lzcat', 'lzcat')),
+}
+WIRE_GZIP_LEVEL = 6  # the level does not change gzip decompression cost on the box
+WIRE_LZMA_PRESET = 2
+WIRE_LZMA_DICT = 1024 * 1024  # bounds the memory the box needs to decompress
+WIRE_SAMPLE_SIZE = 256 * 1024
+WIRE_MIN_SAVING = 0.1  # send plain tar when compression saves less than this
+
+def wire_compressor(codec, level=None):
+    """Return a new compressor object (compress()/flush()) for codec (level: gzip only)"""
+    if codec == 'gzip':
+        return zlib.compressobj(level or WIRE_GZIP_LEVEL, zlib.DEFLATED, 31)
+    filters = [{'id': lzma.FILTER_LZMA2 if codec == 'xz' else lzma.FILTER_LZMA1,
+                'preset': WIRE_LZMA_PRESET, 'dict_size': WIRE_LZMA_DICT}]
+    if codec == 'xz':
+        return lzma.LZMACompressor(format=lzma.FORMAT_XZ, check=lzma.CHECK_CRC32, filters=filters)
+    return lzma.LZMACompressor(format=lzma.FORMAT_ALONE, filters=filters)
+
+def wire_samples(path, samples=4):
+    """Yield a few WIRE_SAMPLE_SIZE pieces spread over a file"""
+    size = get_file_size(path)
+    with open(path, 'rb') as f:
+        for i in range(samples):
+            f.seek(max(0, size - WIRE_SAMPLE_SIZE) * i // max(1, samples - 1))
+            yield f.read(WIRE_SAMPLE_SIZE)
+
+def sample_compression(path, codec, level=None, samples=4):
+    """Compress a few samples spread over a file: return (compression ratio, local compression rate in bytes/s)"""
+    raw = packed = 0
+    seconds = 0.0
+    for data in wire_samples(path, samples):
+        start = time.perf_counter()
+        comp = wire_compressor(codec, level)
+        packed += len(comp.compress(data)) + len(comp.flush())
+        seconds += time.perf_counter() - start
+        raw += len(data)
+    return (packed / raw if raw else 1.0), (raw / seconds if seconds > 0 else float('inf'))
+
+def sample_compression_ratio(path, codec, samples=4):
+    """Estimate the compression ratio of a file from a few samples spread over it"""
+    return sample_compression(path, codec, samples=samples)[0]
+
+def choose_wire_codec(host, user, password, archive_file, compress='auto', debug=False, target_dir=None):
+    """
+    Pick the on-the-wire compression for streaming archive_file to the box
+    (extracted to target_dir). Returns (codec, remote decompress command,
+    gzip level), or (None, None, None) for plain tar.
+
+    'auto' uses gzip, whose decompression is cheap enough for the weakest
+    boxes, and only if a sample of the archive actually compresses (firmware
+    images mostly hold already compressed filesystems). xz/lzma are used on
+    request only, with a small dictionary. Once the box is calibrated (see
+    calibrate_link()), 'auto' picks whatever its link profile estimates to
+    be the fastest instead.
+    """
+    if compress in (None, 'none'):
+        return None, None, None
+    if compress == 'auto' and host in _link_profiles:
+        return _link_profiles[host].choose_codec(host, user, password, archive_file, target_dir, debug)
+    codec = 'gzip' if compress == 'auto' else compress
+    if compress == 'auto':
+        ratio = sample_compression_ratio(archive_file, codec)
+        if ratio > 1 - WIRE_MIN_SAVING:
+            cdebug(f"Archive does not compress ({int(100 * ratio)}% with {codec}), sending plain tar", debug)
+            return None, None, None
+    available = remote_commands(host, user, password, [name for name, _ in WIRE_DECOMPRESSORS[codec]], debug)
+    command = next((cmd for name, cmd in WIRE_DECOMPRESSORS[codec] if name in available), None)
+    if command is None:
+        if compress == 'auto':
+            cdebug(f"No {codec} decompressor on the FRITZ!Box, sending plain tar", debug)
+        else:
+            cwarning(f"No {codec} decompressor on the FRITZ!Box, sending plain tar")
+        return None, None, None
+    return codec, command, None
+
+class CompressingReader:
+    """Reader returning the compressed content of another reader (counting raw and compressed bytes)"""
+    def __init__(self, f, codec, level=None):
+        self.f = f
+        self.compressor = wire_compressor(codec, level)
+        self.raw_bytes = 0
+        self.wire_bytes = 0
+        self._done = False
+
+    def read(self, size=-1):
+        while not self._done:
+            data = self.f.read(size)
+            self.raw_bytes += len(data)
+            if data:
+                out = self.compressor.compress(data)
+            else:
+                out = self.compressor.flush()
+                self._done = True
+            if out:
+                self.wire_bytes += len(out)
+                return out
+        return b''
+
+
+# --- LINK CALIBRATION ---
+CALIBRATION_MAX_AGE = 30 * 24 * 3600  # seconds a cached box profile is used before it is measured again
+CALIBRATION_SECONDS = 0.5  # each measurement is grown until it takes about this long
+CALIBRATION_LINK_SIZE = 1024 * 1024  # first amount of data streamed to measure the link
+CALIBRATION_LINK_MAX = 32 * 1024 * 1024
+CALIBRATION_ROUNDS_MAX = 64  # decompressions of the sample in one measurement
+CALIBRATION_WRITE_SIZE = 4 * 1024 * 1024  # data written to the external storage
+CALIBRATION_MIN_GAIN = 0.05  # compression must be estimated this much faster than plain tar
+WIRE_GZIP_LEVELS = (1, WIRE_GZIP_LEVEL)  # gzip levels weighed by a calibrated 'auto'
+
+_link_profiles = {}  # host -> LinkProfile of the box
+
+class LinkProfile:
+    """
+    Transfer rates of a FRITZ!Box model, measured by calibrate_link() and
+    cached in CACHE_DIR per product ID and Freetz box type: SSH throughput,
+    decompression speed of each codec the box has, and write speed of the
+    external storage (bytes per second), plus the latency of a command and
+    the number of CPUs. estimate() models a streamed extraction from them.
+    """
+    VERSION = 1
+    FIELDS = ('time', 'latency', 'cpus', 'link', 'decompress', 'storage_dir', 'write')
+
+    def __init__(self, model):
+        self.model = model
+        self.time = time.time()
+        self.latency = 0.0
+        self.cpus = 1
+        self.link = None
+        self.decompress = {}  # codec -> bytes/s of decompressed data
+        self.storage_dir = None
+        self.write = None
+
+    @staticmethod
+    def model_of(config):
+        """Cache key of the box of a RouterConfig, None if its model is unknown"""
+        product = getattr(config, 'product_id', 'Unknown')
+        boxtype = getattr(config, 'freetz_info_boxtype', 'Unknown')
+        return None if product == boxtype == 'Unknown' else f"{product}/{boxtype}"
+
+    @staticmethod
+    def cache_file(model):
+        digest = hashlib.sha1(model.encode()).hexdigest()
+        return os.path.join(CACHE_DIR, f"link-{digest}.json")
+
+    @classmethod
+    def load(cls, model, debug=False):
+        """Return the cached profile of model, None if there is none or it is too old"""
+        try:
+            with open(cls.cache_file(model), encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('version') != cls.VERSION or data.get('model') != model:
+                return None
+            profile = cls(model)
+            for attr in cls.FIELDS:
+                setattr(profile, attr, data[attr])
+        except (OSError, ValueError, KeyError):
+            return None
+        if time.time() - profile.time > CALIBRATION_MAX_AGE:
+            cdebug(f"Link profile of {model} is out of date", debug)
+            return None
+        return profile
+
+    def save(self, debug=False):
+        """Write the profile to the cache"""
+        cache_file = self.cache_file(self.model)
+        try:
+            data = {'version': self.VERSION, 'model': self.model}
+            data.update((attr, getattr(self, attr)) for attr in self.FIELDS)
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            tmp = f"{cache_file}.{os.getpid()}-{threading.get_ident()}.tmp"
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(data, f)
+            os.replace(tmp, cache_file)
+        except OSError as e:
+            cdebug(f"Could not write link profile cache: {e}", debug)
+
+    def summary(self):
+        rates = [f"SSH {format_size(self.link)}/s"]
+        rates += [f"{codec} {format_size(rate)}/s" for codec, rate in sorted(self.decompress.items())]
+        if self.write:
+            rates.append(f"storage {format_size(self.write)}/s")
+        return f"{', '.join(rates)}, {self.cpus} CPU{'s' if self.cpus > 1 else ''}"
 
-def ssh_run(host, user, password, command, debug=False, capture_output=True, stdin_stream=None):
-    """Execute command on remote host via SSH, optionally passing a file-like stdin_stream"""
-    # Prepend PATH export to ensure Freetz-NG commands are found
-    # Use 'export PATH=...; command' to set PATH for the entire command execution
-    full_command = f"export PATH='{FREETZ_PATH}'; {command}"
-    cmd = ['ssh', '-o', 'StrictHostKeyChecking=no', f'{user}@{host}', full_command]
-    cmd_str = ' '.join(cmd)
-    cdebug(f"SSH: {cmd_str}", debug)
-    output = sshpass_exec(cmd, password, verbose=debug, capture_output=capture_output, stdin_stream=stdin_stream)
-    # Log command and output only in debug mode
-    if debug:
-        log_ssh_command(cmd_str, output if capture_output else "[output not captured]", debug)
-    return output
+    def estimate(self, ratio=1.0, local=float('inf'), codec=None, storage=False):
+        """
+        Estimated rate (archive bytes/s) of a streamed extraction compressed
+        to ratio at local bytes/s. The box deciphers and decompresses in
+        parallel when it has several CPUs, one after the other otherwise.
+        """
+        rate = self.link / ratio
+        if codec:
+            box = self.decompress[codec]
+            rate = min(rate, box) if self.cpus > 1 else 1 / (1 / rate + 1 / box)
+        rate = min(rate, local)
+        if storage and self.write:
+            rate = min(rate, self.write)
+        return rate
 
-def scp_send(host, user, password, local, remote, debug=False, dry_run=False):
-    """Copy file to remote host via SCP"""
-    # Use quiet mode and redirect all output to /dev/null to prevent progress display
-    cmd = ['scp', '-o', 'StrictHostKeyChecking=no', '-o', 'LogLevel=ERROR', '-q', local, f'{user}@{host}:{remote}']
-    cmd_str = ' '.join(cmd)
-    cdebug(f"SCP: {cmd_str}", debug)
-    
-    # Log SCP command only in debug mode
-    if debug:
-        log_ssh_command(cmd_str, f"Uploading {local} to {remote}", debug)
-    
-    # Execute SCP with silent=True to suppress all output
-    try:
-        # Check if remote file already exists and warn user in interactive mode
-        remote_exists = ssh_run(host, user, password, f"test -f '{remote}' && echo exists || echo notfound", debug=debug, capture_output=True).strip()
-        if remote_exists == "exists":
-            if not dry_run:
-                if sys.stdin.isatty():  # Interactive mode
-                    cwarning(f"Remote file already exists: {remote}")
-                    if not confirm(f"Overwrite remote file\n '{remote}'?\n This will delete the existing file and it is needed to continue.", default=False):
-                        cerror("Upload cancelled by user.")
-                        return None
-                # Delete remote file before upload
-                ssh_run(host, user, password, f"rm -f '{remote}'", debug=debug)
-            else:
-                cwarning(f"[DRY-RUN] Remote file '{remote}' already exists. Would delete before upload.")
+    def choose_codec(self, host, user, password, archive_file, target_dir=None, debug=False):
+        """The fastest estimated codec for archive_file, as returned by choose_wire_codec()"""
+        names = [name for codec in self.decompress for name, _ in WIRE_DECOMPRESSORS[codec]]
+        available = remote_commands(host, user, password, names, debug)
+        storage = bool(self.storage_dir and target_dir and target_dir.startswith(self.storage_dir))
+        plain = self.estimate(storage=storage)
+        estimates = [('plain', plain)]
+        best = (0, None, None, None)
+        for codec, decompress in self.decompress.items():
+            command = next((cmd for name, cmd in WIRE_DECOMPRESSORS[codec] if name in available), None)
+            if command is None or decompress <= max(best[0], plain * (1 + CALIBRATION_MIN_GAIN)):
+                continue  # slower than plain tar (or the best so far) whatever the archive
+            for level in WIRE_GZIP_LEVELS if codec == 'gzip' else (None,):
+                ratio, local = sample_compression(archive_file, codec, level)
+                rate = self.estimate(ratio, local, codec, storage)
+                estimates.append((f"{codec}{f' -{level}' if level else ''} ({int(100 * ratio)}%)", rate))
+                if rate > best[0]:
+                    best = (rate, codec, command, level)
+        cdebug("Estimated extraction rates: " +
+               ', '.join(f"{name} {format_size(rate)}/s" for name, rate in estimates), debug)
+        if best[0] > plain * (1 + CALIBRATION_MIN_GAIN):
+            return best[1:]
+        return None, None, None
 
-        output = sshpass_exec(cmd, password, verbose=False, capture_output=True, silent=True)
-        # Check if there were any error messages in output
-        if output and ('error' in output.lower() or 'failed' in output.lower() or 'permission denied' in output.lower()):
-            cdebug(f"SCP error detected in output: {output}", debug)
-            return False
-        return True
-    except Exception as e:
-        cdebug(f"SCP exception: {e}", debug)
-        return False
+@traced('calibration')
+def calibrate_link(host, user, password, model=None, sample_file=None, storage_dir=None, force=False,
+                   debug=False):
+    """
+    Make the link profile of the box available to choose_wire_codec():
+    read it from the cache (model, see LinkProfile.model_of()) or, with
+    force or without a valid cache entry, measure it. The link is measured
+    with random data streamed to 'cat', each decompressor of the box on a
+    sample of sample_file compressed locally, the storage with a 'dd' into
+    storage_dir followed by 'sync'. Returns the profile, None if the link
+    could not be measured.
+    """
+    profile = LinkProfile.load(model, debug) if model and not force else None
+    if profile:
+        cdebug(f"Link profile of {model}: {profile.summary()}", debug)
+        _link_profiles[host] = profile
+        return profile
+
+    cinfo("Calibrating the transfer to the FRITZ!Box...")
+    profile = LinkProfile(model)
+
+    def timed(command, data=None, latency=0.0):
+        """Seconds command takes (data on its stdin) beyond latency, None if it fails"""
+        start = time.perf_counter()
+        ssh_run(host, user, password, command, debug=debug, capture_output=True,
+                stdin_stream=None if data is None else io.BytesIO(data))
+        if last_exit_status() != 0:
+            return None
+        return max(time.perf_counter() - start - latency, 0.001)
+
+    def grown(measure, amount, limit):
+        """Run measure(amount), growing amount until it takes CALIBRATION_SECONDS / 2; return (amount, seconds)"""
+        while True:
+            seconds = measure(amount)
+            if seconds is None or seconds >= CALIBRATION_SECONDS / 2 or amount >= limit:
+                return amount, seconds
+            amount = min(limit, max(amount * 2, int(amount * CALIBRATION_SECONDS / seconds)))
+
+    # Latency of a command without and with input, taken off every measurement below
+    profile.latency = min(timed('true') or 0, timed('true') or 0)
+    stream_latency = min(timed('cat > /dev/null', b'') or 0, timed('cat > /dev/null', b'') or 0)
+    size, seconds = grown(lambda size: timed('cat > /dev/null', os.urandom(size), stream_latency),
+                          CALIBRATION_LINK_SIZE, CALIBRATION_LINK_MAX)
+    if seconds is None:
+        cwarning("Could not measure the transfer rate to the FRITZ!Box, using the default transfer settings")
+        return None
+    profile.link = size / seconds
+    cpus = ssh_run(host, user, password, "grep -c ^processor /proc/cpuinfo", debug=debug,
+                   capture_output=True).strip()
+    profile.cpus = int(cpus) if cpus.isdigit() and int(cpus) > 0 else 1
+
+    if sample_file:
+        raw = b''.join(wire_samples(sample_file))
+        names = [name for commands in WIRE_DECOMPRESSORS.values() for name, _ in commands]
+        available = remote_commands(host, user, password, names, debug)
+        for codec, commands in WIRE_DECOMPRESSORS.items():
+            command = next((cmd for name, cmd in commands if name in available), None)
+            comp = wire_compressor(codec)
+            sample = f"/tmp/sfu-calibrate.{codec}"
+            if command is None or timed(f"cat > {sample}", comp.compress(raw) + comp.flush()) is None:
+                continue
+            rounds, seconds = grown(
+                lambda rounds: timed(f"i=0; while [ $i -lt {rounds} ]; do {command} < {sample}; "
+                                     f"i=$((i + 1)); done > /dev/null", latency=profile.latency),
+                1, CALIBRATION_ROUNDS_MAX)
+            if seconds is not None:
+                profile.decompress[codec] = rounds * len(raw) / seconds
+
+    if storage_dir:
+        target = f"{storage_dir.rstrip('/')}/.sfu-calibrate"
+        blocks = CALIBRATION_WRITE_SIZE // UPLOAD_BLOCK
+        if timed(f"[ -d '{storage_dir}' ] && dd if=/dev/urandom of=/tmp/sfu-calibrate.bin "
+                 f"bs={UPLOAD_BLOCK} count={blocks} 2>/dev/null") is not None:
+            seconds = timed(f"dd if=/tmp/sfu-calibrate.bin of='{target}' bs={UPLOAD_BLOCK} 2>/dev/null && sync",
+                            latency=profile.latency)
+            if seconds is not None:
+                profile.storage_dir, profile.write = storage_dir, CALIBRATION_WRITE_SIZE / seconds
+    ssh_run(host, user, password, "rm -f /tmp/sfu-calibrate.*" + (f" '{target}'" if storage_dir else ''),
+            debug=debug)
+
+    cinfo(f"Transfer calibrated: {profile.summary()}")
+    TRACE.note(link=round(profile.link), decompress={c: round(r) for c, r in profile.decompress.items()},
+               write=profile.write and round(profile.write), cpus=profile.cpus)
+    if model:
+        profile.save(debug)
+    _link_profiles[host] = profile
+    return profile
 
 
 # --- FRITZ!Box CONFIGURATION FUNCTIONS ---
@@ -516,6 +2836,8 @@ class RouterConfig:
         self.ubi_size = 0
         self.ubi_available = 0
         self.storage_devices = []
+        self.external_dir_exists = None  # None: not probed
+        self.external_dir_size = None
         
     def __repr__(self):
         return (f"RouterConfig(external_dir={self.external_dir}, "
@@ -577,21 +2899,106 @@ def parse_df_output(df_text):
     
     return ubi_info, storage
 
-def read_device_config(host, user, password, debug=False, summary=False):
-    """Read and parse FRITZ!Box configuration"""
+# Device probes: (section name, remote command). Each one is run in its own
+# subshell by the batched probe, so a failing section cannot affect the others.
+PROBE_SECTIONS = [
+    ('modcfg', "cat /mod/etc/conf/mod.cfg 2>/dev/null"),
+    ('df', "df -h"),
+    ('freetz_info', "cat /etc/freetz_info.cfg 2>/dev/null || echo 'Unknown'"),
+    ('uname', "uname -r 2>/dev/null || echo 'Unknown'"),
+    ('urlader', "cat /proc/sys/urlader/environment 2>/dev/null || echo 'Unknown'"),
+    ('free', "free"),
+    ('jffs2', "grep jffs2 /proc/mtd"),
+    ('external', "[ -r /mod/etc/conf/mod.cfg ] && . /mod/etc/conf/mod.cfg; d=\"${MOD_EXTERNAL_DIRECTORY:-%s}\"; "
+                 "test -d \"$d\" && du -sk \"$d\" 2>/dev/null | awk '{print $1}' || echo notfound" % DEFAULT_EXTERNAL_BASE),
+]
+PROBE_COMMANDS = dict(PROBE_SECTIONS)
+PROBE_MARKER = '@@FREETZ-PROBE'
+
+def build_probe_script(sections=PROBE_SECTIONS):
+    """Build one remote script that emits every probe as a delimited section"""
+    script = []
+    for name, command in sections:
+        script.append(f"echo '{PROBE_MARKER}-BEGIN {name}@@'; ( {command} ) </dev/null; "
+                      f"rc=$?; echo; echo \"{PROBE_MARKER}-END {name} $rc@@\"")
+    return '; '.join(script)
+
+def parse_probe_output(output, debug=False):
+    """
+    Split the output of build_probe_script() into {section name: text}.
+    Sections that are missing (e.g. truncated output) are simply absent.
+    """
+    sections = {}
+    name, lines = None, []
+    for line in output.splitlines():
+        match = re.match(rf'^{PROBE_MARKER}-(BEGIN|END) (\w+)(?: (\d+))?@@$', line.strip())
+        if not match:
+            if name is not None:
+                lines.append(line)
+            continue
+        if match.group(1) == 'BEGIN':
+            name, lines = match.group(2), []
+        elif name == match.group(2):
+            if lines and not lines[-1].strip():
+                lines.pop()  # drop the newline added before the end marker
+            sections[name] = '\n'.join(lines)
+            if match.group(3) != '0':
+                cdebug(f"Probe section '{name}' exited with code {match.group(3)}", debug)
+            name = None
+    return sections
+
+def remote_dir_size(host, user, password, path, debug=False):
+    """Return the disk usage of a remote directory (format_size()), or None if it does not exist"""
+    served, info = agent_call(host, user, password, 'stat', path, debug=debug)
+    if served:
+        kbytes = agent_call(host, user, password, 'du', path, debug=debug)[1] if info and info[0] == 'd' else None
+    else:
+        output = ssh_run(host, user, password,
+                         f"test -d '{path}' && du -sk '{path}' 2>/dev/null | awk '{{print $1}}' || echo notfound",
+                         debug=debug, capture_output=True).strip()
+        kbytes = int(output) if output.isdigit() else None
+    return None if kbytes is None else format_size(kbytes * 1024)
+
+@traced('read config')
+def read_device_config(host, user, password, debug=False, summary=False, batch=True):
+    """
+    Read and parse FRITZ!Box configuration.
+
+    With batch=True all PROBE_SECTIONS are collected with a single SSH
+    command; a section missing from the batched output is run on its own.
+    """
     config = RouterConfig()
-    
+    probe = {}
+
+    def probe_run(name):
+        """Return the output of a probe section, running it on its own if not already collected"""
+        if name in probe:
+            return probe[name]
+        if name == 'df':
+            served, output = agent_call(host, user, password, 'df', debug=debug)
+            if served:
+                return output
+        return ssh_run(host, user, password, PROBE_COMMANDS[name], debug=debug, capture_output=True)
+
+    if summary and batch:
+        probe = parse_probe_output(ssh_run(host, user, password, build_probe_script(), debug=debug, capture_output=True), debug)
+
     if not summary:
         # Step 1: Read mod.cfg
         cinfo("Step 1: Reading Freetz-NG configuration (/mod/etc/conf/mod.cfg)")
+        TRACE.step('mod.cfg')
 
         # Try to connect, retrying every 2 seconds if 'No route to host' is detected
         start_time = time.time()
         no_route_first = True
         while True:
-            mod_cfg_output = ssh_run(host, user, password, 
-                                    "cat /mod/etc/conf/mod.cfg 2>/dev/null",
-                                    debug=debug, capture_output=True)
+            if batch:
+                probe_output = ssh_run(host, user, password, build_probe_script(), debug=debug, capture_output=True)
+                probe = parse_probe_output(probe_output, debug)
+                # Without any section, the output holds the connection error (if any)
+                mod_cfg_output = probe_run('modcfg') if probe else probe_output
+            else:
+                mod_cfg_output = probe_run('modcfg')
             if (
                 mod_cfg_output and "Connection refused" in mod_cfg_output
             ) or (
@@ -609,9 +3016,9 @@ def read_device_config(host, user, password, debug=False, summary=False):
                     cerror(f"No connection to {host} (port 22: No route to host)")
                     no_route_first = False
                 else:
-                    print(".", end='', flush=True)
-                if elapsed > BOOT_WAIT_MAX_TRIES * 2:
-                    cerror(f"Could not connect to {host} after {BOOT_WAIT_MAX_TRIES * 2 / 60} minutes. Aborting.")
+                    cprint('.', end='')
+                if elapsed > BOOT_WAIT_TIMEOUT:
+                    cerror(f"Could not connect to {host} after {BOOT_WAIT_TIMEOUT / 60} minutes. Aborting.")
                     return None
                 time.sleep(2)
                 continue
@@ -658,7 +3065,8 @@ def read_device_config(host, user, password, debug=False, summary=False):
         # Step 2: Read storage information (df -h)
         cprint("")
         cinfo("Step 2: Detecting storage devices")
-        df_output = ssh_run(host, user, password, "df -h", debug=debug, capture_output=True)
+        TRACE.step('storage')
+        df_output = probe_run('df')
 
         if df_output:
             ubi_info, storage_devices = parse_df_output(df_output)
@@ -692,11 +3100,10 @@ def read_device_config(host, user, password, debug=False, summary=False):
         # Step 3: Additional FRITZ!Box information
         cprint("")
         cinfo("Step 3: Gathering additional current system information (/etc/freetz_info.cfg):")
+        TRACE.step('system information')
 
     # Get Freetz data
-    freetz_data = ssh_run(host, user, password, 
-                            "cat /etc/freetz_info.cfg 2>/dev/null || echo 'Unknown'",
-                            debug=debug, capture_output=True).strip()
+    freetz_data = probe_run('freetz_info').strip()
 
     # Extract variables from freetz_data
     config.freetz_info_boxtype = 'Unknown'
@@ -720,14 +3127,10 @@ def read_device_config(host, user, password, debug=False, summary=False):
         cprint(f"  Image name:   {config.freetz_info_image_name}", 'cyan')
 
     # Get Freetz version
-    kernel_version = ssh_run(host, user, password, 
-                            "uname -r 2>/dev/null || echo 'Unknown'",
-                            debug=debug, capture_output=True).strip()
+    kernel_version = probe_run('uname').strip()
     
     # Get urlader environment variables
-    urlader_env = ssh_run(host, user, password,
-                         "cat /proc/sys/urlader/environment 2>/dev/null || echo 'Unknown'",
-                         debug=debug, capture_output=True).strip()
+    urlader_env = probe_run('urlader').strip()
     
     # Parse urlader environment
     if urlader_env != 'Unknown':
@@ -787,7 +3190,7 @@ def read_device_config(host, user, password, debug=False, summary=False):
         cprint(f"  Kernel:       {kernel_version}", 'cyan')
 
     # Get RAM info
-    ram_output = ssh_run(host, user, password, "free", debug=debug, capture_output=True)
+    ram_output = probe_run('free')
     ram_line = None
     config.ram_total = None
     for line in ram_output.splitlines():
@@ -801,7 +3204,7 @@ def read_device_config(host, user, password, debug=False, summary=False):
     else:
         cprint("FRITZ!Box RAM info not available", 'yellow', 'warning')
     # Get JFFS2 info
-    config.jffs2_output = ssh_run(host, user, password, "grep jffs2 /proc/mtd", debug=debug, capture_output=True)
+    config.jffs2_output = probe_run('jffs2')
     if config.jffs2_output.strip():
         cprint("  JFFS2 partition detected:", 'cyan')
         for line in config.jffs2_output.splitlines():
@@ -809,6 +3212,12 @@ def read_device_config(host, user, password, debug=False, summary=False):
     else:
         cprint("  No JFFS2 partition detected", 'cyan')
 
+    # State of the configured external directory (only known from the batched probe)
+    if 'external' in probe and not summary:
+        ext_size = probe['external'].strip()
+        config.external_dir_exists = ext_size != 'notfound'
+        config.external_dir_size = format_size(int(ext_size) * 1024) if ext_size.isdigit() else None
+
     return config
 
 # --- UPDATE PROCESS FUNCTIONS ---
@@ -825,8 +3234,14 @@ def detect_external_dir(host, user, password, debug=False):
             return match.group(1)
     return DEFAULT_EXTERNAL_BASE
 
-def upload_file_with_progress(host, user, password, local_file, remote_dir, debug=False, dry_run=False):
-    """Upload file to FRITZ!Box with progress indication"""
+@traced('upload')
+def upload_file_with_progress(host, user, password, local_file, remote_dir, debug=False, dry_run=False,
+                              streams=PARALLEL_STREAMS_MAX):
+    """
+    Upload file to FRITZ!Box with progress indication. Files from
+    PARALLEL_UPLOAD_MIN on are sent over up to streams concurrent SSH
+    connections (see parallel_upload_async()); streams=1 sends one stream.
+    """
     filename = os.path.basename(local_file)
     filesize = get_file_size(local_file)
     remote_path = f"{remote_dir}/{filename}"
@@ -841,87 +3256,38 @@ def upload_file_with_progress(host, user, password, local_file, remote_dir, debu
         cwarning("[DRY-RUN] Skipping file upload")
         return remote_path
     
-    # Check if remote file already exists and warn user in interactive mode
-    remote_exists = ssh_run(host, user, password, f"test -f '{remote_path}' && echo exists || echo notfound", debug=debug, capture_output=True).strip()
-    if remote_exists == "exists":
-        if not dry_run:
-            if sys.stdin.isatty():  # Interactive mode
-                cwarning(f"Remote file already exists: {remote_path}")
-                if not confirm(f"Overwrite remote file '{remote_path}'? This will delete the existing file.", default=False):
-                    cerror("Upload cancelled by user.")
-                    return None
-            # Delete remote file before upload
-            ssh_run(host, user, password, f"rm -f '{remote_path}'", debug=debug)
-        else:
-            cwarning(f"[DRY-RUN] Remote file '{remote_path}' already exists. Would delete before upload.")
+    # An existing remote file is resumed if it is the beginning of this one
+    offset = check_remote_file(host, user, password, local_file, remote_path, debug=debug)
+    if offset is None:
+        return None
+    if offset == filesize:
+        cprint(f"{EMOJI['ok']} Upload complete", 'green')
+        return remote_path
+    TRACE.note(bytes=filesize - offset, offset=offset)
 
-    # For large files, show progress with monitoring thread
-    if filesize > 10 * 1024 * 1024:  # > 10MB
+    # For large files (or a resume), show progress counted on the sending side
+    if filesize > 10 * 1024 * 1024 or offset:  # > 10MB
         cinfo("Upload in progress (this may take several minutes)...")
-        # Progress monitoring thread
-        upload_done = threading.Event()
         start_time = time.time()
-        def monitor_progress():
-            """Monitor upload progress by checking remote file size"""
-            last_size = 0
-            shown_progress = False
-            while not upload_done.is_set():
-                try:
-                    # Check remote file size
-                    result = ssh_run(host, user, password, 
-                                   f"ls -l {remote_path} 2>/dev/null | awk '{{print $5}}'",
-                                   debug=False, capture_output=True)
-                    if result and result.strip().isdigit():
-                        current_size = int(result.strip())
-                        if current_size > 0 and current_size > last_size:
-                            last_size = current_size
-                            elapsed = time.time() - start_time
-                            speed = current_size / elapsed if elapsed > 0 else 0
-                            percent = int(100 * current_size / filesize)
-                            eta = int((filesize - current_size) / speed) if speed > 0 else 0
-                            # Clear line and show progress
-                            print(f"\r   Progress: {percent}% | {format_size(current_size)}/{format_size(filesize)} | "
-                                  f"{format_size(speed)}/s | ETA: {eta}s     ", end='', flush=True)
-                            shown_progress = True
-                except:
-                    pass
-                time.sleep(1)  # Update every second
-            # If we never showed progress, it means upload was too fast or failed
-            if not shown_progress:
-                time.sleep(0.1)  # Give SCP time to complete
-        # Start monitoring thread
-        monitor_thread = threading.Thread(target=monitor_progress, daemon=True)
-        monitor_thread.start()
-        # Perform upload
-        success = scp_send(host, user, password, local_file, remote_path, debug=debug, dry_run=dry_run)
-        upload_done.set()
-        monitor_thread.join(timeout=1)
-        # Verify upload completed successfully
-        elapsed = time.time() - start_time
-        verify_result = ssh_run(host, user, password,
-                               f"ls -l {remote_path} 2>/dev/null | awk '{{print $5}}'",
-                               debug=debug, capture_output=True)
-        if verify_result and verify_result.strip().isdigit():
-            uploaded_size = int(verify_result.strip())
-            if uploaded_size == filesize:
-                speed = filesize / elapsed if elapsed > 0 else 0
-                print(f"\r   Progress: 100% | {format_size(filesize)}/{format_size(filesize)} | "
-                      f"{format_size(speed)}/s | Completed in {int(elapsed)}s     ")
-                success = True
+        # Progress is counted from the bytes pushed into the transport
+        parallel = streams > 1 and filesize - offset >= PARALLEL_UPLOAD_MIN and remote_commands(
+            host, user, password, ['dd'], debug)
+        with PROGRESS.task('Upload', filesize, offset) as task:
+            if parallel:
+                success = asyncio.run(parallel_upload_async(host, user, password, local_file, remote_path,
+                                                            offset=offset, debug=debug, progress=task.update,
+                                                            max_streams=streams))
             else:
-                print(f"\r  Upload incomplete: {format_size(uploaded_size)}/{format_size(filesize)}     ")
-                success = False
-        else:
-            # Could not verify - assume success if scp_send returned True
-            if success:
-                speed = filesize / elapsed if elapsed > 0 else 0
-                print(f"\r   Progress: 100% | {format_size(filesize)}/{format_size(filesize)} | "
-                      f"{format_size(speed)}/s | Completed in {int(elapsed)}s     ")
-    else:
-        # Small files: simple upload
-        start_time = time.time()
-        success = scp_send(host, user, password, local_file, remote_path, debug=debug, dry_run=dry_run)
+                success = resumable_upload(host, user, password, local_file, remote_path, offset=offset,
+                                           debug=debug, progress=task.update)
         elapsed = time.time() - start_time
+        if success:
+            speed = (filesize - offset) / elapsed if elapsed > 0 else 0
+            cprint(f"   Progress: 100% | {format_size(filesize)}/{format_size(filesize)} | "
+                   f"{format_size(speed)}/s | Completed in {int(elapsed)}s (checksum verified)")
+    else:
+        # Small files: one verified stream without progress (the remote file was checked above)
+        success = resumable_upload(host, user, password, local_file, remote_path, debug=debug)
     
     if success:
         cprint(f"{EMOJI['ok']} Upload complete", 'green')
@@ -930,70 +3296,93 @@ def upload_file_with_progress(host, user, password, local_file, remote_dir, debu
         cerror("Upload failed!")
         return None
 
-def extract_archive_with_progress(host, user, password, archive_file, target_dir, log_file, debug=False):
+@traced('extraction')
+def extract_archive_with_progress(host, user, password, archive_file, target_dir, log_file, debug=False,
+                                  verbose_log=False, compress='none', files=None):
     """
     Extract a tar archive to a target directory on FRITZ!Box, showing progress.
     Used by both firmware_update_process and external_update_process.
+
+    Progress is computed locally from the tar headers passing through the
+    stream. On the box, tar only writes its errors to log_file, which is
+    removed after a successful extraction; verbose_log keeps a full
+    'tar -v' listing there instead. compress selects the on-the-wire
+    compression (see choose_wire_codec()). files is the member count of
+    archive_file, if already known.
+
+    The tar stream is hashed on both sides while it passes (see
+    upload_digest()): the box hashes a copy of it, taken after the
+    decompression through a fifo, so a transfer that arrived damaged
+    fails the extraction before anything runs the extracted files.
     """
-    ssh_run(host, user, password, f"rm -rf {log_file}", debug=debug)
-    tar_count = count_tar_files(archive_file)
-    extract_cmd = f"mkdir -p {target_dir} && tar -C {target_dir} -xvf - > {log_file} 2>&1; echo $? > /tmp/var-tar.code"
+    tar_count = count_tar_files(archive_file) if files is None else files
+    tar_size = get_file_size(archive_file)
+    codec, decompress, level = choose_wire_codec(host, user, password, archive_file, compress, debug, target_dir)
+    digest_command, algorithm = upload_digest(host, user, password, debug)
+    if digest_command and not remote_commands(host, user, password, ['mkfifo'], debug):
+        digest_command = algorithm = None
+    pipe = f"{decompress} | " if codec else ''
+    fifo = '/tmp/.extract-digest.$$'
+    if digest_command:
+        # A failing tee leaves the fifo unopened: ':' opens it once so that the digest command ends
+        extract_cmd = (f"rm -f {log_file} {fifo}; mkfifo {fifo} || exit 1; {digest_command} < {fifo} & "
+                       f"{{ mkdir -p {target_dir} && {pipe}tee {fifo} | tar -C {target_dir} -x{'v' if verbose_log else ''}f - ; }} "
+                       f"> {log_file} 2>&1; rc=$?; : <> {fifo}; wait; rm -f {fifo}; ")
+    else:
+        extract_cmd = (f"rm -f {log_file}; {{ mkdir -p {target_dir} && {pipe}tar -C {target_dir} -x{'v' if verbose_log else ''}f - ; }} "
+                       f"> {log_file} 2>&1; rc=$?; ")
+    extract_cmd += f"{'' if verbose_log else f'[ $rc -eq 0 ] && rm -f {log_file}; '}exit $rc"
     cdebug(f"Extracting {tar_count} files to {target_dir}", debug)
 
-    extract_done = threading.Event()
     start_time = time.time()
 
-    def monitor_extraction():
-        last_count = 0
-        while not extract_done.is_set():
-            try:
-                result = ssh_run(host, user, password,
-                                 f"grep -v '/$' {log_file} 2>/dev/null | wc -l || echo 0",  # only count files
-                                 debug=False, capture_output=True)
-                if result and result.strip().isdigit():
-                    current_count = int(result.strip())
-                    if current_count > last_count:
-                        last_count = current_count
-                        percent = min(99, int(100 * current_count / tar_count)) if tar_count > 0 else 0
-                        print(f"\r   Extraction progress: {percent}% | {current_count}/{tar_count} files extracted     ",
-                              end='', flush=True)
-            except:
-                pass
-            time.sleep(1)
-
-    monitor_thread = threading.Thread(target=monitor_extraction, daemon=True)
-    monitor_thread.start()
-
-    with open(archive_file, 'rb') as f:
-        ssh_run(host, user, password, extract_cmd, debug=debug, capture_output=False, stdin_stream=f)
-    extract_done.set()
-    monitor_thread.join(timeout=1)
+    if codec:
+        cinfo(f"Streaming archive with {codec}{f' -{level}' if level else ''} compression")
+    with open(archive_file, 'rb') as f, PROGRESS.task('Extraction', tar_size) as task:
+        stream = TarProgressReader(f, lambda sent, members: task.update(sent, f"{members}/{tar_count} files"))
+        if algorithm:
+            stream = hashed = HashingReader(stream, algorithm)
+        if codec:
+            stream = CompressingReader(stream, codec, level)
+        output = ssh_run(host, user, password, extract_cmd, debug=debug, capture_output=True, stdin_stream=stream)
+    ret_code = last_exit_status()
+    TRACE.note(bytes=tar_size, wire_bytes=stream.wire_bytes if codec else tar_size, files=tar_count,
+               codec=codec or 'none', status=ret_code)
 
     elapsed = int(time.time() - start_time)
 
     # Check extraction return code
-    ret_code = ssh_run(host, user, password, f"cat /tmp/var-tar.code", debug=debug, capture_output=True).strip()
-    if not ret_code.isdigit() or int(ret_code) != 0:
-        cprint("")
+    if ret_code != 0:
         cerror(f"Archive extraction failed with code {ret_code}")
         cprint(f"Last 10 lines of extraction log:", 'red', 'warning')
         log_tail = ssh_run(host, user, password, f"tail -n 10 {log_file}", debug=debug, capture_output=True)
         print(log_tail)
         return False
+    if algorithm and not check_upload_digest(output, ret_code, hashed, target_dir, debug):
+        cerror("The archive arrived damaged: do not run or reboot into the extracted files")
+        return False
 
-    print(f"\r   Extraction progress: 100% | {tar_count}/{tar_count} files extracted in {elapsed}s     ")
+    cprint(f"   Extraction progress: 100% | {tar_count}/{tar_count} files extracted in {elapsed}s"
+           f"{' (checksum verified)' if algorithm else ''}")
+    if codec and stream.raw_bytes:
+        seconds = max(time.time() - start_time, 0.001)
+        cprint(f"   Sent {format_size(stream.wire_bytes)} for {format_size(stream.raw_bytes)} "
+               f"({int(100 * stream.wire_bytes / stream.raw_bytes)}% with {codec}), "
+               f"{format_size(stream.wire_bytes / seconds)}/s on the wire, "
+               f"{format_size(stream.raw_bytes / seconds)}/s effective", 'cyan')
     cprint(f"{EMOJI['ok']} Extraction complete.", 'green')
     if target_dir != '/':
-        ext_size = ssh_run(host, user, password, f"du -sh '{target_dir}' 2>/dev/null | awk '{{print $1}}'", debug=debug, capture_output=True).strip()
+        ext_size = remote_dir_size(host, user, password, target_dir, debug=debug)
         cprint(f"   Size of the external directory: {ext_size}", 'cyan')
 
     return True
 
+@traced('firmware update')
 def firmware_update_process(host, user, password, image_file,
                            stop_services='semistop_avm', no_reboot=False,
                            reboot_at_the_end=False,
                            delete_jffs2=False, downgrade=False,
-                           debug=False, dry_run=False):
+                           debug=False, dry_run=False, extract_log=False, compress='none', web_port=None):
     """Execute firmware update process (emulates do_update_handler.sh)"""
     cprint("\n" + "="*60, 'bold')
     cprint("FIRMWARE UPDATE PROCESS", 'bold', 'install')
@@ -1007,6 +3396,7 @@ def firmware_update_process(host, user, password, image_file,
     # Step 0: Prepare downgrade (if requested)
     if downgrade:
         cinfo("Step 0: Preparing downgrade...")
+        TRACE.step('prepare downgrade')
         downgrade_output = ssh_run(host, user, password, "/usr/bin/prepare-downgrade", debug=debug, capture_output=True)
         if downgrade_output:
             cprint(downgrade_output)
@@ -1016,6 +3406,7 @@ def firmware_update_process(host, user, password, image_file,
     if stop_services == 'noaction':
         cwarning(f"Firmware not installed ({stop_services})")
         return True
+    TRACE.step('stop services', mode=stop_services)
     if stop_services == 'stop_avm':
         cinfo(f"Step 1: Stopping AVM services ({stop_services}). Please wait...")
         ssh_run(host, user, password, "prepare_fwupgrade start", debug=debug)
@@ -1034,18 +3425,21 @@ def firmware_update_process(host, user, password, image_file,
 
     # Step 2: Extract FRITZ!Box firmware archive
     cinfo("Step 2: Extracting firmware archive to the tmpfs of FRITZ!Box. Please wait...")
+    TRACE.step('extract firmware')
     if not extract_archive_with_progress(
         host, user, password,
         archive_file=image_file,
         target_dir="/",
         log_file="/tmp/fw_extract.log",
-        debug=debug
+        debug=debug,
+        verbose_log=extract_log,
+        compress=compress
     ):
         return False
     
     # Step 3: Execute firmware installation script
-    inst_exists = ssh_run(host, user, password, f"test -f /var/install -a -x /var/install && echo ok || echo notfound", debug=debug, capture_output=True).strip()
-    if inst_exists != "ok":
+    TRACE.step('/var/install')
+    if not remote_test(host, user, password, '-f', '/var/install', '-a', '-x', '/var/install', debug=debug):
         cerror("Installation file does not exist.")
         return False
 
@@ -1096,17 +3490,14 @@ def firmware_update_process(host, user, password, image_file,
     }
     
     result_txt, color = result_codes.get(exit_code, ("UNKNOWN_ERROR", "red"))
+    TRACE.note(status=exit_code, result=result_txt)
     cprint(f"Installation result: {exit_code} ({result_txt})", color, 'info' if color == 'green' else 'warning')
     
     # Step 4: Verify post_install if exists
     if exit_code == 1:
         cinfo("Step 4: Verifying post-installation script...")
-        post_install_exists = ssh_run(
-            host, user, password, 
-            "test -f /var/post_install && echo exists || echo notfound",
-            debug=debug, capture_output=True
-        ).strip()
-        if post_install_exists == "exists":
+        TRACE.step('post_install check')
+        if remote_test(host, user, password, '-f', '/var/post_install', debug=debug):
             cprint(f"{EMOJI['ok']} Post-installation script found: /var/post_install", 'green')
         else:
             error("No post-installation script found")
@@ -1123,14 +3514,18 @@ def firmware_update_process(host, user, password, image_file,
         cprint("\n" + "="*60, 'bold')
         cprint("REBOOTING FRITZ!Box", 'bold', 'reboot')
         cprint("="*60 + "\n", 'bold')
+        TRACE.step('reboot')
         ssh_run(host, user, password, REBOOT_CMD, capture_output=False, debug=debug)
+        AGENTS.close(host, user)
+        SESSIONS.close(host, user, debug)
 
-        if not wait_router_boot(host, password, user, debug=debug):
+        if not wait_router_boot(host, password, user, debug=debug, web_port=web_port):
             cerror("Router did not come back online in time after reboot!")
             return False
 
         # Read again FRITZ!Box configuration
         cinfo("Gathering system information after reboot:")
+        TRACE.step('read config after reboot')
         router_config = read_device_config(host, user, password, debug, summary=True)
         if router_config is None:
             cerror("Cannot read Freetz-NG configuration!")
@@ -1149,11 +3544,174 @@ def firmware_update_process(host, user, password, image_file,
         print(log_tail)
         return False
 
+def member_path(name):
+    """Normalize a tar member or find path ('./a/b/' -> 'a/b')"""
+    while name.startswith('./'):
+        name = name[2:]
+    return name.rstrip('/') if name != '.' else ''
+
+def member_kind(tar_type):
+    """Map a tar member type to the kind of manifest entry: d, l, f or other"""
+    if tar_type == '5':
+        return 'd'
+    if tar_type == '2':
+        return 'l'
+    if tar_type in ('0', '\x00', '', '1', '7'):  # hard links are regular files on the box
+        return 'f'
+    return 'o'
+
+def manifest_kind(value):
+    """Kind of a remote_manifest() entry: d, l or f"""
+    return 'd' if value == 'd' else 'l' if value.startswith('l:') else 'f'
+
+def remote_manifest(host, user, password, directory, debug=False):
+    """
+    Return {path: entry} for a directory on the box, read in one SSH call:
+    'd' for directories, 'l:target' for symlinks, the md5 of regular files.
+    Returns None if the directory cannot be read.
+    """
+    served, output = agent_call(host, user, password, 'manifest', directory, debug=debug)
+    if not served:
+        output = ssh_run(host, user, password, f"cd '{directory}' || exit 1; {MANIFEST_LISTING}",
+                         debug=debug, capture_output=True)
+        if last_exit_status() != 0:
+            return None
+    if output is None:
+        return None
+    manifest = {}
+    for line in output.splitlines():
+        if line.startswith('d '):
+            kind, path = 'd', line[2:]
+        elif line.startswith('l ') and '\t' in line:
+            path, target = line[2:].split('\t', 1)
+            kind = f"l:{target}"
+        elif len(line) > 34 and line[32:34] == '  ':
+            kind, path = line[:32], line[34:]
+        else:
+            continue
+        path = member_path(path)
+        if path:
+            manifest[path] = kind
+    return manifest
+
+def plan_external_delta(index, manifest, delete_stale=True):
+    """
+    Compare an external archive with the manifest of its installed directory.
+    Returns (members to send, paths to replace, stale paths): new and changed
+    files and links and missing directories; installed paths whose type
+    changed, which must be removed before the extraction; and installed
+    paths missing from the archive, removed once the extraction succeeded.
+    """
+    digests = {member_path(name): md5 for name, md5 in index.file_digests().items()}
+    archive = {}
+    for name, _, _, _, tar_type in index.members:
+        path = member_path(name)
+        if path:
+            archive[path] = member_kind(tar_type)
+    parents = {path.rsplit('/', i)[0] for path in archive for i in range(1, path.count('/') + 1)}
+    replace, stale = [], []
+    for path, entry in manifest.items():
+        if path == '.external':
+            continue
+        wanted = archive.get(path)
+        if wanted is None:
+            if delete_stale and path not in parents:  # not holding members extracted before the deletion
+                stale.append(path)
+        elif wanted != 'o' and wanted != manifest_kind(entry):
+            replace.append(path)
+    deleted = set(replace)
+    send = set()
+    for name, _, _, _, tar_type in index.members:
+        path = member_path(name)
+        if not path:
+            continue
+        kind = archive[path]
+        if path in deleted or path not in manifest or kind == 'o':
+            send.add(name)
+        elif kind != 'd' and manifest[path] != digests.get(path):
+            send.add(name)
+    return send, sorted(replace), sorted(stale)
+
+def write_delta_tar(archive_file, names, target):
+    """Write the members of archive_file listed in names to a new tar file; return the member count"""
+    count = 0
+    with tarfile.open(archive_file, 'r:*') as src, \
+         tarfile.open(target, 'w', format=tarfile.GNU_FORMAT) as out:
+        for member in src:
+            if member.name in names:
+                out.addfile(member, src.extractfile(member) if member.isfile() else None)
+                count += 0 if member.isdir() else 1
+    return count
+
+def external_delta_update(host, user, password, external_file, external_dir, delete_stale=True,
+                          debug=False, extract_log=False, compress='none'):
+    """
+    Update an installed external directory in place: only new and changed
+    files are sent and stale ones deleted, based on the md5 manifest of the
+    directory on the box. Stale files are only deleted once the changes
+    are extracted, so a failed transfer leaves the old files in place.
+    Returns None if no delta is possible (the caller then does a full
+    extraction), else True/False.
+    """
+    start_time = time.time()
+    manifest = remote_manifest(host, user, password, external_dir, debug)
+    if manifest is None:
+        cwarning(f"Cannot read the content of '{external_dir}', doing a full extraction")
+        return None
+    index = ArchiveIndex.load(external_file, debug)
+    send, replace, stale = plan_external_delta(index, manifest, delete_stale)
+    changed = sum(1 for name, _, _, _, tar_type in index.members if name in send and tar_type != '5')
+    cprint(f"   {len(manifest)} installed, {len(index.members)} in archive: {changed} files and "
+           f"{len(send) - changed} directories to send, {len(stale)} to delete "
+           f"({time.time() - start_time:.1f}s)", 'cyan')
+
+    def remove(paths, what):
+        ssh_run(host, user, password, f"cd '{external_dir}' && xargs -0 rm -rf --", debug=debug,
+                capture_output=True, stdin_stream=io.BytesIO(b''.join(f"./{p}\0".encode() for p in paths)))
+        if last_exit_status() != 0:
+            cerror(f"Could not delete {what} in '{external_dir}'")
+            return False
+        cdebug(f"Deleted: {', '.join(paths)}", debug)
+        return True
+
+    if send:
+        # A path whose type changed (e.g. a file becoming a directory) is in the way of tar
+        if replace and not remove(replace, "the paths whose type changed"):
+            return False
+        with tempfile.TemporaryDirectory(prefix='freetz-delta-') as tmp:
+            delta_file = os.path.join(tmp, 'delta.tar')
+            files = write_delta_tar(external_file, send, delta_file)
+            cdebug(f"Delta archive: {files} files, {format_size(get_file_size(delta_file))} "
+                   f"of {format_size(get_file_size(external_file))}", debug)
+            if not extract_archive_with_progress(
+                host, user, password,
+                archive_file=delta_file,
+                target_dir=external_dir,
+                log_file="/tmp/ext_extract.log",
+                debug=debug,
+                verbose_log=extract_log,
+                compress=compress,
+                files=files
+            ):
+                cwarning(f"Stale files were not deleted, '{external_dir}' keeps its old files")
+                return False
+    if stale and not remove(stale, "stale files"):
+        return False
+    if not send:
+        cprint(f"{EMOJI['ok']} External directory already up to date", 'green')
+    return True
+
+@traced('external update')
 def external_update_process(host, user, password, external_file, external_dir,
                             preserve_old=False, restart_services=True,
                             reboot_at_the_end=False,
-                            debug=False, dry_run=False):
-    """Execute external update process (emulates do_external_handler.sh)"""
+                            debug=False, dry_run=False, extract_log=False, compress='none',
+                            delta=False, staged_dir=None):
+    """
+    Execute external update process (emulates do_external_handler.sh).
+    With staged_dir (see ExternalStaging), the archive is already extracted
+    there and only swapped into place.
+    """
     cprint("\n" + "="*60, 'bold')
     cprint("EXTERNAL UPDATE PROCESS", 'bold', 'external')
     cprint("="*60 + "\n", 'bold')
@@ -1166,12 +3724,15 @@ def external_update_process(host, user, password, external_file, external_dir,
     cprint(f"Installation directory: {external_dir}", 'cyan', 'info')
 
     # Check if external_dir exists and contains .external marker
-    dir_exists = ssh_run(host, user, password, f"test -d '{external_dir}' && echo exists || echo notfound", debug=debug, capture_output=True).strip()
-    if dir_exists == "exists":
-        marker_exists = ssh_run(host, user, password, f"test -e '{external_dir}/.external' && echo exists || echo notfound", debug=debug, capture_output=True).strip()
-        if marker_exists != "exists":
+    if remote_test(host, user, password, '-d', external_dir, debug=debug):
+        if not remote_test(host, user, password, '-e', f"{external_dir}/.external", debug=debug):
             cerror(f"External directory '{external_dir}' exists but is missing the .external marker file!")
+            if staged_dir:
+                ssh_run(host, user, password, f"rm -rf '{staged_dir}'", debug=debug)
             return False
+    elif delta:
+        cinfo("External directory not installed yet, the delta update is replaced by a full extraction")
+        delta = False
     
     if dry_run:
         cprint("")
@@ -1179,6 +3740,7 @@ def external_update_process(host, user, password, external_file, external_dir,
         return True
     
     # Step 1: Stop external services
+    TRACE.step('stop services')
     if restart_services:
         cinfo("Step 1: Stopping external services")
         status = ssh_run(host, user, password, "/mod/etc/init.d/rc.external status 2>/dev/null", debug=debug)
@@ -1191,30 +3753,63 @@ def external_update_process(host, user, password, external_file, external_dir,
         if not reboot_at_the_end:
             cinfo("Step 1: External services not stopped as requested.")
     
-    # Step 2: Delete or preserve old directory
-    if preserve_old:
-        cinfo("Step 2: Keeping old external directory and files")
-    else:
-        cinfo("Step 2: Removing old external directory and files")
-        ssh_run(host, user, password, f"rm -rf {external_dir}", debug=debug)
-        cprint(f"{EMOJI['ok']} Old external directory '{external_dir}' and files removed", 'green')
-    
-    # Step 3: Extract external archive
-    cinfo("Step 3: Extracting external archive. Please wait...")
-    if not extract_archive_with_progress(
-        host, user, password,
-        archive_file=external_file,
-        target_dir=external_dir,
-        log_file="/tmp/ext_extract.log",
-        debug=debug
-    ):
-        return False
+    # Steps 2+3 (delta): compare the installed directory with the archive, send only the changes
+    if delta:
+        cinfo(f"Steps 2-3: Updating changed files{'' if preserve_old else ' and removing stale ones'}. Please wait...")
+        TRACE.step('delta update')
+        result = external_delta_update(host, user, password, external_file, external_dir,
+                                       delete_stale=not preserve_old, debug=debug,
+                                       extract_log=extract_log, compress=compress)
+        if result is False:
+            return False
+        delta = result is not None
+
+    if staged_dir:
+        # Steps 2+3 (pipelined): the archive was extracted during the firmware update, swap it in
+        TRACE.step('swap staged directory')
+        if preserve_old:
+            cinfo("Steps 2-3: Copying the staged external files over the existing directory")
+            swap = f"mkdir -p '{external_dir}' && cp -a '{staged_dir}/.' '{external_dir}/' && rm -rf '{staged_dir}'"
+        else:
+            cinfo("Steps 2-3: Replacing the external directory with the staged one")
+            swap = (f"{{ [ ! -e '{external_dir}' ] || mv '{external_dir}' '{external_dir}.old'; }} && "
+                    f"mv '{staged_dir}' '{external_dir}' && rm -rf '{external_dir}.old'")
+        ssh_run(host, user, password, swap, debug=debug, capture_output=True)
+        if last_exit_status() != 0:
+            cerror(f"Could not move the staged external directory '{staged_dir}' into place")
+            return False
+        cprint(f"{EMOJI['ok']} Staged external directory installed in '{external_dir}'", 'green')
+    elif not delta:
+        # Step 2: Delete or preserve old directory
+        TRACE.step('remove old directory')
+        if preserve_old:
+            cinfo("Step 2: Keeping old external directory and files")
+        else:
+            cinfo("Step 2: Removing old external directory and files")
+            ssh_run(host, user, password, f"rm -rf {external_dir}", debug=debug)
+            cprint(f"{EMOJI['ok']} Old external directory '{external_dir}' and files removed", 'green')
+
+        # Step 3: Extract external archive
+        cinfo("Step 3: Extracting external archive. Please wait...")
+        TRACE.step('extract external')
+        if not extract_archive_with_progress(
+            host, user, password,
+            archive_file=external_file,
+            target_dir=external_dir,
+            log_file="/tmp/ext_extract.log",
+            debug=debug,
+            verbose_log=extract_log,
+            compress=compress
+        ):
+            return False
     
     # Step 4: Mark as external directory
     cinfo("Step 4: Mark external directory")
+    TRACE.step('mark directory')
     ssh_run(host, user, password, f"touch {external_dir}/.external", debug=debug)
     
     # Step 5: Restart external services
+    TRACE.step('start services')
     if restart_services:
         if reboot_at_the_end:
             cerror("Cannot restart external services if reboot is needed.")
@@ -1229,10 +3824,278 @@ def external_update_process(host, user, password, external_file, external_dir,
     
     return True
 
+class ExternalStaging:
+    """
+    Extraction of an external archive into a staging directory next to the
+    external directory, in a background thread, so that it overlaps with
+    the firmware extraction and installation (see --pipeline). Its console
+    output is kept and only shown if the staging fails.
+    """
+    def __init__(self, host, user, password, external_file, external_dir, debug=False, extract_log=False,
+                 compress='none'):
+        self.host, self.user, self.password = host, user, password
+        self.external_file = external_file
+        self.directory = f"{external_dir.rstrip('/')}.staging"
+        self.debug, self.extract_log, self.compress = debug, extract_log, compress
+        self.output = io.StringIO()
+        self.ok = False
+        self.elapsed = 0
+        self._thread = None
+        self._streams = None
+        self._owner = None
+
+    def start(self):
+        """Start the staging in the background"""
+        cinfo(f"Staging external archive in '{self.directory}' while the firmware is installed")
+        if not isinstance(sys.stdout, ThreadOutput):  # fleet workers already have them
+            self._streams = sys.stdout, sys.stderr
+            sys.stdout, sys.stderr = ThreadOutput(sys.stdout), ThreadOutput(sys.stderr)
+        self._owner = ' '.join(filter(None, (PROGRESS.owner(), 'staging')))
+        self._thread = threading.Thread(target=self._run, name=f"staging-{self.host}", daemon=True)
+        self._thread.start()
+
+    def _join(self):
+        self._thread.join()
+        if self._streams:
+            sys.stdout, sys.stderr = self._streams
+            self._streams = None
+
+    def _run(self):
+        ThreadOutput.route(self.output)
+        PROGRESS.set_owner(self._owner)
+        _transport.unattended = True
+        start = time.time()
+        try:
+            ssh_run(self.host, self.user, self.password, f"rm -rf '{self.directory}'", debug=self.debug)
+            self.ok = extract_archive_with_progress(
+                self.host, self.user, self.password,
+                archive_file=self.external_file,
+                target_dir=self.directory,
+                log_file="/tmp/ext_stage.log",
+                debug=self.debug,
+                verbose_log=self.extract_log,
+                compress=self.compress
+            )
+        except Exception as e:
+            cerror(f"Staging failed: {e}")
+        finally:
+            self.elapsed = time.time() - start
+            ThreadOutput.route(None)
+
+    def wait(self):
+        """Wait for the staging to end; return True if the archive is staged"""
+        if self._thread.is_alive():
+            cinfo("Waiting for the external archive staging to complete...")
+        self._join()
+        if self.ok:
+            cprint(f"{EMOJI['ok']} External archive staged in {int(self.elapsed)}s", 'green')
+        else:
+            cerror("Staging of the external archive failed:")
+            cprint(self.output.getvalue().replace('\r', '\n'))
+        return self.ok
+
+    def discard(self):
+        """Wait for the staging to end and remove the staging directory"""
+        self._join()
+        ssh_run(self.host, self.user, self.password, f"rm -rf '{self.directory}'", debug=self.debug)
+
+
+# --- FLEET MODE ---
+INVENTORY_KEYS = {'user': 'user', 'password': 'password', 'image': 'image', 'external': 'external',
+                  'external-dir': 'external_dir', 'stop-services': 'stop_services'}
+
+class ThreadOutput:
+    """
+    Stand-in for sys.stdout/sys.stderr that sends what a thread prints to
+    the file routed to it with route(), and everything else to the original
+    stream. Used to give each fleet worker its own log.
+    """
+    _routes = threading.local()
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    @classmethod
+    def route(cls, target):
+        cls._routes.target = target
+
+    def _current(self):
+        return getattr(self._routes, 'target', None) or self.stream
+
+    def write(self, data):
+        return self._current().write(data)
+
+    def flush(self):
+        self._current().flush()
+
+    def fileno(self):
+        return self._current().fileno()
+
+    def isatty(self):
+        return self._current().isatty()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+def read_inventory(path):
+    """
+    Read a fleet inventory: one host per line, optionally followed by
+    key=value settings overriding the command line for that host.
+    Returns a list of (host, {argument: value}).
+    """
+    hosts = []
+    with open(path, encoding='utf-8') as f:
+        for lineno, line in enumerate(f, 1):
+            words = shlex.split(line, comments=True)
+            if not words:
+                continue
+            settings = {}
+            for word in words[1:]:
+                key, sep, value = word.partition('=')
+                if not sep or key not in INVENTORY_KEYS:
+                    raise ValueError(f"{path}:{lineno}: unknown setting '{word}' "
+                                     f"(valid: {', '.join(INVENTORY_KEYS)})")
+                settings[INVENTORY_KEYS[key]] = value
+            if any(host == words[0] for host, _ in hosts):
+                raise ValueError(f"{path}:{lineno}: duplicate host {words[0]}")
+            hosts.append((words[0], settings))
+    return hosts
+
+def parse_waves(spec, total):
+    """Split total hosts into waves from cumulative sizes like '1,25%,100%'; return the wave sizes"""
+    sizes, done = [], 0
+    for item in spec.split(','):
+        item = item.strip()
+        if item.endswith('%'):
+            target = -(-total * float(item[:-1]) // 100)  # ceiling
+        else:
+            target = int(item)
+        target = min(total, int(target))
+        if target > done:
+            sizes.append(target - done)
+            done = target
+    if done < total:
+        sizes.append(total - done)
+    return sizes
+
+def run_fleet_host(host_args, log_file):
+    """Run one update of a fleet in the current thread, logging to log_file; return the exit code"""
+    with open(log_file, 'w', encoding='utf-8') as log:
+        ThreadOutput.route(log)
+        PROGRESS.set_owner(host_args.host)
+        _transport.unattended = True
+        try:
+            cprint(f"FRITZ!Box {host_args.host} - {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}", 'bold')
+            with TRACE.span(host_args.host, 'host'):
+                return run_update(host_args)
+        except Exception as e:
+            cerror(f"Unexpected error: {e}")
+            if host_args.debug:
+                import traceback
+                traceback.print_exc(file=log)
+            return 1
+        finally:
+            ThreadOutput.route(None)
+
+def run_fleet(args):
+    """
+    Update all hosts of args.inventory, args.jobs at a time, in the waves of
+    args.waves. Each host runs the batch mode update of run_update() with
+    its output in its own log file; a summary table is printed at the end.
+    """
+    try:
+        hosts = read_inventory(args.inventory)
+    except (OSError, ValueError) as e:
+        cerror(f"Cannot read inventory: {e}")
+        return 1
+    if not hosts:
+        cerror(f"No hosts in inventory {args.inventory}")
+        return 1
+    try:
+        waves = parse_waves(args.waves, len(hosts))
+    except ValueError:
+        cerror(f"Invalid --waves: {args.waves}")
+        return 1
+    args.batch = True
+    if any('password' not in settings for _, settings in hosts):
+        args.password = get_password(args)
+
+    # Index the archives once, before the workers need them
+    ImageCatalogue('images').refresh(args.debug)
+    for name in ('image', 'external'):
+        for path in {settings.get(name, getattr(args, name)) for _, settings in hosts}:
+            if path and os.path.exists(path):
+                index = ArchiveIndex.load(path, args.debug)
+                if name == 'image':
+                    index.verify(args.debug)
+
+    run_dir = os.path.join(args.log_dir, datetime.now().strftime('%Y%m%d-%H%M%S'))
+    os.makedirs(run_dir, exist_ok=True)
+    if args.debug:
+        COMMAND_LOG.open(run_dir, prefix='ssh-')
+    cinfo(f"Fleet update of {len(hosts)} FRITZ!Boxes, {args.jobs} at a time, waves of {', '.join(map(str, waves))}")
+    cinfo(f"Per-host logs: {run_dir}")
+
+    sys.stdout, sys.stderr = ThreadOutput(sys.stdout), ThreadOutput(sys.stderr)
+    results = {}  # host -> (wave, exit code or None if not run, seconds, log file)
+    start = time.time()
+    queue = list(hosts)
+    try:
+        for wave, size in enumerate(waves, 1):
+            batch, queue = queue[:size], queue[size:]
+            cprint(f"\nWave {wave}/{len(waves)}: {', '.join(host for host, _ in batch)}", 'bold')
+            with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+                futures = {}
+                for host, settings in batch:
+                    host_args = argparse.Namespace(**vars(args))
+                    host_args.host = host
+                    for name, value in settings.items():
+                        setattr(host_args, name, value)
+                    log_file = os.path.join(run_dir, f"{host}.log")
+                    futures[pool.submit(run_fleet_host, host_args, log_file)] = (host, log_file, time.time())
+                for future in as_completed(futures):
+                    host, log_file, started = futures[future]
+                    rc = future.result()
+                    results[host] = (wave, rc, time.time() - started, log_file)
+                    if rc == 0:
+                        cprint(f"{host}: done in {int(time.time() - started)}s", 'green', 'ok')
+                    else:
+                        cprint(f"{host}: FAILED after {int(time.time() - started)}s, see {log_file}", 'red', 'fail')
+            failed = [host for host, _ in batch if results[host][1] != 0]
+            if failed and queue and not args.keep_going:
+                cerror(f"Wave {wave} failed on {len(failed)} host(s), the remaining waves are not started")
+                break
+    finally:
+        sys.stdout, sys.stderr = sys.stdout.stream, sys.stderr.stream
+
+    elapsed = time.time() - start
+    print_fleet_summary(hosts, results, elapsed)
+    return 0 if all(results.get(host, (0, None))[1] == 0 for host, _ in hosts) else 1
+
+def print_fleet_summary(hosts, results, elapsed):
+    """Print the result of every host of a fleet update"""
+    width = max(len('Host'), *(len(host) for host, _ in hosts))
+    cprint("\n" + "="*70, 'bold')
+    cprint("FLEET UPDATE SUMMARY", 'bold')
+    cprint("="*70, 'bold')
+    cprint(f"  {'Host':<{width}}  Wave  Result   Time   Log", 'bold')
+    busy = 0
+    for host, _ in hosts:
+        if host not in results:
+            cprint(f"  {host:<{width}}     -  skipped     -", 'yellow')
+            continue
+        wave, rc, seconds, log_file = results[host]
+        busy += seconds
+        result, color = ('ok', 'green') if rc == 0 else ('FAILED', 'red')
+        cprint(f"  {host:<{width}}  {wave:>4}  {result:<7} {int(seconds):>4}s   {log_file}", color)
+    ok = sum(1 for _, rc, _, _ in results.values() if rc == 0)
+    cprint(f"\n  {ok} succeeded, {len(results) - ok} failed, {len(hosts) - len(results)} skipped; "
+           f"{int(elapsed)}s elapsed for {int(busy)}s of updates", 'bold')
+
 
 # --- MAIN FUNCTION ---
-def main():
-    """Main entry point"""
+def build_parser():
+    """Return the command line parser"""
     parser = argparse.ArgumentParser(
         description="Professional Freetz-NG FRITZ!Box Update Tool",
         formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -1252,17 +4115,25 @@ Examples:
 
     # Update only external (no firmware)
     %(prog)s --host 192.168.178.1 --password mypass --external fw.external --batch --skip-firmware
+
+    # Fleet: all boxes of an inventory, 8 at a time, one canary first, then 25%%, then the rest
+    %(prog)s --inventory boxes.txt --jobs 8 --waves 1,25%%,100%% --external fw.external --skip-firmware
 """
     )
     
     # Connection arguments
     conn_group = parser.add_argument_group('Connection Options')
-    conn_group.add_argument('--host', required=True,
-                           help='FRITZ!Box IP address or hostname')
+    conn_group.add_argument('--host',
+                           help='FRITZ!Box IP address or hostname (required unless --inventory is used)')
     conn_group.add_argument('--user', default=DEFAULT_USER,
                            help=f'SSH username (default: {DEFAULT_USER})')
     conn_group.add_argument('--password',
                            help='SSH password (or use ROUTER_PASSWORD env var, or interactive prompt)')
+    conn_group.add_argument('--no-multiplex', action='store_true',
+                           help='Do not share one SSH master connection between commands (login for each command)')
+    conn_group.add_argument('--agent', action='store_true',
+                           help='Serve the small remote commands through a helper shell kept running on the box '
+                                '(needs the shared master connection or key authentication)')
     
     # File selection arguments
     file_group = parser.add_argument_group('File Selection')
@@ -1290,6 +4161,9 @@ Examples:
                              help='Do not reboot FRITZ!Box after firmware update')
     update_group.add_argument('--reboot-at-the-end', action='store_true',
                              help='Move the reboot at the end, after the external storage update')
+    update_group.add_argument('--wait-web', action='store_true',
+                             help='After a reboot, also wait (up to '
+                                  f'{WEB_WAIT_TIMEOUT}s) for the Freetz web interface on its MOD_HTTPD_PORT')
     update_group.add_argument('--delete-jffs2', action='store_true',
                              help='Delete JFFS2 partition during firmware update')
     update_group.add_argument('--downgrade', action='store_true',
@@ -1298,6 +4172,20 @@ Examples:
                              help='Delete old external files before extraction')
     update_group.add_argument('--no-external-restart', action='store_true',
                              help='Do not restart external services after update')
+    update_group.add_argument('--delta', action='store_true',
+                             help='Update an installed external directory in place: send only new and changed files, '
+                                  'delete stale ones (unless --no-delete-external)')
+    update_group.add_argument('--pipeline', action='store_true',
+                             help='Extract the external archive to a staging directory while the firmware is installed, '
+                                  'then swap it in (needs room for both external directories; reboot at the end)')
+    update_group.add_argument('--compress', choices=['auto', 'gzip', 'xz', 'lzma', 'none'], default='auto',
+                             help='Compress archives on the wire, decompressing on the FRITZ!Box '
+                                  '(default: auto, gzip if the archive compresses and the box can decompress it, '
+                                  'or the fastest for the box once calibrated)')
+    update_group.add_argument('--calibrate', choices=('auto', 'force', 'off'), default='auto',
+                             help='Measure the SSH throughput, decompression and storage write speed of the box '
+                                  'to choose the compression of --compress auto: once per box model, cached for '
+                                  f'{CALIBRATION_MAX_AGE // 86400} days (auto), again now (force) or never (off)')
     
     # Mode arguments
     mode_group = parser.add_argument_group('Execution Modes')
@@ -1307,31 +4195,43 @@ Examples:
                            help='Dry-run: show what would be done without making changes')
     mode_group.add_argument('--debug', action='store_true',
                            help='Enable debug output')
-    
-    args = parser.parse_args()
-    
-    # Get password from args, env var, or prompt
-    args.password = get_password(args)
-    
-    # Print header
-    cprint("\n" + "="*70, 'bold')
-    cprint("   Freetz-NG FRITZ!Box Update Tool", 'bold', 'rocket')
-    cprint("="*70 + "\n", 'bold')
-    
-    # Initialize SSH log file only if debug mode is active
-    if args.debug:
-        try:
-            with open(SSH_LOG_FILE, 'w', encoding='utf-8') as f:
-                f.write(f"FRITZ!Box Update Session - {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
-            cinfo(f"SSH commands will be logged to: {SSH_LOG_FILE}")
-        except Exception as e:
-            cwarning(f"Could not create SSH log file: {e}")
-    
+    mode_group.add_argument('--extract-log', action='store_true',
+                           help='Keep a verbose tar listing of each extraction on the FRITZ!Box (/tmp/*_extract.log)')
+    mode_group.add_argument('--sequential-probe', action='store_true',
+                           help='Read the FRITZ!Box configuration with one SSH command per item instead of a single batched probe')
+    mode_group.add_argument('--progress', choices=('auto', 'live', 'plain', 'off'), default='auto',
+                           help='Progress display: redrawn in place (live), a line every '
+                                f'{PROGRESS_PLAIN_INTERVAL}s for logs (plain) or none; '
+                                'default: live on a terminal, plain otherwise')
+    mode_group.add_argument('--trace', metavar='FILE',
+                           help='Write the timing of each phase, SSH command and transfer to FILE as a Chrome trace '
+                                '(open with ui.perfetto.dev or chrome://tracing)')
+
+    # Fleet arguments
+    fleet_group = parser.add_argument_group('Fleet Mode')
+    fleet_group.add_argument('--inventory',
+                            help='Update all FRITZ!Boxes listed in this file (one host per line, optionally followed '
+                                 'by user=, password=, image=, external=, external-dir=, stop-services=); implies --batch')
+    fleet_group.add_argument('--jobs', type=int, default=4,
+                            help='Number of FRITZ!Boxes updated at the same time (default: 4)')
+    fleet_group.add_argument('--waves', default='1,100%',
+                            help='Comma separated cumulative wave sizes, as host counts or percentages of the inventory; '
+                                 'a wave starts only if the previous one succeeded (default: 1,100%%: one canary, then all)')
+    fleet_group.add_argument('--keep-going', action='store_true',
+                            help='Start the next wave even if hosts of the previous wave failed')
+    fleet_group.add_argument('--log-dir', default='fleet-logs',
+                            help='Directory for the per-host logs of a fleet update (default: fleet-logs)')
+
+    return parser
+
+@traced('update')
+def run_update(args):
+    """Update the FRITZ!Box args.host as selected by args; return the exit code"""
     if args.dry_run:
         cwarning("DRY-RUN MODE: No changes will be made to FRITZ!Box\n")
     
     # Read FRITZ!Box configuration (always read to show information and validate)
-    router_config = read_device_config(args.host, args.user, args.password, args.debug)
+    router_config = read_device_config(args.host, args.user, args.password, args.debug, batch=not args.sequential_probe)
     if router_config is None:
         cerror("Cannot proceed without valid Freetz-NG configuration!")
         return 1
@@ -1341,6 +4241,10 @@ Examples:
         # Use configured external directory as default
         DEFAULT_EXTERNAL_BASE_OVERRIDE = router_config.external_dir
         cdebug(f"Using external directory from FRITZ!Box config: {DEFAULT_EXTERNAL_BASE_OVERRIDE}", args.debug)
+    # Freetz web interface, probed after a reboot on request only (it may be disabled or slow to start)
+    web_port = None
+    if args.wait_web:
+        web_port = int(router_config.port) if str(getattr(router_config, 'port', '')).isdigit() else None
     
     # Validate arguments
     if args.skip_firmware and args.skip_external:
@@ -1348,7 +4252,8 @@ Examples:
         return 1
     
     # File selection (interactive or batch)
-    images, externals = find_images()
+    catalogue = ImageCatalogue('images').refresh(args.debug)
+    images, externals = find_images(getattr(router_config, 'product_id', None), catalogue, args.debug)
     
     auto_selected_image = False
     if not args.skip_firmware and not args.image:
@@ -1363,7 +4268,7 @@ Examples:
             # Interactive: ask if user wants to install firmware
             cprint("")
             if confirm("Install firmware image?", default=True):
-                args.image = select_file_interactive(images, 'firmware image')
+                args.image = select_file_interactive(images, 'firmware image', catalogue)
                 if not args.image:
                     cwarning("No firmware image selected, skipping firmware update")
                     args.skip_firmware = True
@@ -1388,7 +4293,7 @@ Examples:
             # Interactive: ask if user wants to install external
             cprint("")  # Empty line for spacing
             if confirm("Install external package?", default=True):
-                args.external = select_file_interactive(externals, 'external package')
+                args.external = select_file_interactive(externals, 'external package', catalogue)
                 if not args.external:
                     cwarning("No external package selected, skipping external update")
                     args.skip_external = True
@@ -1433,6 +4338,8 @@ Examples:
             if firmware_suffix != '.image' or external_suffix != '.external':
                 cwarning(f"Non standard firmware or external suffix:\n  Firmware: {firmware_real_path}\n  External: {external_real_path}")
 
+    ext_size_known = (None, None)  # (external directory, size) already read from FRITZ!Box
+
     # Show storage information first
     if router_config and args.external:
         cprint("\n" + "-"*70, 'dim')  # Begin directory configuration
@@ -1479,13 +4386,15 @@ Examples:
                     cinfo(f"Using external directory: {args.external_dir}")
 
         # Show external directory size, check existence first
-        ext_exists = ssh_run(args.host, args.user, args.password, f"test -d '{args.external_dir}' && echo exists || echo notfound", debug=args.debug, capture_output=True).strip()
-        if ext_exists == "exists":
-            ext_size = ssh_run(args.host, args.user, args.password, f"du -sh '{args.external_dir}' 2>/dev/null | awk '{{print $1}}'", debug=args.debug, capture_output=True).strip()
+        if args.external_dir == router_config.external_dir and router_config.external_dir_exists is not None:
+            ext_size = router_config.external_dir_size
+        else:
+            ext_size = remote_dir_size(args.host, args.user, args.password, args.external_dir, debug=args.debug)
+        if ext_size is not None:
             cprint(f"   External directory '{args.external_dir}' already exists. Current size: {ext_size}", 'cyan')
         else:
             cwarning(f"Remote external directory '{args.external_dir}' does not exist.\n   It will be created during archive extraction.")
-            ext_size = "0"
+        ext_size_known = (args.external_dir, ext_size)
 
     # Ask for external directory if external update is selected
     if args.external and not args.skip_external:
@@ -1525,9 +4434,10 @@ Examples:
         cprint("\n" + "-"*70, 'dim')
         cinfo("Reading firmware archive metadata...")
         
-        # Extract ./var/content
+        # Extract ./var/content (and ./var/.packages) from the archive index
         try:
-            fw_content_output = subprocess.getoutput(f"tar -xOf '{args.image}' ./var/content 2>/dev/null")
+            fw_index = ArchiveIndex.load(args.image, args.debug)
+            fw_content_output = fw_index.content
         except Exception as e:
             cerror(f"Could not extract ./var/content from firmware image: {e}")
             return 1
@@ -1537,12 +4447,7 @@ Examples:
             return 1
         
         # Parse ./var/content
-        fw_content = {}
-        for line in fw_content_output.splitlines():
-            line = line.strip()
-            if '=' in line:
-                key, value = line.split('=', 1)
-                fw_content[key.strip()] = value.strip()
+        fw_content = parse_fw_content(fw_content_output)
         
         # Extract Product field
         fw_product = fw_content.get('Product', 'Unknown')
@@ -1582,9 +4487,36 @@ Examples:
         else:
             cdebug("Could not verify product compatibility (missing product ID)", args.debug)
 
+        # Pre-flight check of the image contents, before anything is sent to the box
+        try:
+            with TRACE.span('pre-flight check'):
+                preflight = fw_index.verify(args.debug)
+        except OSError as e:
+            cerror(f"Could not read firmware image: {e}")
+            return 1
+        for name, (size, checksum) in sorted(preflight['images'].items()):
+            cdebug(f"  ./{name}: {format_size(size)}, checksum {checksum}", args.debug)
+        for warning in preflight['warnings']:
+            cwarning(f"Pre-flight check: {warning}")
+        if preflight['errors']:
+            cprint("")
+            cwarning("PRE-FLIGHT CHECK FAILED:")
+            for error in preflight['errors']:
+                cwarning(f"  {error}")
+            cprint("")
+            if args.batch:
+                cerror("The firmware image is damaged or incomplete! Cannot proceed.")
+                return 1
+            if not confirm("Do you want to proceed anyway? (NOT RECOMMENDED)", default=False):
+                cinfo("Update cancelled by user due to a damaged firmware image.")
+                return 0
+        else:
+            verified = sum(1 for _, checksum in preflight['images'].values() if checksum == 'ok')
+            cinfo(f"Pre-flight check passed: {len(preflight['images'])} images, {verified} checksums verified")
+
         # Extract ./var/.packages
         try:
-            fw_packages = subprocess.getoutput(f"tar -xOf '{args.image}' ./var/.packages 2>/dev/null")
+            fw_packages = fw_index.packages
             if fw_packages and fw_packages.strip():
                 package_lines = fw_packages.strip().splitlines()
                 if len(package_lines) == 1:
@@ -1648,7 +4580,10 @@ Examples:
     if args.external and not args.skip_external:
         cprint("\n" + "-"*70, 'dim')
         if args.batch:
-            if args.no_delete_external:
+            if args.delta:
+                cprint("Only new and changed files will be sent to the installed external directory"
+                       f"{'' if args.no_delete_external else ', stale files will be deleted'}.", 'yellow', 'info')
+            elif args.no_delete_external:
                 cprint("Old external directory will be preserved", 'yellow', 'info')
             else:
                 cprint("Old external directory will be deleted before extraction.", 'yellow', 'info')
@@ -1658,7 +4593,11 @@ Examples:
         else:
             cinfo("External Update Options:")
 
-            if confirm("Delete any previously existing external directory after file upload and before extraction?", default=True):
+            args.delta = confirm("Send only new and changed files to an installed external directory (delta update)?",
+                                 default=args.delta)
+            if args.delta:
+                args.no_delete_external = not confirm("Delete installed files that are no longer in the archive?", default=True)
+            elif confirm("Delete any previously existing external directory after file upload and before extraction?", default=True):
                 args.no_delete_external = False
             else:
                 args.no_delete_external = True
@@ -1684,7 +4623,10 @@ Examples:
     if args.external:
         cprint(f"  External archive: {os.path.basename(args.external)} ({format_size(get_file_size(args.external))})", 'yellow')
         if args.external_dir:
-            ext_size = ssh_run(args.host, args.user, args.password, f"du -hs {args.external_dir} 2>/dev/null | awk '{{print $1}}'", debug=args.debug, capture_output=True).strip()
+            if ext_size_known[0] == args.external_dir:
+                ext_size = ext_size_known[1] or ''
+            else:
+                ext_size = remote_dir_size(args.host, args.user, args.password, args.external_dir, debug=args.debug) or ''
             ext_size_str = f" ({ext_size})" if ext_size else ""
             cprint(f"  External dir:     {args.external_dir}{ext_size_str}", 'yellow')
     if args.image and not args.skip_firmware:
@@ -1694,40 +4636,73 @@ Examples:
         cprint(f"  Reboot at end:    {'Yes' if args.reboot_at_the_end else 'No'}", 'yellow')
     cprint("-"*70 + "\n", 'dim')
 
+    if args.external and not args.skip_external:
+        # Detect external dir if not provided
+        if not args.external_dir:
+            if router_config:
+                # Use configuration from FRITZ!Box
+                basename = os.path.splitext(os.path.basename(args.external))[0]
+                args.external_dir = f"{router_config.external_dir}/{basename}"
+                cdebug(f"Using external directory from FRITZ!Box config: {args.external_dir}", args.debug)
+            elif not args.dry_run:
+                # Fallback to detection
+                args.external_dir = detect_external_dir(args.host, args.user, args.password, args.debug)
+                cdebug(f"Detected external directory: {args.external_dir}", args.debug)
+
+    # Calibrate the transfer for the automatic compression (measured once per box model)
+    external = args.external and not args.skip_external
+    if args.compress == 'auto' and args.calibrate != 'off' and not args.dry_run:
+        calibrate_link(args.host, args.user, args.password, LinkProfile.model_of(router_config),
+                       sample_file=args.external if external else args.image,
+                       storage_dir=os.path.dirname(args.external_dir.rstrip('/')) if external and args.external_dir else None,
+                       force=args.calibrate == 'force', debug=args.debug)
+
+    # Pipelined mode: the external archive is staged while the firmware is installed
+    staging = None
+    both = args.image and not args.skip_firmware and args.external and not args.skip_external
+    if args.pipeline and both and not args.dry_run:
+        if args.delta:
+            cinfo("Delta update selected: the external update is not pipelined")
+        elif not (args.reboot_at_the_end or args.no_reboot):
+            cwarning("--pipeline needs the reboot at the end (--reboot-at-the-end): the external update is not pipelined")
+        else:
+            staging = ExternalStaging(args.host, args.user, args.password, args.external, args.external_dir,
+                                      debug=args.debug, extract_log=args.extract_log, compress=args.compress)
+
     # Execute firmware update
     if args.image and not args.skip_firmware:
         if not args.batch:
             if not confirm("Proceed with firmware update?", default=False):
                 cinfo("Update cancelled by user.")
                 return 0
+            if staging and not confirm("Proceed with external storage update?", default=False):
+                cinfo("External update cancelled by user.")
+                args.skip_external = True
+                staging = None
+        if staging:
+            staging.start()
         success = firmware_update_process(
             args.host, args.user, args.password, args.image,
             stop_services=args.stop_services, no_reboot=args.no_reboot,
             reboot_at_the_end=args.reboot_at_the_end,
             delete_jffs2=args.delete_jffs2, downgrade=args.downgrade,
-            debug=args.debug, dry_run=args.dry_run
+            debug=args.debug, dry_run=args.dry_run, extract_log=args.extract_log,
+            compress=args.compress, web_port=web_port
         )
         if success and not args.skip_external:
             cprint("")
         if not success:
             cerror("Firmware update failed!")
+            if staging:
+                staging.discard()
             return 1
     
     # Execute external update
     if args.external and not args.skip_external:
-        # Detect external dir if not provided
-        if not args.external_dir:
-            if router_config:
-                # Use configuration from FRITZ!Box
-                basename = os.path.splitext(os.path.basename(args.external))[0]
-                args.external_dir = f"{router_config.external_dir}/{basename}"
-                cdebug(f"Using external directory from FRITZ!Box config: {args.external_dir}", args.debug)
-            elif not args.dry_run:
-                # Fallback to detection
-                args.external_dir = detect_external_dir(args.host, args.user, args.password, args.debug)
-                cdebug(f"Detected external directory: {args.external_dir}", args.debug)
-
-        if not args.batch:
+        if staging and not staging.wait():
+            cerror("External update failed!")
+            return 1
+        if not args.batch and not staging:
             if not confirm("Proceed with external storage update?", default=False):
                 cinfo("Update cancelled by user.")
                 return 0
@@ -1737,7 +4712,8 @@ Examples:
             preserve_old=args.no_delete_external, 
             restart_services=not args.no_external_restart,
             reboot_at_the_end=args.reboot_at_the_end,
-            debug=args.debug, dry_run=args.dry_run
+            debug=args.debug, dry_run=args.dry_run, extract_log=args.extract_log,
+            compress=args.compress, delta=args.delta, staged_dir=staging.directory if staging else None
         )
         if not success:
             cerror("External update failed!")
@@ -1752,13 +4728,16 @@ Examples:
             cwarning("[DRY-RUN] Skipping reboot command")
         else:
             ssh_run(args.host, args.user, args.password, REBOOT_CMD, capture_output=False, debug=args.debug)
-            if not wait_router_boot(args.host, args.password, args.user, debug=args.debug):
+            AGENTS.close(args.host, args.user)
+            SESSIONS.close(args.host, args.user, args.debug)
+            if not wait_router_boot(args.host, args.password, args.user, debug=args.debug, web_port=web_port):
                 cerror("Router did not come back online in time after reboot!")
                 return 1
 
         # Read again FRITZ!Box configuration
         cinfo("Gathering system information after reboot:")
-        router_config = read_device_config(args.host, args.user, args.password, args.debug, summary=True)
+        router_config = read_device_config(args.host, args.user, args.password, args.debug, summary=True,
+                                           batch=not args.sequential_probe)
         if router_config is None:
             cerror("Cannot read Freetz-NG configuration!")
             return 1
@@ -1769,11 +4748,53 @@ Examples:
     cprint("="*60 + "\n", 'bold')
     
     # Show log file location only in debug mode
-    if args.debug and os.path.exists(SSH_LOG_FILE):
-        cinfo(f"SSH command log saved to: {SSH_LOG_FILE}")
+    if args.debug and COMMAND_LOG.directory:
+        cinfo(f"SSH command log saved to: {COMMAND_LOG.path(args.host)}")
     
     return 0
 
+def main():
+    """Main entry point"""
+    parser = build_parser()
+    args = parser.parse_args()
+    if not args.host and not args.inventory:
+        parser.error("--host or --inventory is required")
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+
+    # Get password from args, env var, or prompt (per host in fleet mode)
+    if not args.inventory:
+        args.password = get_password(args)
+    SESSIONS.enabled = not args.no_multiplex
+    AGENTS.enabled = args.agent
+    PROGRESS.mode = args.progress
+    
+    # Print header
+    cprint("\n" + "="*70, 'bold')
+    cprint("   Freetz-NG FRITZ!Box Update Tool", 'bold', 'rocket')
+    cprint("="*70 + "\n", 'bold')
+    
+    # Initialize SSH log only if debug mode is active (fleet mode logs next to the host logs)
+    if args.debug and not args.inventory:
+        try:
+            COMMAND_LOG.open(SSH_LOG_DIR, prefix=f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-")
+            cinfo(f"SSH commands will be logged to: {COMMAND_LOG.path(args.host)}")
+        except OSError as e:
+            cwarning(f"Could not create SSH log directory: {e}")
+
+    TRACE.enabled = bool(args.trace)
+    try:
+        if args.inventory:
+            return run_fleet(args)
+        return run_update(args)
+    finally:
+        if args.trace:
+            try:
+                TRACE.save(args.trace)
+                cinfo(f"Timing trace written to: {args.trace}")
+            except OSError as e:
+                cwarning(f"Could not write trace file: {e}")
+
 if __name__ == "__main__":
     try:
         ret = main()
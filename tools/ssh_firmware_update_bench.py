@@ -0,0 +1,835 @@
+#!/usr/bin/env python3
+"""
+ssh_firmware_update_bench.py — Benchmarks for tools/ssh_firmware_update.py
+
+Measures the local cost of the SSH transport of ssh_firmware_update.py
+without a FRITZ!Box. The 'device' benchmark runs the update tool against
+a local stand-in FRITZ!Box (fake ssh/scp, fake rootfs, simulated reboot)
+with configurable latency and bandwidth.
+
+Usage:
+  tools/ssh_firmware_update_bench.py capture [--sizes 1,2,4,8]
+  tools/ssh_firmware_update_bench.py drain [--calls 20]
+  tools/ssh_firmware_update_bench.py transport [--size 64]
+  tools/ssh_firmware_update_bench.py progress [--tasks 1,10,100,1000]
+  tools/ssh_firmware_update_bench.py async [--commands 200] [--uploads 20]
+  tools/ssh_firmware_update_bench.py device [--latency 0.02] [--bandwidth 10] [--boot 5]
+"""
+import os, sys, argparse, time, tempfile, asyncio, stat, io, socket, select, threading, tarfile, contextlib, filecmp, shutil, subprocess, hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import ssh_firmware_update as sfu
+
+CHUNK_SIZE = 4096  # typical size of a PTY read
+
+def tar_listing(size_mb):
+    """Return about size_mb MB of 'tar -xvf' style output"""
+    lines = []
+    total = 0
+    i = 0
+    while total < size_mb * 1024 * 1024:
+        line = f"./usr/lib/freetz/package-{i // 100:04d}/lib/libexample-{i:07d}.so.1.2.3\n".encode()
+        lines.append(line)
+        total += len(line)
+        i += 1
+    return b''.join(lines)
+
+class LimitedReader:
+    """File wrapper returning at most limit bytes"""
+    def __init__(self, f, limit):
+        self.f, self.left = f, limit
+    def fileno(self):
+        return self.f.fileno()
+    def read(self, n=-1):
+        n = self.left if n < 0 else min(n, self.left)
+        data = self.f.read(n)
+        self.left -= len(data)
+        return data
+
+# Stand-in for ssh on PATH: prompts for the password on the terminal like
+# ssh does, then runs the remote command locally. ControlMaster=yes leaves a
+# no-op master (its pid in the ControlPath) that spares later commands the login.
+STANDIN_SSH = """#!/bin/sh
+control=
+for arg; do last=$arg; case $arg in ControlPath=*) control=${arg#ControlPath=} ;; esac; done
+master=$(cat "$control" 2>/dev/null)
+[ -n "$master" ] && kill -0 "$master" 2>/dev/null || master=
+case " $* " in
+*" -O check "*) [ -n "$master" ] || exit 255; echo "Master running (pid=$master)" >&2; exit 0 ;;
+*" -O exit "*) [ -n "$master" ] || exit 255; rm -f "$control"; kill "$master"; exit 0 ;;
+*" ControlMaster=no "*) [ -n "$master" ] && exec sh -c "$last" ;;
+esac
+case " $* " in *" BatchMode=yes "*) echo "Permission denied (publickey,password)." >&2; exit 255 ;; esac
+printf "root@standin's password: " > /dev/tty
+read -r pw < /dev/tty
+printf '\\n' > /dev/tty
+if [ "$pw" != "$STANDIN_PASSWORD" ]; then echo "Permission denied, please try again." > /dev/tty; exit 255; fi
+case " $* " in *" ControlMaster=yes "*)
+    : > "$control"
+    (trap '' HUP; while [ -f "$control" ]; do sleep 1; done) < /dev/null > /dev/null 2>&1 &
+    echo $! > "$control" ;;
+esac
+exec sh -c "$last"
+"""
+
+def standin_sshd(directory, password):
+    """Put the ssh stand-in first on PATH"""
+    path = os.path.join(directory, 'ssh')
+    with open(path, 'w') as f:
+        f.write(STANDIN_SSH)
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+    os.environ['PATH'] = f"{directory}{os.pathsep}{os.environ['PATH']}"
+    os.environ['STANDIN_PASSWORD'] = password
+
+def report(name, size, elapsed):
+    """Print one benchmark result line"""
+    rate = size / elapsed if elapsed > 0 else 0
+    print(f"  {name:<28} {sfu.format_size(size):>10} in {elapsed:7.3f}s  "
+          f"{sfu.format_size(rate):>10}/s  {elapsed * 1e6 / max(1, size):.4f} us/byte")
+
+def bench_capture(args):
+    """Feed multi-megabyte command output through the PTY capture engine"""
+    sizes = [int(x) for x in args.sizes.split(',')]
+    print("Capture engine (prompt filtering active, worst case):")
+    for size_mb in sizes:
+        data = tar_listing(size_mb)
+        start = time.perf_counter()
+        matcher = sfu.StreamMatcher()
+        capture = sfu.OutputCapture()
+        for i in range(0, len(data), CHUNK_SIZE):
+            chunk = data[i:i + CHUNK_SIZE]
+            matcher.feed(chunk)
+            capture.feed(chunk)
+        capture.close()
+        elapsed = time.perf_counter() - start
+        assert len(capture.getvalue()) == len(data)
+        report(f"feed {size_mb} MB", len(data), elapsed)
+
+    print("sshpass_exec() through a local PTY ('cat' of the listing):")
+    for size_mb in sizes:
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(tar_listing(size_mb))
+            f.flush()
+            start = time.perf_counter()
+            output = sfu.sshpass_exec(['cat', f.name], '', capture_output=True)
+            elapsed = time.perf_counter() - start
+            report(f"sshpass_exec {size_mb} MB", len(output), elapsed)
+
+def bench_drain(args):
+    """Measure the per-call overhead of sshpass_exec() with and without a stdin stream"""
+    cases = [
+        ("command, no input", ['true'], None),
+        ("stream 64 KB to 'cat'", ['sh', '-c', 'cat >/dev/null'], 64 * 1024),
+        ("stream 4 MB to 'wc -c'", ['wc', '-c'], 4 * 1024 * 1024),
+    ]
+    print(f"Per-call overhead of sshpass_exec() ({args.calls} calls each):")
+    worst = 0
+    with tempfile.NamedTemporaryFile() as f:
+        f.write(os.urandom(4 * 1024 * 1024))
+        f.flush()
+        for name, cmd, size in cases:
+            timings = []
+            for _ in range(args.calls):
+                start = time.perf_counter()
+                if size is None:
+                    sfu.sshpass_exec(cmd, '', capture_output=True)
+                else:
+                    with open(f.name, 'rb') as stream:
+                        sfu.sshpass_exec(cmd, '', capture_output=True, stdin_stream=LimitedReader(stream, size))
+                timings.append(time.perf_counter() - start)
+                if sfu.last_exit_status() != 0:
+                    print(f"  {name}: exit status {sfu.last_exit_status()}")
+                    return 1
+            worst = max(worst, max(timings))
+            print(f"  {name:<28} mean {1000 * sum(timings) / len(timings):8.1f} ms   max {1000 * max(timings):8.1f} ms")
+    if worst >= 1:
+        print(f"FAIL: a call took {worst:.2f}s, per-call overhead must stay below one second")
+        return 1
+    print("OK: no call reached a one second floor")
+    return 0
+
+def bench_transport(args):
+    """Compare the PTY and the pipe transport on local commands (output capture and streamed input)"""
+    size = args.size * 1024 * 1024
+    transports = (('pty', lambda cmd, **kw: sfu.pty_exec_async(cmd, '', authenticated=True, **kw)),
+                  ('pipe', sfu.pipe_exec_async))
+    failures = []
+    with tempfile.TemporaryDirectory() as tmp:
+        listing, data = os.path.join(tmp, 'listing.txt'), os.path.join(tmp, 'data.bin')
+        with open(listing, 'wb') as f:
+            f.write(tar_listing(args.size))
+        with open(data, 'wb') as f:
+            f.write(os.urandom(size))
+        with open(data, 'rb') as f:
+            digest = hashlib.md5(f.read()).hexdigest()
+
+        print(f"Output capture ('cat' of a {args.size} MB listing):")
+        for name, run in transports:
+            start = time.perf_counter()
+            output, status = asyncio.run(run(['cat', listing], capture_output=True))
+            report(name, len(output), time.perf_counter() - start)
+            if status != 0 or len(output) != os.path.getsize(listing):
+                failures.append(f"{name} output")
+
+        print(f"Streamed input ({args.size} MB of random data to 'wc -c', and hashed on both ends to 'md5sum'):")
+        for name, run in transports:
+            for command, reader in ((['wc', '-c'], sfu.ProgressReader), (['md5sum'], sfu.HashingReader)):
+                for zero_copy in (False, True) if reader.zero_copy else (False,):
+                    with open(data, 'rb') as f:
+                        stream = reader(f)
+                        stream.zero_copy = zero_copy
+                        start = time.perf_counter()
+                        output, status = asyncio.run(run(command, capture_output=True, stdin_stream=stream))
+                        elapsed = time.perf_counter() - start
+                    copy = 'sendfile' if zero_copy else 'read/write'
+                    report(f"{name}, {command[0]}, {copy}", size, elapsed)
+                    local = stream.hash.hexdigest() if stream.hash else str(stream.count)
+                    remote = output.split()[0] if output.split() else ''
+                    if status != 0 or remote != local or local not in (digest, str(size)):
+                        failures.append(f"{name} input ({command[0]}, {copy})")
+
+    if failures:
+        print(f"FAIL: {', '.join(failures)}")
+        return 1
+    print("OK: all results verified")
+    return 0
+
+class Console(io.StringIO):
+    """Terminal stand-in for the progress display, counting the writes"""
+    def __init__(self):
+        super().__init__()
+        self.writes = []
+
+    def isatty(self):
+        return True
+
+    def write(self, text):
+        self.writes.append(text)
+        return super().write(text)
+
+def bench_progress(args):
+    """Cost of the progress display for a growing number of concurrent transfers"""
+    failures = []
+    size = 1 << 30
+    sfu.PROGRESS_PLAIN_INTERVAL = args.seconds / 4  # a few plain lines per case
+    print(f"Progress display, {args.threads} threads updating the transfers for {args.seconds}s "
+          f"(a redraw every {sfu.PROGRESS_INTERVAL}s live, every {sfu.PROGRESS_PLAIN_INTERVAL}s plain, at most):")
+    for count in [int(x) for x in args.tasks.split(',')]:
+        for mode in ('live', 'plain'):
+            display = sfu.ProgressDisplay()
+            display.mode, display.stream = mode, Console()
+            updates = [0] * args.threads
+            with contextlib.ExitStack() as stack:
+                tasks = [stack.enter_context(display.task(f"transfer {i}", size)) for i in range(count)]
+                stop = time.monotonic() + args.seconds
+
+                def worker(n):
+                    done = 0
+                    while time.monotonic() < stop:
+                        done += 65536
+                        for task in tasks[n::args.threads]:
+                            task.update(done, f"{done // 65536} blocks")
+                            updates[n] += 1
+                        time.sleep(0.001)
+
+                start = time.perf_counter()
+                with ThreadPoolExecutor(args.threads) as pool:
+                    list(pool.map(worker, range(args.threads)))
+                elapsed = time.perf_counter() - start
+                redraws = 200
+                with display._lock:
+                    draw = display._draw_live if mode == 'live' else display._draw_plain
+                    start_draw = time.perf_counter()
+                    for i in range(redraws):
+                        tasks[0].update(i)
+                        draw(Console())
+                    draw_time = (time.perf_counter() - start_draw) / redraws
+            frames = [text for text in display.stream.writes if text.strip()]
+            lines = max((text.strip('\n').count('\n') + 1 for text in frames), default=0)
+            print(f"  {count:>5} transfers, {mode:<5} {sum(updates) / elapsed:>10.0f} updates/s   "
+                  f"{len(frames):>3} writes, at most {lines} lines   {draw_time * 1e6:8.1f} us/redraw")
+            limit = args.seconds / (sfu.PROGRESS_INTERVAL if mode == 'live' else sfu.PROGRESS_PLAIN_INTERVAL) + 2
+            if len(frames) > limit or lines > sfu.PROGRESS_ROWS + 1:
+                failures.append(f"{count} transfers, {mode}: {len(frames)} writes of up to {lines} lines")
+            if mode == 'plain' and '\033' in display.stream.getvalue():
+                failures.append(f"{count} transfers, plain: escape sequences in the output")
+            if mode == 'live' and not display.stream.getvalue().endswith('\033[2K'):
+                failures.append(f"{count} transfers, live: display not removed at the end")
+
+    if failures:
+        print(f"FAIL: {', '.join(failures)}")
+        return 1
+    print("OK: all results verified")
+    return 0
+
+def bench_async(args):
+    """Run hundreds of concurrent commands and uploads against the local stand-in sshd"""
+    password = 'standin'
+    with tempfile.TemporaryDirectory() as tmp:
+        standin_sshd(tmp, password)
+        command = f"sleep {args.sleep}; echo $(( {{}} * 2 ))"
+
+        async def run_all():
+            return await asyncio.gather(*(sfu.ssh_run_async('standin', 'root', password, command.format(i))
+                                          for i in range(args.commands)))
+
+        elapsed_async, bad = {}, []
+        for shared in (False, True):
+            sfu.SESSIONS.enabled = shared
+            start = time.perf_counter()
+            results = asyncio.run(run_all())
+            elapsed_async[shared] = time.perf_counter() - start
+            bad += [i for i, (output, status) in enumerate(results) if status != 0 or output.strip() != str(2 * i)]
+            sfu.SESSIONS.close('standin', 'root')
+        sfu.SESSIONS.enabled = False  # the comparisons below are between password logins
+
+        def run_sync(i):
+            sfu._transport.unattended = True
+            return sfu.ssh_run('standin', 'root', password, command.format(i)).strip() == str(2 * i)
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.commands) as pool:
+            ok_threads = sum(pool.map(run_sync, range(args.commands)))
+        elapsed_threads = time.perf_counter() - start
+
+        print(f"{args.commands} concurrent commands ('sleep {args.sleep}' each, password login):")
+        print(f"  asyncio, one event loop      {elapsed_async[False]:7.3f}s  "
+              f"{args.commands / elapsed_async[False]:8.1f} commands/s")
+        print(f"  asyncio, shared connection   {elapsed_async[True]:7.3f}s  "
+              f"{args.commands / elapsed_async[True]:8.1f} commands/s")
+        print(f"  one thread per command       {elapsed_threads:7.3f}s  {args.commands / elapsed_threads:8.1f} commands/s")
+        print(f"  sequential (estimate)        {args.commands * args.sleep:7.3f}s")
+
+        source = os.path.join(tmp, 'source.bin')
+        with open(source, 'wb') as f:
+            f.write(os.urandom(args.upload_size * 1024 * 1024))
+
+        async def upload_all():
+            return await asyncio.gather(*(sfu.ssh_upload_async('standin', 'root', password, source,
+                                                               os.path.join(tmp, f"upload-{i}.bin"))
+                                          for i in range(args.uploads)))
+
+        start = time.perf_counter()
+        uploaded = asyncio.run(upload_all())
+        elapsed = time.perf_counter() - start
+        size = args.uploads * os.path.getsize(source)
+        bad_uploads = [i for i in range(args.uploads)
+                       if not uploaded[i] or os.path.getsize(os.path.join(tmp, f"upload-{i}.bin")) != size // args.uploads]
+        print(f"{args.uploads} concurrent streamed uploads of {args.upload_size} MB:")
+        report("asyncio uploads", size, elapsed)
+
+    if bad or ok_threads != args.commands or bad_uploads:
+        print(f"FAIL: {len(bad)} async commands, {args.commands - ok_threads} threaded commands and "
+              f"{len(bad_uploads)} uploads returned a wrong result")
+        return 1
+    print("OK: all results verified")
+    return 0
+
+# --- STAND-IN FRITZ!Box ---
+# Stand-in for ssh and scp on PATH. The box is a directory (STANDIN_ROOT):
+# absolute box paths in remote commands are moved into it, the command runs
+# in a POSIX shell with pipefail, after STANDIN_LATENCY seconds of
+# connection setup, with its input limited to STANDIN_BANDWIDTH bytes/s.
+# While the box reboots (STANDIN_STATE holds the time it is up again), the
+# connection is refused. ControlMaster=yes starts a master: a process whose
+# pid is written to the ControlPath and that lives until '-O exit' or the
+# box goes down; commands given that ControlPath skip the login.
+STANDIN_DEVICE = r"""#!%(python)s
+import os, re, sys, time, shutil, signal, subprocess, threading
+root, state = os.environ['STANDIN_ROOT'], os.environ['STANDIN_STATE']
+latency, bandwidth = float(os.environ['STANDIN_LATENCY']), float(os.environ['STANDIN_BANDWIDTH'])
+args = sys.argv[1:]
+options = dict(args[i + 1].split('=', 1) for i, arg in enumerate(args[:-1]) if arg == '-o')
+control = options.get('ControlPath')
+
+def is_up():
+    try:
+        with open(state) as f:
+            return time.time() >= float(f.read())
+    except (OSError, ValueError):
+        return True
+
+def master_pid():
+    try:
+        with open(control) as f:
+            pid = int(f.read())
+        os.kill(pid, 0)
+        return pid
+    except (TypeError, OSError, ValueError):
+        return None
+
+def start_master():
+    open(control, 'w').close()
+    pid = os.fork()
+    if pid:
+        with open(control, 'w') as f:
+            f.write(str(pid))
+        return
+    os.setsid()
+    null = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(null, fd)
+    while os.path.exists(control) and is_up():
+        time.sleep(0.1)
+    if os.path.exists(control):
+        os.remove(control)
+    os._exit(0)
+
+if '-O' in args:
+    pid = master_pid()
+    if pid is None:
+        sys.stderr.write(f"Control socket connect({control}): No such file or directory\n")
+        sys.exit(255)
+    if args[args.index('-O') + 1] == 'exit':
+        os.remove(control)
+        os.kill(pid, signal.SIGTERM)
+        sys.stderr.write("Exit request sent.\n")
+    else:
+        sys.stderr.write(f"Master running (pid={pid})\n")
+    sys.exit(0)
+# A new channel on the master connection: no connection setup, no login
+multiplexed = options.get('ControlMaster', 'no') in ('no', 'auto') and master_pid()
+if not multiplexed:
+    time.sleep(latency)
+    if not is_up():
+        sys.stderr.write("ssh: connect to host standin port 22: Connection refused\n")
+        sys.exit(255)
+if multiplexed:
+    pass
+elif 'BatchMode=yes' in args:
+    if not os.environ.get('STANDIN_KEYS'):
+        sys.stderr.write("root@standin: Permission denied (publickey,password).\n")
+        sys.exit(255)
+else:
+    tty = os.open('/dev/tty', os.O_RDWR)
+    os.write(tty, b"root@standin's password: ")
+    answer = b''
+    while not answer.endswith((b'\n', b'\r')):
+        data = os.read(tty, 1)
+        if not data:
+            break
+        answer += data
+    if answer.strip().decode() != os.environ['STANDIN_PASSWORD']:
+        os.write(tty, b"Permission denied, please try again.\n")
+        sys.exit(255)
+    os.write(tty, b"\n")
+    os.close(tty)
+if control and options.get('ControlMaster') in ('yes', 'auto') and not master_pid():
+    start_master()
+
+BOX_PATH = re.compile(r"(?<![\w./$-])/(mod|var|proc|tmp|etc|bin/env\.mod\.rcconf|usr/bin/prepare-downgrade)"
+                      r"(?=[/\s'\";:)|&>]|$)")
+BOX_ROOT = re.compile(r"(?<=[\s'\"=(;])/(?=[\s'\";)]|$)")
+
+def box_path(text):
+    return BOX_ROOT.sub(root + '/', BOX_PATH.sub(lambda m: root + m.group(0), text))
+
+def throttled(size):
+    if bandwidth > 0:
+        time.sleep(size / bandwidth)
+
+if os.path.basename(sys.argv[0]) == 'scp':
+    local, remote = args[-2], args[-1].split(':', 1)[1]
+    throttled(os.path.getsize(local))
+    shutil.copyfile(local, box_path(' ' + remote)[1:])
+    sys.exit(0)
+
+shell = shutil.which('busybox') and ['busybox', 'sh'] or ['bash', '--posix']
+command = box_path(args[-1])
+# The requests to the helper agent hold box paths too: they are rewritten line by line
+agent = ' sfu-agent ' in command
+# Like a session of the box sshd, the command outlives the terminal (nohup ... &)
+if (bandwidth <= 0 and not agent) or os.isatty(0):
+    sys.exit(subprocess.call(shell + ['-c', command], start_new_session=True, cwd=root))
+child = subprocess.Popen(shell + ['-c', command], stdin=subprocess.PIPE, start_new_session=True, cwd=root)
+
+def pump():
+    start, sent, pending = time.monotonic(), 0, b''
+    try:
+        while True:
+            data = os.read(0, 65536)
+            if not data:
+                break
+            if agent:
+                data, pending = pending + data, b''
+                if not data.endswith(b'\n'):
+                    head, newline, pending = data.rpartition(b'\n')
+                    data = head + newline
+                data = box_path(data.decode()).encode()
+            child.stdin.write(data)
+            child.stdin.flush()
+            sent += len(data)
+            ahead = sent / bandwidth - (time.monotonic() - start) if bandwidth > 0 else 0
+            if ahead > 0:
+                time.sleep(ahead)
+        child.stdin.close()
+    except OSError:
+        pass
+threading.Thread(target=pump, daemon=True).start()
+sys.exit(child.wait())
+"""
+
+STANDIN_FILES = {
+    'mod/etc/conf/mod.cfg': "export MOD_EXTERNAL_DIRECTORY='/var/media/ftp/external'\n"
+                            "export MOD_EXTERNAL_FREETZ_SERVICES='yes'\nexport MOD_LANG='en'\n"
+                            "export MOD_HTTPD_PORT='%(web_port)d'\nexport MOD_HTTPD_USER='admin'\n"
+                            "export MOD_STOR_PREFIX='uStor'\n",
+    'etc/freetz_info.cfg': "export FREETZ_INFO_BOXTYPE='7590'\nexport FREETZ_INFO_FIRMWAREVERSION='07.57'\n"
+                           "export FREETZ_INFO_VERSION='ng-standin'\nexport FREETZ_INFO_MAKEDATE='20250101'\n"
+                           "export FREETZ_INFO_IMAGE_NAME='standin.image'\n",
+    'proc/sys/urlader/environment': "HWRevision\t226\nHWSubRevision\t1\nProductID\tFritz_Box_HW226\n"
+                                    "SerialNumber\t0000000000000000\nannex\tB\nautoload\tyes\n"
+                                    "bootloaderVersion\t1.3486\ncountry\t049\nfirmware_info\t154.07.57\n"
+                                    "firmware_version\tavm\nflashsize\tnor_size=0MB sflash_size=1024KB nand_size=512MB\n",
+    'proc/cpuinfo': "processor\t: 0\nprocessor\t: 1\n",
+    'proc/mtd': 'dev:    size   erasesize  name\nmtd0: 00400000 00010000 "jffs2"\n',
+    'bin/env.mod.rcconf': ":\n",
+    'usr/bin/prepare-downgrade': "#!/bin/sh\necho 'downgrade prepared'\n",
+    'etc/inittab.shutdown': "#!/bin/sh\n:\n",
+    'mod/sbin/prepare_fwupgrade': "#!/bin/sh\n:\n",
+    'mod/sbin/reboot': "#!/bin/sh\nsleep ${2:-0}\n"
+                       "echo $(( $(date +%%s) + %(boot)d )) > \"$STANDIN_STATE\"\n",
+    'mod/bin/df': "#!/bin/sh\necho 'Filesystem Size Used Available Use%% Mounted on'\n"
+                  "echo '/dev/ubi1_0 410.1M 12.0M 398.1M 3%% /var/media/ftp'\n"
+                  "echo '/dev/sda1 29.3G 1.2G 28.1G 4%% /var/media/ftp/uStor01'\n",
+    'mod/bin/sh': "#!/bin/sh\ncommand -v busybox >/dev/null && exec busybox sh \"$@\"\nexec bash --posix \"$@\"\n",
+    'mod/etc/init.d/rc.external': "#!/bin/sh\ncase \"$1\" in status) echo running ;; *) echo \"external $1\" ;; esac\n",
+    'var/media/ftp/.keep': "",
+    'var/tmp/.keep': "",
+    'tmp/.keep': "",
+}
+
+# Metadata and /var/install of the stand-in firmware image
+STANDIN_CONTENT = "Product=Fritz_Box_HW226 (FRITZ!Box 7590)\nVersion=154.07.57\nType=Fritz_Box_HW226\n"
+STANDIN_INSTALL = """#!/bin/sh
+sleep %(install)s
+touch "$STANDIN_ROOT/var/post_install"
+exit 1
+"""
+
+def standin_files(root, files):
+    """Write {relative path: content} below root, scripts executable"""
+    for name, content in files.items():
+        path = os.path.join(root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(content)
+        if content.startswith('#!'):
+            os.chmod(path, 0o755)
+
+def standin_archive(path, files, size_mb, root_files=None, images=()):
+    """
+    Write a tar of files members holding size_mb MB of half-compressible data (plus root_files
+    scripts); the first members are named after images and carry a TI checksum trailer
+    """
+    chunk = size_mb * 1024 * 1024 // max(1, files)
+    with tarfile.open(path, 'w') as tar:
+        for name, content in (root_files or {}).items():
+            info = tarfile.TarInfo(name)
+            info.size, info.mode = len(content), 0o755
+            tar.addfile(info, io.BytesIO(content.encode()))
+        for i in range(files):
+            data = os.urandom(chunk // 2) + bytes(chunk - chunk // 2)
+            info = tarfile.TarInfo(f"./usr/lib/package-{i // 50:03d}/file-{i:05d}.bin")
+            if i < len(images):
+                data = data[:-8]  # the TI checksum is the POSIX cksum of the payload
+                crc = int(subprocess.run(['cksum'], input=data, capture_output=True, check=True).stdout.split()[0])
+                data += sfu.TI_CHECKSUM_MAGIC.to_bytes(4, 'little') + crc.to_bytes(4, 'little')
+                info = tarfile.TarInfo(images[i])
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+
+class StandinDevice:
+    """
+    Local stand-in FRITZ!Box: rootfs directory, ssh/scp on PATH and a TCP
+    listener greeting like dropbear on the SSH and web ports while the box
+    is up (sfu.SSH_PORT is moved to it).
+    """
+    def __init__(self, directory, password, latency=0.0, bandwidth=0.0, boot=5):
+        self.root = os.path.join(directory, 'root')
+        self.state = os.path.join(directory, 'up-at')
+        self.password = password
+        bindir = os.path.join(directory, 'bin')
+        os.makedirs(bindir)
+        for name in ('ssh', 'scp'):
+            path = os.path.join(bindir, name)
+            with open(path, 'w') as f:
+                f.write(STANDIN_DEVICE % {'python': sys.executable})
+            os.chmod(path, 0o755)
+        self.ssh_port, self.web_port = self._free_port(), self._free_port()
+        standin_files(self.root, {name: content % {'web_port': self.web_port, 'boot': boot}
+                                  for name, content in STANDIN_FILES.items()})
+        os.environ.update(PATH=f"{bindir}{os.pathsep}{os.environ['PATH']}", STANDIN_ROOT=self.root,
+                          STANDIN_STATE=self.state, STANDIN_PASSWORD=password,
+                          STANDIN_LATENCY=str(latency), STANDIN_BANDWIDTH=str(bandwidth * 1024 * 1024))
+        sfu.SSH_PORT = self.ssh_port
+        self._stop = threading.Event()
+        threading.Thread(target=self._listen, daemon=True).start()
+
+    @staticmethod
+    def _free_port():
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            return sock.getsockname()[1]
+
+    def is_up(self):
+        try:
+            with open(self.state) as f:
+                return time.time() >= float(f.read())
+        except (OSError, ValueError):
+            return True
+
+    def _listen(self):
+        """Accept connections on both ports while the box is up; close the ports while it reboots"""
+        listeners = []
+        while not self._stop.is_set():
+            if self.is_up() and not listeners:
+                for port in (self.ssh_port, self.web_port):
+                    sock = socket.socket()
+                    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                    sock.bind(('127.0.0.1', port))
+                    sock.listen(16)
+                    listeners.append(sock)
+            elif not self.is_up() and listeners:
+                for sock in listeners:
+                    sock.close()
+                listeners = []
+            if not listeners:
+                time.sleep(0.05)
+                continue
+            for sock in select.select(listeners, [], [], 0.05)[0]:
+                conn, _ = sock.accept()
+                if sock is listeners[0]:
+                    conn.sendall(b'SSH-2.0-dropbear_2022.83\r\n')
+                conn.close()
+        for sock in listeners:
+            sock.close()
+
+    def path(self, box_path):
+        """Local path of a file on the stand-in box"""
+        return os.path.join(self.root, box_path.lstrip('/'))
+
+    def close(self):
+        self._stop.set()
+
+def timed(func, *args, **kwargs):
+    """Return (result, seconds) of a call, its console output discarded"""
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as null, contextlib.redirect_stdout(null), contextlib.redirect_stderr(null):
+        result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+def bench_device(args):
+    """Probe, upload, extract, reboot and update end to end against the local stand-in FRITZ!Box"""
+    password, host = 'standin', '127.0.0.1'
+    failures = []
+    with tempfile.TemporaryDirectory() as tmp:
+        box = StandinDevice(tmp, password, args.latency, args.bandwidth, args.boot)
+        os.chdir(tmp)
+        sfu.CACHE_DIR = os.path.join(tmp, 'cache')  # no index or link profile from an earlier run
+        firmware, external = os.path.join(tmp, 'standin.image'), os.path.join(tmp, 'standin.external')
+        standin_archive(firmware, 4, args.firmware_size, {'./var/content': STANDIN_CONTENT,
+                                                          './var/install': STANDIN_INSTALL % {'install': args.install}},
+                        ('./var/tmp/kernel.image', './var/tmp/filesystem.image'))
+        standin_archive(external, args.files, args.external_size)
+        print(f"Stand-in FRITZ!Box: latency {args.latency}s, "
+              f"bandwidth {f'{args.bandwidth} MB/s' if args.bandwidth else 'unlimited'}, boot {args.boot}s")
+
+        print("Configuration probe (shared connection, then one login per command):")
+        for name, batch, shared in (('batched probe', True, True), ('one command per item', False, True),
+                                    ('batched, own logins', True, False), ('per item, own logins', False, False)):
+            sfu.SESSIONS.enabled = shared
+            config, elapsed = timed(sfu.read_device_config, host, 'root', password, batch=batch)
+            sfu.SESSIONS.close(host, 'root')
+            print(f"  {name:<28} {elapsed:7.3f}s")
+            if config is None or config.product_id != 'Fritz_Box_HW226' or config.port != str(box.web_port):
+                failures.append(f"read_device_config ({name})")
+
+        print("Small commands (key authentication):")
+        os.environ['STANDIN_KEYS'] = '1'
+        probe = "test -f /var/tmp/.keep && echo exists || echo notfound"
+        for name, shared, enabled in (('one login per command', False, False), ('shared connection', True, False),
+                                      ('agent', True, True)):
+            sfu.SESSIONS.enabled, sfu.AGENTS.enabled = shared, enabled
+            outputs, elapsed = timed(lambda: [sfu.ssh_run(host, 'root', password, probe) for _ in range(args.probes)])
+            print(f"  {name:<28} {elapsed / args.probes * 1000:7.2f} ms/command")
+            if any(output.strip() != 'exists' for output in outputs):
+                failures.append(f"probes ({name})")
+        agent = sfu.AGENTS.acquire(host, 'root', password)
+        cfg = '/mod/etc/conf/mod.cfg'
+        with open(box.path(cfg), 'rb') as f:
+            content = f.read()
+        results = {'test': agent.test('-d', '/var/tmp') and not agent.test('-e', '/var/missing'),
+                   'stat': agent.stat(cfg) == ('f', len(content)) and agent.stat('/var/missing') is None,
+                   'read': agent.read(cfg) == content.decode(), 'du': agent.du('/mod') is not None,
+                   'df': 'Filesystem' in agent.df('/var/media/ftp'),
+                   'manifest': f"{hashlib.md5(content).hexdigest()}  ./conf/mod.cfg" in (agent.manifest('/mod/etc') or ''),
+                   'checksum': agent.checksum('md5sum', cfg) == hashlib.md5(content).hexdigest()}
+        sfu.AGENTS.release(agent)
+        sfu.AGENTS.close(host, 'root')
+        sfu.AGENTS.enabled = False
+        sfu.SESSIONS.close(host, 'root')
+        sfu.SESSIONS.enabled = True  # the default: the transfers, the reboot and the updates share a connection
+        del os.environ['STANDIN_KEYS']
+        failures.extend(f"agent {op}" for op, ok in results.items() if not ok)
+
+        print("Pre-flight check:")
+        damaged = os.path.join(tmp, 'damaged.image')
+        shutil.copyfile(firmware, damaged)
+        kernel = next(m for m in sfu.ArchiveIndex.load(damaged).members if m[0].endswith('kernel.image'))
+        with open(damaged, 'r+b') as f:
+            f.seek(kernel[2] + kernel[3] // 2)
+            byte = f.read(1)
+            f.seek(-1, os.SEEK_CUR)
+            f.write(bytes([byte[0] ^ 0xFF]))
+        # The layouts without a classic kernel + filesystem pair must pass too
+        fit, hidden_root = os.path.join(tmp, 'fit.image'), os.path.join(tmp, 'hidden-root.image')
+        install = {'./var/install': STANDIN_INSTALL % {'install': 0}}
+        standin_archive(fit, 2, 1, install, ('./var/tmp/fit-image',))
+        standin_archive(hidden_root, 2, 1, dict(install, **{'./var/tmp/filesystem.image': ''}),
+                        ('./var/tmp/kernel.image',))
+        for name, path in (('image', firmware), ('cached', firmware), ('FIT image layout', fit),
+                           ('hidden root layout', hidden_root), ('damaged image', damaged)):
+            result, elapsed = timed(lambda path: sfu.ArchiveIndex.load(path).verify(), path)
+            report(name, os.path.getsize(path), elapsed)
+            if bool(result['errors']) != (path == damaged):
+                failures.append(f"pre-flight check ({name}): {result['errors']}")
+
+        print("Transfers:")
+        ok, elapsed = timed(sfu.resumable_upload, host, 'root', password, firmware, '/var/tmp/standin.image')
+        report("streamed upload", os.path.getsize(firmware), elapsed)
+        if not ok or not filecmp.cmp(firmware, box.path('/var/tmp/standin.image'), shallow=False):
+            failures.append("upload")
+        large = os.path.join(tmp, 'standin-large.image')
+        standin_archive(large, 4, args.parallel_size)
+        for name, streams in (('upload, one stream', 1), (f"upload, up to {args.streams} streams", args.streams)):
+            if os.path.exists(box.path('/var/tmp/standin-large.image')):
+                os.remove(box.path('/var/tmp/standin-large.image'))
+            sfu.TRACE.events.clear()
+            sfu.TRACE.enabled = True
+            remote, elapsed = timed(sfu.upload_file_with_progress, host, 'root', password, large, '/var/tmp',
+                                    streams=streams)
+            sfu.TRACE.enabled = False
+            used = next((e['args'].get('streams', 1) for e in sfu.TRACE.events if e['name'] == 'upload'), 1)
+            report(f"{name} ({used})" if streams > 1 else name, os.path.getsize(large), elapsed)
+            if not remote or not filecmp.cmp(large, box.path('/var/tmp/standin-large.image'), shallow=False):
+                failures.append(name)
+        extraction = {}
+        for codec in ('none', 'gzip', 'auto'):
+            if codec == 'auto':
+                print("Calibration:")
+                model = sfu.LinkProfile.model_of(config)
+                for name, force in (('measured', True), ('cached', False)):
+                    profile, elapsed = timed(sfu.calibrate_link, host, 'root', password, model, external,
+                                             '/var/media/ftp', force=force)
+                    print(f"  {name:<28} {elapsed:7.3f}s  {profile.summary() if profile else 'failed'}")
+                    if profile is None or not profile.decompress.get('gzip') or not profile.write:
+                        failures.append(f"calibration ({name})")
+                if profile and args.bandwidth and not 0.5 < profile.link / (args.bandwidth * 1024 * 1024) < 1.2:
+                    failures.append(f"calibration: link measured at {sfu.format_size(profile.link)}/s")
+            target = f"/var/media/ftp/bench-{codec}"
+            ok, elapsed = timed(sfu.extract_archive_with_progress, host, 'root', password, external, target,
+                                '/tmp/bench_extract.log', compress=codec)
+            extraction[codec] = elapsed
+            if codec == 'auto':
+                chosen = sfu.choose_wire_codec(host, 'root', password, external, 'auto', target_dir=target)
+                codec = f"auto, calibrated: {chosen[0] or 'plain'}{f' -{chosen[2]}' if chosen[2] else ''}"
+            report(f"extraction ({codec})", os.path.getsize(external), elapsed)
+            extracted = sum(len(files) for _, _, files in os.walk(box.path(target)))
+            if not ok or extracted != args.files:
+                failures.append(f"extraction ({codec}): {extracted}/{args.files} files")
+        if extraction['auto'] > 1.25 * min(extraction['none'], extraction['gzip']) + 0.1:
+            failures.append("calibrated extraction slower than the best fixed codec")
+
+        print("Reboot:")
+        timed(sfu.ssh_run, host, 'root', password, sfu.REBOOT_CMD, capture_output=False)
+        ok, elapsed = timed(sfu.wait_router_boot, host, password, web_port=box.web_port)
+        print(f"  {'reboot to SSH login':<28} {elapsed:7.3f}s  (stand-in boot {args.boot}s)")
+        if not ok:
+            failures.append("boot wait")
+
+        for mode, options in (('sequential, web interface wait', ['--wait-web']),
+                              ('sequential, one login per command', ['--no-multiplex']), ('pipelined', ['--pipeline']),
+                              ('pipelined, key authentication, remote agent', ['--pipeline', '--agent'])):
+            print(f"End-to-end update, {mode} (firmware, external, reboot at the end):")
+            if os.path.exists(box.path('/var/post_install')):
+                os.remove(box.path('/var/post_install'))
+            update_args = sfu.build_parser().parse_args(
+                ['--host', host, '--password', password, '--batch', '--image', firmware, '--external', external,
+                 '--reboot-at-the-end', '--compress', args.compress] + options)
+            sfu.TRACE.events.clear()
+            sfu.TRACE.enabled = True
+            sfu.AGENTS.enabled = update_args.agent
+            os.environ['STANDIN_KEYS'] = '1' if update_args.agent else ''
+            sfu._key_auth.clear()
+            sfu._key_auth_retry.clear()
+            rc, elapsed = timed(sfu.run_update, update_args)
+            sfu.TRACE.enabled = sfu.AGENTS.enabled = False
+            sfu.SESSIONS.enabled = True
+            sfu.AGENTS.close(host, 'root')
+            sfu.SESSIONS.close(host, 'root')
+            sfu._key_auth.clear()
+            sfu._key_auth_retry.clear()
+            print(f"  {'total':<28} {elapsed:7.3f}s")
+            phases = {}
+            for event in sfu.TRACE.events:
+                if event.get('cat') in ('phase', 'step') and event['name'] != 'update':
+                    phases[event['name']] = phases.get(event['name'], 0) + event['dur'] / 1e6
+            for name, seconds in sorted(phases.items(), key=lambda item: -item[1])[:args.top]:
+                print(f"    {name:<26} {seconds:7.3f}s")
+            extracted = sum(len(files) for _, _, files in os.walk(box.path('/var/media/ftp/external')))
+            if rc != 0 or not os.path.exists(box.path('/var/post_install')) or extracted != args.files + 1:
+                failures.append(f"{mode} end-to-end update (exit code {rc}, {extracted - 1}/{args.files} files)")
+        box.close()
+        os.chdir(os.path.dirname(tmp))
+
+    if failures:
+        print(f"FAIL: {', '.join(failures)}")
+        return 1
+    print("OK: all results verified")
+    return 0
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for ssh_firmware_update.py")
+    sub = parser.add_subparsers(dest='bench', required=True)
+    p = sub.add_parser('capture', help='PTY output capture and prompt filtering')
+    p.add_argument('--sizes', default='1,2,4,8', help='Comma separated output sizes in MB (default: 1,2,4,8)')
+    p.set_defaults(func=bench_capture)
+    p = sub.add_parser('drain', help='per-call overhead and end of stream detection (timing test)')
+    p.add_argument('--calls', type=int, default=20, help='Calls per case (default: 20)')
+    p.set_defaults(func=bench_drain)
+    p = sub.add_parser('transport', help='PTY vs pipe transport throughput (local commands)')
+    p.add_argument('--size', type=int, default=64, help='Data size in MB (default: 64)')
+    p.set_defaults(func=bench_transport)
+    p = sub.add_parser('progress', help='progress display cost for many concurrent transfers (no I/O)')
+    p.add_argument('--tasks', default='1,10,100,1000', help='Comma separated numbers of concurrent transfers (default: 1,10,100,1000)')
+    p.add_argument('--threads', type=int, default=8, help='Threads updating the transfers (default: 8)')
+    p.add_argument('--seconds', type=float, default=1, help='Duration of each case in seconds (default: 1)')
+    p.set_defaults(func=bench_progress)
+    p = sub.add_parser('async', help='concurrent commands and uploads on one event loop (local stand-in sshd)')
+    p.add_argument('--commands', type=int, default=200, help='Concurrent commands (default: 200)')
+    p.add_argument('--sleep', type=float, default=0.5, help='Duration of each remote command in seconds (default: 0.5)')
+    p.add_argument('--uploads', type=int, default=20, help='Concurrent uploads (default: 20)')
+    p.add_argument('--upload-size', type=int, default=4, help='Size of each upload in MB (default: 4)')
+    p.set_defaults(func=bench_async)
+    p = sub.add_parser('device', help='probe, upload, extraction, reboot and full update against a local stand-in FRITZ!Box')
+    p.add_argument('--latency', type=float, default=0.02, help='Connection setup time of each SSH command in seconds (default: 0.02)')
+    p.add_argument('--bandwidth', type=float, default=0, help='Upload bandwidth in MB/s, 0 for unlimited (default: 0)')
+    p.add_argument('--boot', type=int, default=5, help='Seconds the stand-in takes to reboot (default: 5)')
+    p.add_argument('--install', type=float, default=1, help='Seconds /var/install runs (default: 1)')
+    p.add_argument('--firmware-size', type=int, default=16, help='Size of the firmware image in MB (default: 16)')
+    p.add_argument('--external-size', type=int, default=8, help='Size of the external archive in MB (default: 8)')
+    p.add_argument('--files', type=int, default=500, help='Files in the external archive (default: 500)')
+    p.add_argument('--compress', default='auto', help='--compress of the end-to-end update (default: auto)')
+    p.add_argument('--parallel-size', type=int, default=64, help='Size of the file of the parallel upload in MB (default: 64)')
+    p.add_argument('--streams', type=int, default=sfu.PARALLEL_STREAMS_MAX,
+                   help=f'Most streams of the parallel upload (default: {sfu.PARALLEL_STREAMS_MAX})')
+    p.add_argument('--probes', type=int, default=50, help='Small commands timed with and without the remote agent (default: 50)')
+    p.add_argument('--top', type=int, default=12, help='Slowest phases of the end-to-end update shown (default: 12)')
+    p.set_defaults(func=bench_device)
+    args = parser.parse_args()
+    return args.func(args) or 0
+
+if __name__ == "__main__":
+    sys.exit(main())